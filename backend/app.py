@@ -1,28 +1,49 @@
-from flask import Flask, request, jsonify, send_file
-from flask_pymongo import PyMongo
+from flask import Flask, Blueprint, Request, Response, request, jsonify, send_file, g
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
 from flask_cors import CORS
 import gridfs
 import os
 import pymongo
-import traceback
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import logging
 import uuid
 import json
+import base64
 from bson.objectid import ObjectId
 import hashlib
 import google.generativeai as genai
-from PIL import Image
-from datetime import datetime, timezone
-
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app)
+from PIL import Image, ImageOps
+import io
+import shutil
+import tempfile
+from datetime import datetime, timezone, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import time
+import random
+import contextvars
+from indexes import ensure_indexes, explain_queries
+from llm_gateway import LLMGateway
+from providers import GeminiProvider, MockProvider
+from metrics import (LLMCallMetrics, MongoCommandMetrics, WriteBehindMetrics, observe_request, observe_vision_preprocess,
+                     render_metrics, start_request_timer)
+from structured_logging import LogPipeline, request_id_var
+from write_behind import WriteBehindBuffer
+
+# All routes live on this blueprint; create_app() builds the Flask app around it
+api = Blueprint("api", __name__)
 
 # API configuration for image recognition service
 API_CONFIG = {
     # Using Gemini API for image recognition
     "service": "gemini",
     "api_key": "your-api-key",  # Using the same key as Gemini chat
-    "enable_mock": False  # Disable mock data and use real API
+    # Use the deterministic local MockProvider instead of Gemini (see providers.py),
+    # e.g. ENABLE_MOCK=1 for offline load tests and benchmarks
+    "enable_mock": os.environ.get("ENABLE_MOCK", "").lower() in ("1", "true", "yes")
 }
 
 # Large language model configuration for conversation
@@ -36,61 +57,475 @@ LLM_CONFIG = {
     "model": "gemini-1.5-flash"
 }
 
-# Global variable to track database status
-db_connection_status = {"status": "Unknown", "error": None}
+# Policies applied to every Gemini call (see llm_gateway.py)
+LLM_GATEWAY_CONFIG = {
+    # Per-call deadline in seconds, by call site
+    "timeouts": {"vision": 60, "title": 20, "chat": 30, "summary": 30},
+    "default_timeout": 30,
+    # Retries for rate limiting, timeouts and 5xx errors, with jittered exponential backoff
+    "max_retries": 2,
+    "retry_initial_delay": 0.5,
+    "retry_max_delay": 4,
+    # Calls allowed in flight per process; further calls wait up to queue_timeout seconds for a slot
+    "max_in_flight": 8,
+    "queue_timeout": 5,
+    # Consecutive provider failures that open the circuit, and seconds before a trial call
+    "failure_threshold": 5,
+    "circuit_cooldown": 30
+}
 
-# Simple MongoDB Atlas connection
-try:
-    print("Connecting to MongoDB Atlas...")
-    # Standard MongoDB connection string
-    mongodb_uri = "your-mongodb-connection-string"
-    
-    # Configure Flask app to use MongoDB
-    app.config["MONGO_URI"] = mongodb_uri
-    mongo = PyMongo(app)
-    
-    # Test connection with a simple command
-    mongo.db.command('ping')
-    print("Connected to MongoDB Atlas successfully")
-    db_connection_status["status"] = "Connected"
-    
-except Exception as e:
-    print(f"MongoDB connection error: {str(e)}")
-    db_connection_status["status"] = "Error"
-    db_connection_status["error"] = str(e)
-    raise
+# Simulated model behaviour when API_CONFIG["enable_mock"] is set
+MOCK_CONFIG = {
+    # Seeds the latency and failure draws, so a run with the same calls repeats exactly
+    "seed": 42,
+    # Log-normal latency in seconds by call site: median and spread (sigma of the log)
+    "latency": {
+        "vision": {"median": 1.5, "sigma": 0.3},
+        "title": {"median": 0.4, "sigma": 0.2},
+        "chat": {"median": 0.8, "sigma": 0.3},
+        "summary": {"median": 0.8, "sigma": 0.3}
+    },
+    "default_latency": {"median": 0.5, "sigma": 0.2},
+    # Fraction of calls that fail with a retryable provider error, or hang until the deadline
+    "error_rate": 0.0,
+    "timeout_rate": 0.0,
+    # Streamed replies arrive a few words at a time
+    "stream_chunk_words": 4,
+    "stream_chunk_delay": 0.05
+}
+
+# Server-Sent Events chat (/chat/stream)
+CHAT_STREAM_CONFIG = {
+    # Seconds without a chunk before a keep-alive comment is sent to the client
+    "keepalive_interval": 15
+}
+
+# Answers to first questions about an image, reused when the same question is asked again.
+# Follow-up questions (with earlier turns in the prompt) are never cached.
+ANSWER_CACHE_CONFIG = {
+    "enabled": True,
+    # In-process LRU tier
+    "max_entries": 1000,
+    "ttl_seconds": 6 * 60 * 60,
+    # Shared tier in the answerCache collection, so all workers and restarts reuse answers
+    "mongo_enabled": False
+}
+
+# Multi-turn chat context. Token counts are estimated as characters / chars_per_token.
+CHAT_CONTEXT_CONFIG = {
+    # Upper bound on the whole prompt (instructions, description, summary, history, question)
+    "max_prompt_tokens": 4000,
+    # Recent messages are included newest-first until this many tokens are used
+    "history_token_budget": 1500,
+    # Most recent unsummarized messages read from chatHistory per turn
+    "history_fetch_limit": 40,
+    # Older messages that no longer fit are folded into the stored running summary in the background
+    # once they add up to this many tokens, so summarization runs every few turns, not every turn
+    "summarize_threshold_tokens": 600,
+    "summary_max_tokens": 300,
+    # Pages of history_fetch_limit older messages summarized at most per background task; a longer backlog
+    # continues after the next turn
+    "max_summary_pages_per_turn": 3,
+    "chars_per_token": 4
+}
+
+# --- Batch Chat Configuration ---
+CHAT_BATCH_CONFIG = {
+    # /chat/batch answers up to this many questions with one model call
+    "max_questions": 10
+}
+
+# Upload pipeline configuration
+UPLOAD_CONFIG = {
+    # When enabled, /upload stores the blob and returns 202 with a job id;
+    # analysis and title generation run in a background worker pool.
+    # Clients can also opt in per request with the form field async=true.
+    "async_enabled": False,
+    "worker_count": 4,
+
+    # Jobs live in one process's worker pool, so a restart or crash strands them. A queued or
+    # processing job not updated for stale_job_seconds is requeued (it should exceed the longest
+    # queue wait plus analysis), and marked failed once it was requeued job_max_recoveries times.
+    "stale_job_seconds": 15 * 60,
+    "job_max_recoveries": 2,
+
+    # /upload/batch analyzes up to batch_worker_count files of one request at a time
+    "batch_worker_count": 4,
+    "batch_max_files": 50,
+
+    # "structured" asks the vision model once for description, title and labels as JSON,
+    # falling back to the description-then-title calls if the reply can't be parsed.
+    # "two_call" always uses the separate description and title calls.
+    "analysis_mode": "structured",
+    "max_labels": 10,
+
+    # Uploads (and GridFS reads for analysis) stay in memory up to this size
+    # and only spill to a temporary file in UPLOAD_FOLDER above it
+    "spool_max_bytes": 8 * 1024 * 1024,
+
+    # Cache lifetime for image bytes served from GridFS. An image's bytes never
+    # change after upload, so browsers and CDNs may keep them for a long time.
+    "image_cache_max_age": 365 * 24 * 60 * 60,
+
+    # Downscaled copies generated once at upload and served via /images/<id>/file?size=<name>
+    "derivative_sizes": {"thumb": 256, "medium": 1024},
+    "derivative_format": "JPEG",
+    "derivative_quality": 80
+}
+
+# List endpoint paging
+PAGINATION_CONFIG = {
+    "default_limit": 10,
+    "max_limit": 100,
+    "chat_default_limit": 100,
+    "chat_max_limit": 500,
+    "summary_default_limit": 50,
+    # How long a per-user image count is reused before it is recounted
+    "count_cache_ttl": 60,
+    # Per-user counts kept at most; the least recently used are evicted beyond this
+    "count_cache_max_entries": 10000
+}
+
+# MongoDB connection configuration
+MONGO_CONFIG = {
+    # Standard MongoDB connection string; the database name is taken from the URI
+    "uri": os.environ.get("MONGODB_URI", "your-mongodb-connection-string"),
+    # How long a single operation waits to find a reachable server
+    "server_selection_timeout_ms": 5000,
+    # Backoff between background connection attempts while the database is unreachable
+    "retry_initial_delay": 1,
+    "retry_max_delay": 30,
+    # Once connected, the database is pinged this often so /status/ready notices when it goes away
+    "health_check_interval": 10
+}
+
+# Image normalization applied before every vision call
+VISION_PREPROCESS_CONFIG = {
+    # Disable to send the original upload to the vision model unchanged
+    "enabled": True,
+    # Longest edge (in pixels) of the image sent to the model
+    "max_edge": 1536,
+    # Re-encode format ("JPEG" or "WEBP") and quality (1-95)
+    "format": "JPEG",
+    "quality": 85
+}
+
+# Image view tracking (see write_behind.py)
+VIEW_TRACKING_CONFIG = {
+    # Views waiting to be written; further views are dropped rather than slowing /images/<id>
+    "buffer_size": 10000,
+    # Views are written with one insert_many once this many are waiting, or every flush_interval seconds
+    "batch_size": 500,
+    "flush_interval": 2.0,
+    # /analytics/images reads hourly imageViewStats buckets for windows up to this long, daily ones beyond
+    "hourly_max_window_hours": 48,
+    # Hourly buckets are removed by a TTL index after this many days; daily and total ones are kept
+    "hourly_retention_days": 3
+}
+
+# Per-user activity counters behind /analytics/user-activity
+ACTIVITY_CONFIG = {
+    # Users listed per leaderboard
+    "leaderboard_size": 10,
+    # Leaderboards are served from memory and re-read from userActivity at most this often
+    "leaderboard_refresh_seconds": 30
+}
+
+# Application logging (see structured_logging.py)
+LOGGING_CONFIG = {
+    "level": os.environ.get("LOG_LEVEL", "INFO"),
+    # "json" for one JSON object per line, "text" for plain lines when reading logs by hand
+    "format": os.environ.get("LOG_FORMAT", "json"),
+    # Records waiting for the writer thread; further records are dropped rather than blocking requests
+    "queue_size": 10000,
+    # Fraction of records kept for high-volume events (logged with extra={"event": ...});
+    # warnings and errors are always kept. vision.preprocess is not sampled: it carries the
+    # per-image bytes-saved figures (also exported as vision_preprocess_bytes_total).
+    "sample_rates": {
+        "vision.response": 0.1,
+        "chat.prompt": 0.1,
+        "chat.response": 0.1
+    }
+}
 
-# Ensuring uploads directory exists
+log_pipeline = LogPipeline()
+logger = log_pipeline.configure("chatbot", LOGGING_CONFIG)
+
+# Ensuring uploads directory exists (created by create_app)
 UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
 
-# Initialize Gemini API
-# Ensuring API key is valid and configured
-gemini_api_key = API_CONFIG.get("api_key")
-if gemini_api_key:
-    try:
-        print(f"Attempting to configure Gemini API with key ending in: ...{gemini_api_key[-4:]}")
-        genai.configure(api_key=gemini_api_key)
-        print("Gemini API configured successfully using API Key.")
-    except Exception as api_conf_error:
-        print(f"ERROR configuring Gemini API: {api_conf_error}")
+# Global variable to track database status
+db_connection_status = {"status": "Unknown", "error": None}
 
-else:
-    print("WARNING: Gemini API key not found in API_CONFIG. Gemini features may fail.")
+class LazyMongo:
+    """
+    Per-process MongoDB handle exposing `.db` like flask_pymongo's PyMongo.
+    The MongoClient is created on first use in each process, so pre-fork servers never
+    share a client across workers, and creating it never blocks on the network.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    # A client inherited across fork is abandoned, never closed, as pymongo requires
+                    self._client = pymongo.MongoClient(
+                        MONGO_CONFIG["uri"],
+                        connect=False,
+                        serverSelectionTimeoutMS=MONGO_CONFIG.get("server_selection_timeout_ms", 5000),
+                        event_listeners=[MongoCommandMetrics()]
+                    )
+                    self._pid = pid
+        return self._client
+
+    @property
+    def db(self):
+        return self.client.get_default_database()
+
+mongo = LazyMongo()
+
+def connect_to_database():
+    """
+    Background task: ping MongoDB until it answers, backing off between attempts,
+    make sure the required indexes exist, then mark the database as connected so
+    /status/ready reports ready. Afterwards keep checking it (see monitor_database).
+    """
+    delay = MONGO_CONFIG.get("retry_initial_delay", 1)
+    while True:
+        try:
+            logger.info("Connecting to MongoDB Atlas...")
+            mongo.db.command('ping')
+            logger.info("Connected to MongoDB Atlas successfully")
+            index_errors = ensure_indexes(mongo.db)
+            for index_error in index_errors:
+                logger.warning(f"could not create index {index_error}")
+            recover_upload_jobs()
+            db_connection_status["status"] = "Connected"
+            db_connection_status["error"] = None
+            break
+        except Exception as e:
+            logger.error(f"MongoDB connection error: {str(e)} (retrying in {delay}s)")
+            db_connection_status["status"] = "Error"
+            db_connection_status["error"] = str(e)
+        time.sleep(delay + random.uniform(0, delay / 2))
+        delay = min(delay * 2, MONGO_CONFIG.get("retry_max_delay", 30))
+    monitor_database()
+
+def monitor_database():
+    """
+    Ping MongoDB every health_check_interval seconds and flip db_connection_status between
+    "Connected" and "Error", so /status/ready stops reporting ready while the database is down.
+    Each check also picks up upload jobs stranded by another process (see recover_upload_jobs).
+    """
+    interval = MONGO_CONFIG.get("health_check_interval", 10)
+    while True:
+        time.sleep(interval)
+        try:
+            mongo.db.command('ping')
+            if db_connection_status["status"] != "Connected":
+                logger.info("MongoDB is reachable again")
+            db_connection_status["status"] = "Connected"
+            db_connection_status["error"] = None
+            recover_upload_jobs()
+        except Exception as e:
+            if db_connection_status["status"] == "Connected":
+                logger.error(f"Lost connection to MongoDB: {str(e)}")
+            db_connection_status["status"] = "Error"
+            db_connection_status["error"] = str(e)
+
+# Process id the background services were started in; reset implicitly by fork
+background_services_pid = None
+background_services_lock = threading.Lock()
+
+def ensure_background_services():
+    """Start this process's log writer, view flush and database connection threads if they aren't running yet."""
+    global background_services_pid
+    if background_services_pid == os.getpid():
+        return
+    log_pipeline.start()
+    view_buffer.start()
+    with background_services_lock:
+        if background_services_pid == os.getpid():
+            return
+        background_services_pid = os.getpid()
+        db_connection_status["status"] = "Connecting"
+        db_connection_status["error"] = None
+        threading.Thread(target=connect_to_database, name="mongo-connect", daemon=True).start()
+
+# Gemini API is configured on first use in each process
+genai_configured_pid = None
+
+def ensure_genai_configured():
+    """Configure the Gemini API key once per process, before the first model call."""
+    global genai_configured_pid
+    if genai_configured_pid == os.getpid():
+        return
+    genai_configured_pid = os.getpid()
+
+    # Ensuring API key is valid and configured
+    gemini_api_key = API_CONFIG.get("api_key")
+    if gemini_api_key:
+        try:
+            logger.info(f"Attempting to configure Gemini API with key ending in: ...{gemini_api_key[-4:]}")
+            genai.configure(api_key=gemini_api_key)
+            logger.info("Gemini API configured successfully using API Key.")
+        except Exception as api_conf_error:
+            logger.error(f"Error configuring Gemini API: {api_conf_error}")
+
+    else:
+        logger.warning("Gemini API key not found in API_CONFIG. Gemini features may fail.")
+
+def create_llm_provider():
+    """The model provider selected by API_CONFIG["enable_mock"]."""
+    if API_CONFIG.get("enable_mock", False):
+        logger.info("Using the mock model provider")
+        return MockProvider(MOCK_CONFIG)
+    return GeminiProvider(configure=ensure_genai_configured)
+
+llm_gateway = LLMGateway(LLM_GATEWAY_CONFIG, create_llm_provider(), observer=LLMCallMetrics())
+
+class SpooledUploadRequest(Request):
+    """Request that buffers uploaded files in memory up to UPLOAD_CONFIG["spool_max_bytes"]."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_CONFIG.get("spool_max_bytes", 8 * 1024 * 1024), dir=UPLOAD_FOLDER)
+
+# Running totals for the vision preprocessing stage, reported by /status
+vision_preprocess_stats = {"calls": 0, "original_bytes": 0, "sent_bytes": 0}
+vision_preprocess_stats_lock = threading.Lock()
+
+def get_stream_size(stream):
+    """Return the total size of a seekable binary stream without moving its position."""
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def read_image_source(image_source):
+    """Return the full bytes of a file path or seekable binary file object."""
+    if isinstance(image_source, str):
+        with open(image_source, 'rb') as f:
+            return f.read()
+    image_source.seek(0)
+    return image_source.read()
+
+def encode_image(img, output_format, quality):
+    """Encode a PIL image in the given format, converting modes the format can't store."""
+    if output_format == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=output_format, quality=quality)
+    return buffer.getvalue()
+
+def prepare_image_for_vision(image_source, derivative_sizes=None):
+    """
+    Normalize an image before it is sent to the vision model: apply EXIF orientation,
+    downscale to VISION_PREPROCESS_CONFIG["max_edge"] (decoding JPEGs at reduced size
+    via draft mode) and re-encode at bounded quality.
+    image_source is a file path or a seekable binary file object.
+    derivative_sizes optionally maps derivative names to a maximum edge; each one is
+    produced from the same decoded image and encoded with UPLOAD_CONFIG's derivative settings.
+    Returns (image_part, stats, derivatives) where image_part can be passed to generate_content,
+    stats holds the original and sent byte counts for this call and derivatives maps each
+    name to its encoded data, content_type, width and height.
+    """
+    if isinstance(image_source, str):
+        original_bytes = os.path.getsize(image_source)
+    else:
+        image_source.seek(0)
+        original_bytes = get_stream_size(image_source)
+    img = Image.open(image_source)
+    logger.debug(f"Image loaded successfully: {img.size} pixels, Format: {img.format}")
+
+    preprocess_enabled = VISION_PREPROCESS_CONFIG.get("enabled", True)
+    max_edge = VISION_PREPROCESS_CONFIG.get("max_edge", 1536)
+    output_format = VISION_PREPROCESS_CONFIG.get("format", "JPEG").upper()
+    quality = VISION_PREPROCESS_CONFIG.get("quality", 85)
+    derivative_format = UPLOAD_CONFIG.get("derivative_format", "JPEG").upper()
+    derivative_quality = UPLOAD_CONFIG.get("derivative_quality", 80)
+    original_size = img.size
+    original_format = img.format
+
+    # Every output comes from one decode, shrinking the same image step by step, largest first
+    steps = [(edge, name) for name, edge in (derivative_sizes or {}).items()]
+    if preprocess_enabled:
+        steps.append((max_edge, None))
+    steps.sort(key=lambda step: step[0], reverse=True)
+
+    image_part = None
+    vision_size = original_size
+    derivatives = {}
+
+    if steps:
+        # Let the JPEG decoder skip straight to the nearest scale >= the largest output
+        if img.format == "JPEG":
+            img.draft("RGB", (steps[0][0], steps[0][0]))
+        img = ImageOps.exif_transpose(img)
+
+        for edge, name in steps:
+            img.thumbnail((edge, edge), Image.LANCZOS)
+            if name is None:
+                vision_size = img.size
+                image_part = {"mime_type": f"image/{output_format.lower()}", "data": encode_image(img, output_format, quality)}
+            elif max(original_size) > edge:
+                # Derivatives only exist where they are smaller than the original
+                derivatives[name] = {
+                    "data": encode_image(img, derivative_format, derivative_quality),
+                    "content_type": f"image/{derivative_format.lower()}",
+                    "width": img.width,
+                    "height": img.height
+                }
+
+    # Small, already-compact uploads can grow when re-encoded; send those (or everything, when disabled) as-is
+    if image_part is None or (len(image_part["data"]) >= original_bytes and vision_size == original_size and original_format in ("JPEG", "PNG", "WEBP")):
+        image_part = {
+            "mime_type": Image.MIME.get(original_format, "application/octet-stream"),
+            "data": read_image_source(image_source)
+        }
+    sent_bytes = len(image_part["data"])
+
+    stats = {
+        "original_bytes": original_bytes,
+        "sent_bytes": sent_bytes,
+        "bytes_saved": original_bytes - sent_bytes
+    }
+    with vision_preprocess_stats_lock:
+        vision_preprocess_stats["calls"] += 1
+        vision_preprocess_stats["original_bytes"] += original_bytes
+        vision_preprocess_stats["sent_bytes"] += sent_bytes
+    observe_vision_preprocess(original_bytes, sent_bytes)
+
+    logger.info("Vision preprocessing done", extra={
+        "event": "vision.preprocess",
+        "original_pixels": list(original_size), "sent_pixels": list(vision_size),
+        "original_bytes": original_bytes, "sent_bytes": sent_bytes
+    })
+    if derivatives and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Generated derivatives: " + ", ".join(f"{name} {d['width']}x{d['height']} ({len(d['data'])} bytes)" for name, d in derivatives.items()))
+    return image_part, stats, derivatives
 
 # Helper function for text generation using the configured LLM
-def generate_text_with_llm(prompt):
-    """Generates text using the configured conversational LLM."""
+def generate_text_with_llm(prompt, call_site="title"):
+    """Generates text using the configured conversational LLM. call_site labels the call in the gateway's stats."""
     if not LLM_CONFIG.get("enabled", False):
-        print("LLM is disabled. Cannot generate text.")
+        logger.info("LLM is disabled. Cannot generate text.")
         return "Error: LLM is disabled."
     
     try:
         model_name = LLM_CONFIG.get("model", "gemini-1.5-flash")
-        model = genai.GenerativeModel(model_name)
-        print(f"Generating text with {model_name}...")
-        response = model.generate_content(prompt)
+        logger.debug(f"Generating text with {model_name}...")
+        response = llm_gateway.generate_content(call_site, prompt, model_name)
         
         if response and hasattr(response, 'text'):
             return response.text.strip()
@@ -98,152 +533,605 @@ def generate_text_with_llm(prompt):
              return response.parts[0].text.strip()
         else:
             # Handle potential errors or empty responses
-            print(f"LLM text generation returned unexpected response: {response}")
+            logger.warning(f"LLM text generation returned unexpected response: {response}")
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
                  return f"Error: Text generation blocked ({response.prompt_feedback.block_reason})"
             return "Error: Failed to generate text."
             
     except Exception as e:
-        print(f"Error during LLM text generation: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error during LLM text generation: {str(e)}")
         return f"Error: {str(e)}"
 
-def call_vision_api(image_path, service=None):
+VISION_DESCRIPTION_PROMPT = "Describe this image in detail. What objects, scenes, or people are visible?"
+
+STRUCTURED_ANALYSIS_PROMPT = (
+    "Analyze this image and respond with only a JSON object with these keys:\n"
+    '"description": a detailed description of the image, covering the objects, scenes, and people visible,\n'
+    '"title": a short, descriptive title for the image of at most 5 words,\n'
+    '"labels": a list of up to 10 short lowercase labels for the main subjects of the image.\n'
+    "Do not include any text outside the JSON object."
+)
+
+def call_vision_api(image_source, service=None, prompt=None, json_mode=False):
     """
     Call the appropriate vision API based on configuration.
-    Returns a textual description of the image using gemini-pro-vision.
+    image_source is a file path, a seekable binary file object, or an image part
+    already returned by prepare_image_for_vision.
+    Returns a textual description of the image using gemini-pro-vision,
+    or the raw model reply when a custom prompt is given. json_mode asks for a JSON-only reply.
     """
     if not service:
         service = API_CONFIG.get("service", "gemini")
 
 
-    if image_path is None or not os.path.exists(image_path):
-        print("No valid image path provided")
+    if image_source is None or (isinstance(image_source, str) and not os.path.exists(image_source)):
+        logger.warning("No valid image path provided")
         return "Error: Invalid image path provided."
 
     # Gemini API for image recognition (gemini-pro-vision)
     if service == "gemini":
         try:
-            print(f"\n=== Calling Gemini Vision API (gemini-pro-vision) ===")
-            print(f"Image path: {image_path}")
+            logger.debug("Calling Gemini Vision API, image source: %s", image_source if isinstance(image_source, str) else "in-memory buffer")
 
-            # Load the image using PIL
-            img = Image.open(image_path)
-            print(f"Image loaded successfully: {img.size} pixels, Format: {img.format}")
-
-            model = genai.GenerativeModel('gemini-1.5-flash')
+            # Load and normalize the image using PIL, unless the caller already did
+            if isinstance(image_source, dict):
+                image_part = image_source
+            else:
+                image_part, _, _ = prepare_image_for_vision(image_source)
 
-            prompt = "Describe this image in detail. What objects, scenes, or people are visible?"
+            if not prompt:
+                prompt = VISION_DESCRIPTION_PROMPT
 
-            print("Sending request to Gemini Vision API...")
+            logger.debug("Sending request to Gemini Vision API...")
 
             # Generate content using the image and prompt
-            response = model.generate_content([prompt, img]) # Pass prompt first generally works well
+            response = llm_gateway.generate_content("vision", [prompt, image_part], 'gemini-1.5-flash', json_mode=json_mode) # Pass prompt first generally works well
 
             # Process the response
             if response and hasattr(response, 'text'):
                 text_response = response.text
-                print(f"Gemini Vision API response received: {text_response[:200]}...")
+                logger.info("Gemini Vision API response received", extra={"event": "vision.response", "chars": len(text_response)})
+                logger.debug("Vision response text: %.200s", text_response)
                 return text_response
             else:
                 # Handling cases where the response might be blocked or empty
-                print("Gemini Vision API returned an empty or unexpected response.")
+                logger.warning("Gemini Vision API returned an empty or unexpected response.")
                 if hasattr(response, 'prompt_feedback'):
-                    print(f"Prompt Feedback: {response.prompt_feedback}")
+                    logger.debug("Prompt Feedback: %s", response.prompt_feedback)
                 return "Error: Failed to get description from Vision API (empty response)."
 
         except FileNotFoundError:
-            print(f"Error: Image file not found at {image_path}")
+            logger.error(f"Error: Image file not found at {image_source}")
             return "Error: Image file not found."
         except Exception as e:
             raw_error_message = str(e)
-            print(f"Error using Gemini Vision API: {raw_error_message}")
-            traceback.print_exc()
+            logger.exception(f"Error using Gemini Vision API: {raw_error_message}")
             return f"Error: {raw_error_message}"
 
     # If no service matched or service is not implemented, return error string
-    print(f"Unknown or unimplemented vision service: {service}")
+    logger.warning(f"Unknown or unimplemented vision service: {service}")
     return f"Error: Unknown vision service '{service}' specified."
 
+def compute_content_hash(stream):
+    """
+    Return the SHA-256 hex digest of a seekable binary stream, read in chunks to keep
+    memory flat. The stream is rewound to the start afterwards.
+    """
+    sha256 = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        sha256.update(chunk)
+    stream.seek(0)
+    return sha256.hexdigest()
+
+def find_image_by_content_hash(content_hash):
+    """
+    Look up a previously stored image with the same bytes.
+    Returns the most recent matching images document, or None.
+    """
+    if not content_hash:
+        return None
+    return mongo.db.images.find_one(
+        {"content_hash": content_hash, "file_id": {"$exists": True}},
+        sort=[("uploadTimestamp", -1)]
+    )
+
+def extract_json_reply(raw_text):
+    """
+    Return the JSON object or array in a model reply, ignoring a markdown code fence and any
+    text around it, or None if there is none that parses.
+    """
+    if not raw_text:
+        return None
+
+    text = raw_text.strip()
+    # Models often wrap JSON in a markdown code fence
+    if text.startswith("```"):
+        text = text.strip("`").strip()
+        if text.lower().startswith("json"):
+            text = text[4:]
+    start = min((i for i in (text.find("{"), text.find("[")) if i != -1), default=-1)
+    end = max(text.rfind("}"), text.rfind("]"))
+    if start == -1 or end <= start:
+        return None
+
+    try:
+        return json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+
+def parse_structured_analysis(raw_text):
+    """
+    Parse and validate the JSON reply to STRUCTURED_ANALYSIS_PROMPT.
+    Returns a dictionary with description, title and labels, or None if the reply is unusable.
+    The title is None when it is missing or too long to be a title.
+    """
+    data = extract_json_reply(raw_text)
+    if not isinstance(data, dict):
+        return None
+
+    description = data.get("description")
+    if not isinstance(description, str) or not description.strip():
+        return None
+
+    title = data.get("title")
+    if isinstance(title, str):
+        title = title.strip('"\' \n')
+    if not title or not isinstance(title, str) or len(title.split()) > 10:
+        title = None
+
+    labels = []
+    raw_labels = data.get("labels")
+    if isinstance(raw_labels, list):
+        for label in raw_labels:
+            if isinstance(label, str) and label.strip():
+                labels.append({"label": label.strip().lower()})
+    labels = labels[:UPLOAD_CONFIG.get("max_labels", 10)]
+
+    return {"description": description.strip(), "title": title, "labels": labels}
+
+def encode_cursor(timestamp, object_id):
+    """Encode a (timestamp, _id) keyset position as an opaque, URL-safe cursor string."""
+    payload = json.dumps({"t": timestamp.isoformat(), "id": str(object_id)})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor into (timestamp, ObjectId). Raises ValueError if malformed."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(payload["t"]), ObjectId(payload["id"])
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+# Recent per-user image counts, keyed by user_id, least recently used first
+image_count_cache = OrderedDict()
+image_count_cache_lock = threading.Lock()
+
+def count_images(query):
+    """
+    Count images matching query cheaply: the collection-wide total comes from metadata,
+    per-user totals are counted and then reused for PAGINATION_CONFIG["count_cache_ttl"] seconds,
+    for at most count_cache_max_entries users.
+    """
+    user_id = query.get("user_id")
+    if user_id is None:
+        return mongo.db.images.estimated_document_count()
+
+    now = time.monotonic()
+    with image_count_cache_lock:
+        cached = image_count_cache.get(user_id)
+        if cached and now - cached[1] < PAGINATION_CONFIG.get("count_cache_ttl", 60):
+            image_count_cache.move_to_end(user_id)
+            return cached[0]
+
+    count = mongo.db.images.count_documents(query)
+    with image_count_cache_lock:
+        image_count_cache[user_id] = (count, now)
+        image_count_cache.move_to_end(user_id)
+        while len(image_count_cache) > PAGINATION_CONFIG.get("count_cache_max_entries", 10000):
+            image_count_cache.popitem(last=False)
+    return count
+
+def backfill_image_owners(batch_size=1000):
+    """
+    Copy each upload's user_id from uploadsImage onto its images document, for images
+    stored before the owner was denormalized. Returns the number of images updated.
+    """
+    updated = 0
+    batch = []
+    for upload in mongo.db.uploadsImage.find({}, {"user_id": 1, "image_id": 1}):
+        if not ObjectId.is_valid(upload.get("image_id")):
+            continue
+        batch.append(pymongo.UpdateOne(
+            {"_id": ObjectId(upload["image_id"]), "user_id": {"$exists": False}},
+            {"$set": {"user_id": upload.get("user_id", "anonymous")}}
+        ))
+        if len(batch) >= batch_size:
+            updated += mongo.db.images.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += mongo.db.images.bulk_write(batch, ordered=False).modified_count
+    return updated
+
 # Image analysis function - now returns description
-def analyze_image(image_path=None, image_id=None):
+def analyze_image(image_path=None, image_id=None, structured=False, image_stream=None, derivative_sizes=None):
     """
     Analyze image content using the configured vision API.
-    Retrieves image from GridFS if image_id is provided.
-    Returns a dictionary containing success status and description/error.
+    Analyzes image_stream (a seekable binary file object) directly when given;
+    otherwise retrieves the image from GridFS if image_id is provided.
+    The image is decoded once; derivatives for derivative_sizes are produced from
+    that same decode and returned under "derivatives".
+    With structured=True the description, title and labels come from a single JSON
+    vision call, and a plain description call is made only if that reply can't be parsed.
+    Returns a dictionary containing success status and description/error
+    (plus generated_title and labels when the structured call succeeded).
     """
-    temp_file_to_delete = None
+    spooled_copy = None
     try:
-        print(f"\n=== Starting Image Analysis ===")
-        print(f"Provided image path: {image_path}")
-        print(f"Provided image ID: {image_id}")
+        logger.info("Starting image analysis", extra={"event": "analysis.start", "image_path": image_path, "file_id": str(image_id) if image_id else None})
 
-        analysis_image_path = image_path
+        image_source = image_stream if image_stream is not None else image_path
 
-        # If we have an image_id, retrieve the file from GridFS
-        if image_id and not image_path:
+        # If we have an image_id, read the file from GridFS into a memory buffer
+        if image_id and image_source is None:
             fs = gridfs.GridFS(mongo.db)
             try:
                 if not ObjectId.is_valid(image_id):
-                     print(f"Invalid ObjectId format for image_id: {image_id}")
+                     logger.warning(f"Invalid ObjectId format for image_id: {image_id}")
                      return {"success": False, "error": "Invalid image ID format."}
 
                 file_data = fs.get(ObjectId(image_id))
-                print(f"Retrieved file from GridFS: {file_data.filename}")
+                logger.debug(f"Retrieved file from GridFS: {file_data.filename}")
 
-                # Create a temporary file to process
-                temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4()}_{file_data.filename}")
-                with open(temp_path, 'wb') as f:
-                    f.write(file_data.read())
-                analysis_image_path = temp_path
-                temp_file_to_delete = temp_path
-                print(f"Created temporary file for analysis at: {analysis_image_path}")
+                # Large files spill to disk past the spool threshold, small ones never touch it
+                spooled_copy = tempfile.SpooledTemporaryFile(
+                    max_size=UPLOAD_CONFIG.get("spool_max_bytes", 8 * 1024 * 1024),
+                    dir=UPLOAD_FOLDER
+                )
+                shutil.copyfileobj(file_data, spooled_copy, file_data.chunk_size)
+                spooled_copy.seek(0)
+                image_source = spooled_copy
 
             except gridfs.errors.NoFile:
-                 print(f"Error: No file found in GridFS for image_id: {image_id}")
+                 logger.error(f"Error: No file found in GridFS for image_id: {image_id}")
                  return {"success": False, "error": "Image file not found in storage."}
             except Exception as grid_error:
-                print(f"Error retrieving file from GridFS: {str(grid_error)}")
-                traceback.print_exc()
+                logger.exception(f"Error retrieving file from GridFS: {str(grid_error)}")
                 return {"success": False, "error": f"File retrieval error: {str(grid_error)}"}
 
-        if not analysis_image_path or not os.path.exists(analysis_image_path):
-            error_msg = f"Image path for analysis is invalid or file does not exist: {analysis_image_path}"
-            print(error_msg)
+        if image_source is None or (isinstance(image_source, str) and not os.path.exists(image_source)):
+            error_msg = f"Image path for analysis is invalid or file does not exist: {image_source}"
+            logger.warning(error_msg)
             return {"success": False, "error": error_msg}
 
-
-        print(f"Calling vision API for image: {analysis_image_path}")
-        description_or_error = call_vision_api(analysis_image_path)
-        print(f"Vision API returned: {description_or_error[:200]}...")
+        image_part, _, derivatives = prepare_image_for_vision(image_source, derivative_sizes)
+
+        if structured:
+            logger.debug("Calling vision API for structured analysis")
+            raw_or_error = call_vision_api(image_part, prompt=STRUCTURED_ANALYSIS_PROMPT, json_mode=True)
+            if isinstance(raw_or_error, str) and raw_or_error.startswith("Error:"):
+                return {"success": False, "error": raw_or_error}
+
+            parsed = parse_structured_analysis(raw_or_error)
+            if parsed:
+                return {
+                    "success": True,
+                    "description": parsed["description"],
+                    "generated_title": parsed["title"],
+                    "labels": parsed["labels"],
+                    "derivatives": derivatives
+                }
+            logger.info("Structured analysis reply could not be parsed, falling back to description call")
+
+        logger.debug("Calling vision API for image description")
+        description_or_error = call_vision_api(image_part)
+        logger.debug("Vision API returned: %.200s", description_or_error)
 
         if isinstance(description_or_error, str) and description_or_error.startswith("Error:"):
             return {"success": False, "error": description_or_error}
         else:
             
-            return {"success": True, "description": description_or_error}
+            return {"success": True, "description": description_or_error, "derivatives": derivatives}
 
     except Exception as e:
-        print(f"Error analyzing image: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error analyzing image: {str(e)}")
         return {"success": False, "error": f"Unexpected error during analysis: {str(e)}"}
     finally:
-        if temp_file_to_delete and os.path.exists(temp_file_to_delete):
-            try:
-                os.remove(temp_file_to_delete)
-                print(f"Deleted temporary analysis file: {temp_file_to_delete}")
-            except Exception as del_error:
-                print(f"Error deleting temporary file {temp_file_to_delete}: {del_error}")
+        if spooled_copy is not None:
+            spooled_copy.close()
+
+def describe_and_title_image(image_path=None, image_id=None, image_stream=None):
+    """
+    Run the full upload analysis: vision description followed by title generation.
+    Returns a dictionary with success status, description, generated_title, labels and
+    encoded derivatives, or an error.
+    """
+    structured = UPLOAD_CONFIG.get("analysis_mode", "structured") == "structured"
+    analyze_results = analyze_image(
+        image_path=image_path,
+        image_id=image_id,
+        structured=structured,
+        image_stream=image_stream,
+        derivative_sizes=UPLOAD_CONFIG.get("derivative_sizes")
+    )
+    logger.info("Analysis finished", extra={"event": "analysis.result", "success": analyze_results.get("success"), "error": analyze_results.get("error")})
+
+    if not analyze_results.get("success"):
+        return {"success": False, "error": analyze_results.get('error', 'Unknown analysis error')}
+
+    # Get the vision description from analysis
+    vision_description = analyze_results.get("description", "")
+    logger.debug("Extracted vision description: %.100s", vision_description)
+
+    generated_title = "Untitled Image"
+    if analyze_results.get("generated_title"):
+        generated_title = analyze_results["generated_title"]
+        logger.info(f"Using title from structured analysis: {generated_title}")
+    elif vision_description and not vision_description.startswith("Error:"):
+        title_prompt = f"Generate a short, descriptive title (max 5 words) for an image described as follows:\n\nDescription: {vision_description}\n\nTitle:"
+        try:
+            generated_title_raw = generate_text_with_llm(title_prompt)
+            if generated_title_raw and not generated_title_raw.startswith("Error:"):
+                generated_title = generated_title_raw.strip('"\' ')
+                logger.info(f"Generated title: {generated_title}")
+            else:
+                logger.warning(f"Failed to generate title: {generated_title_raw}")
+        except Exception as title_gen_error:
+             logger.error(f"Error during title generation: {title_gen_error}")
+    else:
+         logger.warning("Skipping title generation due to missing or error in vision description.")
+
+    return {
+        "success": True,
+        "description": vision_description,
+        "generated_title": generated_title,
+        "labels": analyze_results.get("labels", []),
+        "derivatives": analyze_results.get("derivatives", {})
+    }
+
+def serialize_derivatives(image_id, derivatives):
+    """Turn an images document's derivatives into JSON-safe entries with their serving URLs."""
+    return {
+        name: {
+            "url": f"/images/{image_id}/file?size={name}",
+            "width": derivative.get("width"),
+            "height": derivative.get("height"),
+            "size": derivative.get("size")
+        }
+        for name, derivative in (derivatives or {}).items()
+    }
+
+def store_image_derivatives(derivatives, filename, content_hash):
+    """
+    Store encoded derivatives in GridFS.
+    Returns the mapping saved on the images document: name -> file_id, content_hash, size and dimensions.
+    """
+    fs = gridfs.GridFS(mongo.db)
+    stored = {}
+    for name, derivative in (derivatives or {}).items():
+        derivative_hash = hashlib.sha256(derivative["data"]).hexdigest()
+        file_id = fs.put(
+            derivative["data"],
+            filename=f"{name}_{filename}",
+            content_type=derivative["content_type"],
+            metadata={"content_hash": derivative_hash, "derivative_of": content_hash, "size_name": name}
+        )
+        stored[name] = {
+            "file_id": file_id,
+            "content_hash": derivative_hash,
+            "content_type": derivative["content_type"],
+            "width": derivative["width"],
+            "height": derivative["height"],
+            "size": len(derivative["data"])
+        }
+    if stored:
+        logger.info(f"Stored derivatives in GridFS: {', '.join(stored.keys())}")
+    return stored
+
+# Background worker pool for asynchronous upload analysis and conversation summarization, created on first use in each process
+upload_executor = None
+upload_executor_pid = None
+upload_executor_lock = threading.Lock()
+
+def get_upload_executor():
+    """Return this process's upload worker pool, creating it on first use."""
+    global upload_executor, upload_executor_pid
+    with upload_executor_lock:
+        if upload_executor is None or upload_executor_pid != os.getpid():
+            upload_executor_pid = os.getpid()
+            worker_count = UPLOAD_CONFIG.get("worker_count", 4)
+            logger.info(f"Starting upload worker pool with {worker_count} workers")
+            upload_executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="upload-worker")
+        return upload_executor
+
+def enqueue_upload_job(image_id, file_id, user_id, content_hash=None):
+    """
+    Record an upload analysis job and hand it to the worker pool. Returns the job id.
+    The job keeps the upload's request id so its analysis logs can be tied to the upload.
+    If a job for the same bytes is still queued or processing, the image is attached to
+    that job instead and gets its results, so duplicates are analyzed only once.
+    """
+    if content_hash:
+        active_job = mongo.db.uploadJobs.find_one_and_update(
+            {"content_hash": content_hash, "status": {"$in": ["queued", "processing"]}},
+            {"$addToSet": {"image_ids": image_id}},
+            projection={"_id": 1}
+        )
+        if active_job:
+            logger.info(f"Attached image_id: {image_id} to upload analysis job {active_job['_id']}")
+            return active_job["_id"]
+
+    job_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    request_id = request_id_var.get()
+    mongo.db.uploadJobs.insert_one({
+        "_id": job_id,
+        "image_id": image_id,
+        "image_ids": [image_id],
+        "file_id": file_id,
+        "content_hash": content_hash,
+        "user_id": user_id,
+        "request_id": request_id,
+        "status": "queued",
+        "error": None,
+        "created_at": now,
+        "updated_at": now
+    })
+    get_upload_executor().submit(process_upload_job, job_id, image_id, str(file_id), request_id)
+    logger.info(f"Queued upload analysis job {job_id} for image_id: {image_id}")
+    return job_id
+
+def finish_upload_job(job_id, image_ids, image_update, status, error=None):
+    """
+    Write an analysis outcome to a job's images, then close the job. Duplicates can attach
+    to the job until it is closed, so images attached in between are updated as well.
+    """
+    mongo.db.images.update_many({"_id": {"$in": [ObjectId(i) for i in image_ids]}}, image_update)
+    job = mongo.db.uploadJobs.find_one_and_update(
+        {"_id": job_id},
+        {"$set": {"status": status, "error": error, "updated_at": datetime.now(timezone.utc)}},
+        projection={"image_ids": 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    attached_late = [i for i in (job or {}).get("image_ids", []) if i not in image_ids]
+    if attached_late:
+        mongo.db.images.update_many({"_id": {"$in": [ObjectId(i) for i in attached_late]}}, image_update)
+
+def process_upload_job(job_id, image_id, file_id, request_id=None):
+    """Worker entry point: analyze a stored upload and write the results back to the job's images documents."""
+    request_id_var.set(request_id)
+    image_ids = [image_id]
+
+    try:
+        job = mongo.db.uploadJobs.find_one_and_update(
+            {"_id": job_id},
+            {"$set": {"status": "processing", "updated_at": datetime.now(timezone.utc)}},
+            projection={"image_ids": 1},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        # Jobs recorded before duplicates could attach only carry image_id
+        image_ids = (job or {}).get("image_ids") or [image_id]
+        mongo.db.images.update_many({"_id": {"$in": [ObjectId(i) for i in image_ids]}}, {"$set": {"analysis_status": "processing"}})
+
+        analyze_results = describe_and_title_image(image_id=file_id)
+
+        if analyze_results.get("success"):
+            image = mongo.db.images.find_one({"_id": ObjectId(image_id)}, {"filename": 1, "content_hash": 1}) or {}
+            derivatives = store_image_derivatives(
+                analyze_results.get("derivatives"),
+                image.get("filename", "image"),
+                image.get("content_hash")
+            )
+            finish_upload_job(job_id, image_ids, {"$set": {
+                "vision_description": analyze_results["description"],
+                "generated_title": analyze_results["generated_title"],
+                "labels": analyze_results.get("labels", []),
+                "derivatives": derivatives,
+                "analysis_status": "completed"
+            }}, "completed")
+            logger.info(f"Upload analysis job {job_id} completed for image_id: {image_id}")
+        else:
+            analysis_error = analyze_results.get('error', 'Unknown analysis error')
+            finish_upload_job(job_id, image_ids, {"$set": {"analysis_status": "failed", "analysis_error": analysis_error}},
+                              "failed", analysis_error)
+            logger.warning(f"Upload analysis job {job_id} failed: {analysis_error}")
+
+    except Exception as e:
+        logger.exception(f"Error in upload analysis job {job_id}: {str(e)}")
+        try:
+            finish_upload_job(job_id, image_ids, {"$set": {"analysis_status": "failed", "analysis_error": str(e)}},
+                              "failed", str(e))
+        except Exception as status_error:
+            logger.error(f"Error recording failure for job {job_id}: {status_error}")
 
-@app.route('/status', methods=['GET'])
+def recover_upload_jobs():
+    """
+    Requeue upload jobs left queued or processing by a process that restarted or crashed,
+    which would otherwise keep their images pending (and closed to /chat) forever. Each
+    stale job is claimed with one atomic update, so processes recovering at the same time
+    requeue it only once; after job_max_recoveries attempts it is marked failed instead.
+    """
+    now = datetime.now(timezone.utc)
+    stale_before = now - timedelta(seconds=UPLOAD_CONFIG.get("stale_job_seconds", 15 * 60))
+    max_recoveries = UPLOAD_CONFIG.get("job_max_recoveries", 2)
+    while True:
+        job = mongo.db.uploadJobs.find_one_and_update(
+            {"status": {"$in": ["queued", "processing"]}, "updated_at": {"$lt": stale_before}},
+            {"$set": {"status": "queued", "updated_at": now}, "$inc": {"recoveries": 1}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if job is None:
+            return
+        image_ids = job.get("image_ids") or [job["image_id"]]
+        if job["recoveries"] > max_recoveries:
+            error = "Analysis did not finish after being requeued"
+            finish_upload_job(job["_id"], image_ids, {"$set": {"analysis_status": "failed", "analysis_error": error}},
+                              "failed", error)
+            logger.warning(f"Upload analysis job {job['_id']} marked failed: {error}")
+            continue
+        mongo.db.images.update_many({"_id": {"$in": [ObjectId(i) for i in image_ids]}}, {"$set": {"analysis_status": "pending"}})
+        get_upload_executor().submit(process_upload_job, job["_id"], job["image_id"], str(job["file_id"]), job.get("request_id"))
+        logger.info(f"Requeued stale upload analysis job {job['_id']} for image_id: {job['image_id']}")
+
+@api.route('/status/live', methods=['GET'])
+def liveness():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({"status": "alive"}), 200
+
+@api.route('/status/ready', methods=['GET'])
+def readiness():
+    """Readiness probe: the database is reachable, as of the last background health check"""
+    ready = db_connection_status["status"] == "Connected"
+    return jsonify({
+        "ready": ready,
+        "database": db_connection_status
+    }), 200 if ready else 503
+
+@api.route('/status', methods=['GET'])
 def status():
     """Endpoint to check server and database status"""
+    with vision_preprocess_stats_lock:
+        preprocess_totals = dict(vision_preprocess_stats)
+    preprocess_totals["bytes_saved"] = preprocess_totals["original_bytes"] - preprocess_totals["sent_bytes"]
+
     return jsonify({
         "server": "running",
-        "database": db_connection_status
+        "live": True,
+        "ready": db_connection_status["status"] == "Connected",
+        "database": db_connection_status,
+        "vision_preprocessing": preprocess_totals,
+        "llm_gateway": llm_gateway.get_stats(),
+        "view_tracking": view_buffer.get_stats()
     })
 
-@app.route('/register', methods=['POST'])
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: request, MongoDB command and LLM call latencies"""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+def start_metrics_timer():
+    start_request_timer(g)
+
+def record_request_metrics(response):
+    observe_request(g, request.url_rule.rule if request.url_rule else None, request.method, response.status_code)
+    return response
+
+def assign_request_id():
+    """Use the caller's X-Request-ID when it looks sane, otherwise generate one."""
+    request_id = request.headers.get("X-Request-ID", "")
+    if not request_id or len(request_id) > 64 or not request_id.replace("-", "").isalnum():
+        request_id = uuid.uuid4().hex
+    request_id_var.set(request_id)
+
+def return_request_id(response):
+    response.headers["X-Request-ID"] = request_id_var.get() or ""
+    return response
+
+def clear_request_id(exception=None):
+    request_id_var.set(None)
+
+@api.route('/register', methods=['POST'])
 def register_user():
     """Register a new user"""
     try:
@@ -268,19 +1156,22 @@ def register_user():
 
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
         
-        # Save user to database
-        mongo.db.users.insert_one({
-            "_id": user_id,
-            "username": username,
-            "email": email,
-            "password": hashed_password,
-            "created_at": datetime.datetime.utcnow(),
-            "last_login": None,
-            "preferences": {
-                "theme": "light",
-                "notifications_enabled": True
-            }
-        })
+        # Save user to database; the unique email index catches concurrent registrations
+        try:
+            mongo.db.users.insert_one({
+                "_id": user_id,
+                "username": username,
+                "email": email,
+                "password": hashed_password,
+                "created_at": datetime.now(timezone.utc),
+                "last_login": None,
+                "preferences": {
+                    "theme": "light",
+                    "notifications_enabled": True
+                }
+            })
+        except DuplicateKeyError:
+            return jsonify({"error": "User with this email already exists"}), 409
         
         return jsonify({
             "message": "User registered successfully",
@@ -288,11 +1179,10 @@ def register_user():
         }), 201
         
     except Exception as e:
-        print(f"Registration error: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Registration error: {str(e)}")
         return jsonify({"error": "An error occurred during registration", "details": str(e)}), 500
 
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login_user():
     """Login a user"""
     try:
@@ -321,7 +1211,7 @@ def login_user():
         # Update last login time
         mongo.db.users.update_one(
             {"_id": user["_id"]},
-            {"$set": {"last_login": datetime.datetime.utcnow()}}
+            {"$set": {"last_login": datetime.now(timezone.utc)}}
         )
         
         # Return user info
@@ -338,11 +1228,10 @@ def login_user():
         }), 200
         
     except Exception as e:
-        print(f"Login error: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Login error: {str(e)}")
         return jsonify({"error": "An error occurred during login", "details": str(e)}), 500
 
-@app.route('/user/profile', methods=['GET'])
+@api.route('/user/profile', methods=['GET'])
 def get_user_profile():
     """Get user profile information"""
     try:
@@ -374,11 +1263,10 @@ def get_user_profile():
         return jsonify(user_info), 200
         
     except Exception as e:
-        print(f"Error retrieving user profile: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error retrieving user profile: {str(e)}")
         return jsonify({"error": "An error occurred retrieving the user profile", "details": str(e)}), 500
 
-@app.route('/user/preferences', methods=['PUT'])
+@api.route('/user/preferences', methods=['PUT'])
 def update_user_preferences():
     """Update user preferences"""
     try:
@@ -407,11 +1295,122 @@ def update_user_preferences():
         }), 200
         
     except Exception as e:
-        print(f"Error updating user preferences: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error updating user preferences: {str(e)}")
         return jsonify({"error": "An error occurred updating user preferences", "details": str(e)}), 500
 
-@app.route('/upload', methods=['POST'])
+def prepare_upload(upload_stream, filename, content_type, user_id, title, description, async_requested, content_hash=None):
+    """
+    Deduplicate, analyze (unless async_requested) and store one uploaded file's blob and
+    derivatives in GridFS. The images document is built but not inserted, so callers can
+    write one or many at once.
+    content_hash may be passed when the caller already computed it.
+    Returns {"success": True, "image": images document, "deduplicated": bool}, or
+    {"success": False, "error": ..., "details": ...}.
+    """
+    upload_size = get_stream_size(upload_stream)
+
+    # Identical bytes are stored and analyzed only once; repeats reuse the existing blob and results
+    content_hash = content_hash or compute_content_hash(upload_stream)
+    existing_image = find_image_by_content_hash(content_hash)
+    reuse_analysis = existing_image is not None and existing_image.get("analysis_status", "completed") == "completed"
+
+    file_id = existing_image["file_id"] if existing_image else None
+    vision_description = ""
+    generated_title = "Untitled Image"
+    labels = []
+    derivatives = {}
+    analysis_status = "completed"
+
+    if reuse_analysis:
+        logger.info(f"Duplicate upload detected (sha256={content_hash[:12]}...), reusing image {existing_image['_id']}")
+        vision_description = existing_image.get("vision_description", "")
+        generated_title = existing_image.get("generated_title", "Untitled Image")
+        labels = existing_image.get("labels", [])
+        derivatives = existing_image.get("derivatives", {})
+    elif async_requested:
+        # Analysis happens in the worker pool; the request only stores the blob
+        analysis_status = "pending"
+    else:
+        analyze_results = describe_and_title_image(image_stream=upload_stream)
+
+        if not analyze_results.get("success"):
+            analysis_error = analyze_results.get('error', 'Unknown analysis error')
+            logger.warning(f"Image analysis failed: {analysis_error}")
+            return {"success": False, "error": "Image analysis failed", "details": analysis_error}
+
+        vision_description = analyze_results["description"]
+        generated_title = analyze_results["generated_title"]
+        labels = analyze_results.get("labels", [])
+        derivatives = store_image_derivatives(analyze_results.get("derivatives"), filename, content_hash)
+
+    if file_id is None:
+        # Use GridFS to store the file content
+        fs = gridfs.GridFS(mongo.db)
+        upload_stream.seek(0)
+        file_id = fs.put(
+            upload_stream,
+            filename=filename,
+            content_type=content_type,
+            metadata={"content_hash": content_hash}
+        )
+        logger.info(f"Stored file in GridFS with file_id: {file_id}")
+
+    image_metadata = {
+        "_id": ObjectId(), 
+        "file_id": file_id,
+        "user_id": user_id,
+        "filename": filename,
+        "title": title,
+        "description": description,
+        "vision_description": vision_description,
+        "generated_title": generated_title, 
+        "uploadTimestamp": datetime.now(timezone.utc),
+        "size": upload_size,
+        "mime_type": content_type,
+        "content_hash": content_hash,
+        "analysis_status": analysis_status,
+        "labels": labels,
+        "derivatives": derivatives
+    }
+    return {"success": True, "image": image_metadata, "deduplicated": existing_image is not None}
+
+def upload_record(image_metadata):
+    """uploadsImage entry recording who uploaded an image."""
+    return {
+        "_id": str(uuid.uuid4()),
+        "user_id": image_metadata["user_id"],
+        "image_id": str(image_metadata["_id"]), 
+        "timestamp": datetime.now(timezone.utc)
+    }
+
+def format_upload_result(image_metadata, deduplicated, job_id=None):
+    """Per-file part of the /upload and /upload/batch responses."""
+    image_id = str(image_metadata["_id"])
+    if job_id:
+        return {
+            "message": "File uploaded, analysis queued",
+            "storage": "mongodb",
+            "image_id": image_id,
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/jobs/{job_id}",
+            "title": image_metadata["title"],
+            "description": image_metadata["description"]
+        }
+    return {
+        "message": "File uploaded and analyzed successfully",
+        "storage": "mongodb",
+        "image_id": image_id,
+        "deduplicated": deduplicated,
+        "title": image_metadata["title"],
+        "description": image_metadata["description"],
+        "vision_description": image_metadata["vision_description"],
+        "generated_title": image_metadata["generated_title"],
+        "labels": image_metadata["labels"],
+        "thumbnail_url": f"/images/{image_id}/file?size=thumb"
+    }
+
+@api.route('/upload', methods=['POST'])
 def upload_image():
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
@@ -423,145 +1422,231 @@ def upload_image():
     user_id = request.form.get('user_id', 'anonymous')
     title = request.form.get('title', file.filename)
     description_from_user = request.form.get('description', '')
+    async_requested = request.form.get('async', str(UPLOAD_CONFIG.get("async_enabled", False))).lower() in ("1", "true", "yes")
 
-    print(f"Processing upload request: file={file.filename}, user_id={user_id}")
-    temp_path = None
+    logger.info("Processing upload request", extra={"event": "upload.request", "upload_filename": file.filename, "user_id": user_id, "async": async_requested})
     try:
+        # The upload is already buffered by SpooledUploadRequest; analyze and store from that buffer
+        upload = prepare_upload(file.stream, file.filename, file.content_type, user_id, title,
+                                description_from_user, async_requested)
+        if not upload["success"]:
+            return jsonify({"error": upload["error"], "details": upload["details"]}), 500
 
-        temp_filename = f"{uuid.uuid4()}_{file.filename}"
-        temp_path = os.path.join(UPLOAD_FOLDER, temp_filename)
-        file.save(temp_path)
-        print(f"Saved file temporarily to: {temp_path}")
+        # Save metadata to the images collection
+        image_metadata = upload["image"]
+        mongo.db.images.insert_one(image_metadata)
+        image_id = str(image_metadata["_id"])
+        logger.info(f"Created image document with image_id: {image_id}")
 
-        # Analyze the image to get the description from Gemini Vision
-        print(f"Analyzing image using configured API: {temp_path}")
-        analyze_results = analyze_image(image_path=temp_path)
-        print(f"Analysis results: {analyze_results}")
+        # Record upload in the uploadsImage collection to track user uploads
+        mongo.db.uploadsImage.insert_one(upload_record(image_metadata))
+        logger.info(f"Recorded upload in uploadsImage collection for user_id: {user_id}")
+        record_user_activity({user_id: (1, image_metadata["uploadTimestamp"])}, "upload_count", "last_upload")
 
-        if not analyze_results.get("success"):
-            analysis_error = analyze_results.get('error', 'Unknown analysis error')
-            print(f"Image analysis failed: {analysis_error}")
-            if temp_path and os.path.exists(temp_path):
-                os.remove(temp_path)
-            return jsonify({
-                "error": "Image analysis failed",
-                "details": analysis_error
-            }), 500
-
-        # Get the vision description from analysis
-        vision_description = analyze_results.get("description", "")
-        print(f"Extracted vision description: {vision_description[:100]}...")
-
- 
-        generated_title = "Untitled Image"
-        if vision_description and not vision_description.startswith("Error:"):
-            title_prompt = f"Generate a short, descriptive title (max 5 words) for an image described as follows:\n\nDescription: {vision_description}\n\nTitle:"
-            try:
-                generated_title_raw = generate_text_with_llm(title_prompt)
-                if generated_title_raw and not generated_title_raw.startswith("Error:"):
-                    generated_title = generated_title_raw.strip('"\' ')
-                    print(f"Generated title: {generated_title}")
-                else:
-                    print(f"Failed to generate title: {generated_title_raw}")
-            except Exception as title_gen_error:
-                 print(f"Error during title generation: {title_gen_error}")
-        else:
-             print("Skipping title generation due to missing or error in vision description.")
+        if image_metadata["analysis_status"] == "pending":
+            job_id = enqueue_upload_job(image_id, image_metadata["file_id"], user_id, image_metadata["content_hash"])
+            return jsonify(format_upload_result(image_metadata, upload["deduplicated"], job_id)), 202
 
+        return jsonify(format_upload_result(image_metadata, upload["deduplicated"])), 201 
 
-        # Reset file pointer before storing in GridFS
-        file.seek(0)
+    except Exception as e:
+        # Log the error
+        logger.exception(f"Upload error: {str(e)}")
+        return jsonify({
+            "error": "Could not upload file",
+            "details": str(e)
+        }), 500
 
-        # Use GridFS to store the file content
-        fs = gridfs.GridFS(mongo.db)
-        with open(temp_path, 'rb') as temp_file_content:
-             file_id = fs.put(
-                 temp_file_content,
-                 filename=file.filename,
-                 content_type=file.content_type
-             )
-        print(f"Stored file in GridFS with file_id: {file_id}")
+@api.route('/upload/batch', methods=['POST'])
+def upload_images_batch():
+    """
+    Upload several files at once (multipart field `files`, repeated). Files are analyzed
+    concurrently by up to UPLOAD_CONFIG["batch_worker_count"] threads and their metadata is
+    written with one insert_many per collection. The response lists a result per file in
+    request order; failed files carry an error and do not affect the others.
+    Returns 201 when every file succeeded (202 if any analysis was queued), 207 when some
+    failed and 500 when all failed.
+    """
+    files = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if not files:
+        return jsonify({"error": "No files provided"}), 400
 
-        # Save metadata to the images collection
-        image_metadata = {
-            "_id": ObjectId(), 
-            "file_id": file_id,
-            "filename": file.filename,
-            "title": title,
-            "description": description_from_user,
-            "vision_description": vision_description,
-            "generated_title": generated_title, 
-            "uploadTimestamp": datetime.now(timezone.utc),
-            "size": os.path.getsize(temp_path),
-            "mime_type": file.content_type,
-            "labels": []
-        }
+    max_files = UPLOAD_CONFIG.get("batch_max_files", 50)
+    if len(files) > max_files:
+        return jsonify({"error": f"At most {max_files} files can be uploaded in one batch"}), 400
 
-        result = mongo.db.images.insert_one(image_metadata)
-        image_id = str(image_metadata["_id"])
-        print(f"Created image document with image_id: {image_id}")
+    user_id = request.form.get('user_id', 'anonymous')
+    async_requested = request.form.get('async', str(UPLOAD_CONFIG.get("async_enabled", False))).lower() in ("1", "true", "yes")
+    logger.info("Processing batch upload request", extra={"event": "upload.batch_request", "files": len(files), "user_id": user_id, "async": async_requested})
 
-        # Record upload in the uploadsImage collection to track user uploads
-        mongo.db.uploadsImage.insert_one({
-            "_id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "image_id": image_id, 
-            "timestamp": datetime.now(timezone.utc)
-        })
-        print(f"Recorded upload in uploadsImage collection for user_id: {user_id}")
+    try:
+        results = [None] * len(files)
+        uploads = [None] * len(files)
+        worker_count = min(UPLOAD_CONFIG.get("batch_worker_count", 4), len(files))
+        # Identical files in the batch are analyzed and stored once, by the first of them
+        content_hashes = [compute_content_hash(f.stream) for f in files]
+        first_with_hash = {}
+        for index, content_hash in enumerate(content_hashes):
+            first_with_hash.setdefault(content_hash, index)
+
+        with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="batch-upload") as pool:
+            # Each task runs in a copy of the request's context so its logs carry the request id
+            futures = {
+                index: pool.submit(contextvars.copy_context().run, prepare_upload, files[index].stream, files[index].filename,
+                                   files[index].content_type, user_id, files[index].filename, '', async_requested,
+                                   content_hashes[index])
+                for index in first_with_hash.values()
+            }
+            for index, future in futures.items():
+                try:
+                    uploads[index] = future.result()
+                except Exception as e:
+                    logger.exception(f"Batch upload error for {files[index].filename}: {str(e)}")
+                    uploads[index] = {"success": False, "error": "Could not upload file", "details": str(e)}
+
+        for index, content_hash in enumerate(content_hashes):
+            first = uploads[first_with_hash[content_hash]]
+            if uploads[index] is not None:
+                continue
+            if not first["success"]:
+                uploads[index] = first
+                continue
+            uploads[index] = {
+                "success": True,
+                "deduplicated": True,
+                "image": {**first["image"], "_id": ObjectId(), "filename": files[index].filename,
+                          "title": files[index].filename, "uploadTimestamp": datetime.now(timezone.utc)}
+            }
 
-        return jsonify({
-            "message": "File uploaded and analyzed successfully",
-            "storage": "mongodb",
-            "image_id": image_id,
-            "title": title,
-            "description": description_from_user,
-            "vision_description": vision_description,
-            "generated_title": generated_title,
-            "labels": image_metadata["labels"]
-        }), 201 
+        stored = []
+        for index, upload in enumerate(uploads):
+            if upload["success"]:
+                stored.append(index)
+            else:
+                results[index] = {"filename": files[index].filename, "error": upload["error"], "details": upload["details"]}
+
+        if stored:
+            images = [uploads[index]["image"] for index in stored]
+            failed_positions = set()
+            try:
+                mongo.db.images.insert_many(images, ordered=False)
+            except BulkWriteError as e:
+                failed_positions = {write_error["index"] for write_error in e.details.get("writeErrors", [])}
+                logger.error(f"Batch upload: {len(failed_positions)} image document(s) could not be written")
+
+            inserted = [index for position, index in enumerate(stored) if position not in failed_positions]
+            for position, index in enumerate(stored):
+                if position in failed_positions:
+                    results[index] = {"filename": files[index].filename, "error": "Could not save image metadata", "details": None}
+                    # Its blobs were written before the insert failed; keep any another image still uses
+                    delete_unshared_blobs(uploads[index]["image"])
+
+            if inserted:
+                mongo.db.uploadsImage.insert_many([upload_record(uploads[index]["image"]) for index in inserted], ordered=False)
+                record_user_activity({user_id: (len(inserted), datetime.now(timezone.utc))}, "upload_count", "last_upload")
+
+            for index in inserted:
+                image_metadata = uploads[index]["image"]
+                job_id = None
+                if image_metadata["analysis_status"] == "pending":
+                    job_id = enqueue_upload_job(str(image_metadata["_id"]), image_metadata["file_id"], user_id,
+                                                image_metadata["content_hash"])
+                results[index] = {"filename": files[index].filename,
+                                  **format_upload_result(image_metadata, uploads[index]["deduplicated"], job_id)}
+
+        uploaded = sum(1 for result in results if "error" not in result)
+        failed = len(results) - uploaded
+        logger.info(f"Batch upload finished: {uploaded} uploaded, {failed} failed")
+        queued = any(result.get("status") == "queued" for result in results)
+        status_code = (202 if queued else 201) if failed == 0 else 207 if uploaded else 500
+        return jsonify({"results": results, "uploaded": uploaded, "failed": failed}), status_code
 
     except Exception as e:
-        # Log the error
-        print(f"Upload error: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Batch upload error: {str(e)}")
         return jsonify({
-            "error": "Could not upload file",
+            "error": "Could not upload files",
             "details": str(e)
         }), 500
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-                print(f"Deleted temporary upload file: {temp_path}")
-            except Exception as del_error:
-                print(f"Error deleting temporary upload file {temp_path}: {del_error}")
 
-@app.route('/images', methods=['GET'])
+@api.route('/jobs/<job_id>', methods=['GET'])
+def get_upload_job(job_id):
+    """Get the status of a background upload analysis job"""
+    try:
+        job = mongo.db.uploadJobs.find_one({"_id": job_id})
+
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+
+        response = {
+            "job_id": job["_id"],
+            "image_id": job.get("image_id"),
+            "status": job.get("status"),
+            "error": job.get("error"),
+            "created_at": job["created_at"].isoformat() if job.get("created_at") else None,
+            "updated_at": job["updated_at"].isoformat() if job.get("updated_at") else None
+        }
+
+        if job.get("status") == "completed":
+            image = mongo.db.images.find_one(
+                {"_id": ObjectId(job["image_id"])},
+                {"vision_description": 1, "generated_title": 1, "labels": 1}
+            )
+            if image:
+                response["vision_description"] = image.get("vision_description", "")
+                response["generated_title"] = image.get("generated_title", "Untitled Image")
+                response["labels"] = image.get("labels", [])
+
+        return jsonify(response), 200
+
+    except Exception as e:
+        logger.exception(f"Error getting upload job: {str(e)}")
+        return jsonify({"error": "Failed to get job status", "details": str(e)}), 500
+
+@api.route('/images', methods=['GET'])
 def get_images():
-    """Get list of uploaded images"""
+    """
+    Get list of uploaded images, newest first.
+    Pages with an opaque `cursor` (returned as next_cursor) so every page costs the same;
+    `include_total=true` adds a total_count that is estimated or cached rather than exact.
+    """
     try:
         user_id = request.args.get('user_id')
-        limit = int(request.args.get('limit', 10))
+        # At least 1: Mongo treats limit(0) as no limit
+        limit = max(1, min(int(request.args.get('limit', PAGINATION_CONFIG.get("default_limit", 10))), PAGINATION_CONFIG.get("max_limit", 100)))
         skip = int(request.args.get('skip', 0))
+        cursor = request.args.get('cursor')
+        include_total = request.args.get('include_total', 'false').lower() in ("1", "true", "yes")
         
         query = {}
         
         if user_id:
-            # Get image IDs associated with the user from uploadsImage collection
-            user_images = list(mongo.db.uploadsImage.find({"user_id": user_id}))
-            image_ids = [ObjectId(img["image_id"]) for img in user_images]
-            if image_ids:
-                query["_id"] = {"$in": image_ids}
-            else:
-                return jsonify({"images": [], "total_count": 0}), 200
-        
-        total_count = mongo.db.images.count_documents(query)
+            # Owner is denormalized onto images (see backfill_image_owners for older documents)
+            query["user_id"] = user_id
+
+        page_query = dict(query)
+        if cursor:
+            try:
+                cursor_timestamp, cursor_id = decode_cursor(cursor)
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+            page_query["$or"] = [
+                {"uploadTimestamp": {"$lt": cursor_timestamp}},
+                {"uploadTimestamp": cursor_timestamp, "_id": {"$lt": cursor_id}}
+            ]
             
-        images = list(mongo.db.images.find(
-            query,
+        images_cursor = mongo.db.images.find(
+            page_query,
             {"_id": 1, "filename": 1, "title": 1, "description": 1, "uploadTimestamp": 1, "labels": 1, "generated_title": 1} 
-        ).sort("uploadTimestamp", -1).skip(skip).limit(limit))
+        ).sort([("uploadTimestamp", -1), ("_id", -1)])
+        if skip and not cursor:
+            # Offset paging is kept for older clients; it gets slower the deeper the page
+            images_cursor = images_cursor.skip(skip)
+        # Fetch one extra document to learn whether another page exists
+        images = list(images_cursor.limit(limit + 1))
+
+        has_more = len(images) > limit
+        images = images[:limit]
+        next_cursor = encode_cursor(images[-1]["uploadTimestamp"], images[-1]["_id"]) if has_more and images else None
         
         # Convert ObjectId to string for JSON serialization
         for img in images:
@@ -571,20 +1656,138 @@ def get_images():
             if "uploadTimestamp" in img:
                 img["uploadTimestamp"] = img["uploadTimestamp"].isoformat()
             img["generated_title"] = img.get("generated_title", img.get("title", img.get("filename", "Untitled")))    
+            img["thumbnail_url"] = f"/images/{img['_id']}/file?size=thumb"
 
-        return jsonify({
+        response = {
             "images": images, 
-            "total_count": total_count,
-            "page": skip // limit + 1 if limit > 0 else 1,
-            "pages": (total_count + limit - 1) // limit if limit > 0 else 1
-        }), 200
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+            "limit": limit
+        }
+
+        if include_total:
+            total_count = count_images(query)
+            response["total_count"] = total_count
+            response["total_count_approximate"] = True
+            response["page"] = skip // limit + 1 if limit > 0 and not cursor else None
+            response["pages"] = (total_count + limit - 1) // limit if limit > 0 else 1
+
+        return jsonify(response), 200
         
+    except ValueError:
+        return jsonify({"error": "limit and skip must be integers"}), 400
     except Exception as e:
-        print(f"Error retrieving images: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error retrieving images: {str(e)}")
         return jsonify({"error": "An error occurred retrieving images", "details": str(e)}), 500
 
-@app.route('/images/<image_id>', methods=['GET'])
+def view_stat_buckets(timestamp):
+    """(granularity, bucket start) pairs a view at timestamp is counted in; "total" has no bucket."""
+    hour = timestamp.replace(minute=0, second=0, microsecond=0)
+    return [("hour", hour), ("day", hour.replace(hour=0)), ("total", None)]
+
+def rollup_image_views(views, sign=1):
+    """
+    Add views to (or with sign=-1, remove them from) the imageViewStats rollups: one document
+    per image per hour, per day and in total, holding the view count, last view time and the
+    image's title, filename and owner. Views of images that no longer exist are skipped.
+    """
+    rollups = {}
+    for view in views:
+        for granularity, bucket in view_stat_buckets(view["timestamp"]):
+            stat_id = f"{view['image_id']}:{granularity}" + (f":{bucket:%Y%m%d%H}" if bucket else "")
+            rollup = rollups.setdefault(stat_id, {
+                "image_id": view["image_id"], "granularity": granularity, "bucket": bucket,
+                "views": 0, "last_viewed": view["timestamp"]
+            })
+            rollup["views"] += 1
+            rollup["last_viewed"] = max(rollup["last_viewed"], view["timestamp"])
+
+    image_ids = list(set(view["image_id"] for view in views if ObjectId.is_valid(view["image_id"])))
+    images = {
+        str(image["_id"]): image
+        for image in mongo.db.images.find(
+            {"_id": {"$in": [ObjectId(img_id) for img_id in image_ids]}},
+            {"title": 1, "filename": 1, "user_id": 1}
+        )
+    }
+
+    retention = timedelta(days=VIEW_TRACKING_CONFIG.get("hourly_retention_days", 3))
+    expired_before = datetime.now(timezone.utc) - retention
+    operations = []
+    for stat_id, rollup in rollups.items():
+        image = images.get(rollup["image_id"])
+        if image is None:
+            continue
+        if sign < 0:
+            operations.append(pymongo.UpdateOne({"_id": stat_id}, {"$inc": {"views": -rollup["views"]}}))
+            continue
+        if rollup["granularity"] == "hour" and rollup["bucket"] < expired_before.replace(tzinfo=rollup["bucket"].tzinfo):
+            continue
+        fields = {
+            "title": image.get("title", image.get("filename", "Unknown")),
+            "filename": image.get("filename", "Unknown"),
+            "owner_id": image.get("user_id")
+        }
+        if rollup["granularity"] == "hour":
+            fields["expires_at"] = rollup["bucket"] + retention
+        operations.append(pymongo.UpdateOne(
+            {"_id": stat_id},
+            {
+                "$inc": {"views": rollup["views"]},
+                "$max": {"last_viewed": rollup["last_viewed"]},
+                "$set": fields,
+                "$setOnInsert": {"image_id": rollup["image_id"], "granularity": rollup["granularity"], "bucket": rollup["bucket"]}
+            },
+            upsert=True
+        ))
+
+    if operations:
+        mongo.db.imageViewStats.bulk_write(operations, ordered=False)
+
+def backfill_image_view_stats(batch_size=1000):
+    """
+    Rebuild imageViewStats from imageViews. Views recorded while this runs may be counted
+    twice, so run it before serving traffic. Returns the number of views rolled up.
+    """
+    mongo.db.imageViewStats.delete_many({})
+    total = 0
+    batch = []
+    for view in mongo.db.imageViews.find({}, {"image_id": 1, "timestamp": 1}).batch_size(batch_size):
+        if not view.get("image_id") or not view.get("timestamp"):
+            continue
+        batch.append(view)
+        if len(batch) >= batch_size:
+            rollup_image_views(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        rollup_image_views(batch)
+        total += len(batch)
+    return total
+
+def flush_image_views(views):
+    """Write a batch of buffered image views and add them to the imageViewStats rollups."""
+    try:
+        mongo.db.imageViews.insert_many(views, ordered=False)
+    except Exception as e:
+        logger.error(f"Error recording {len(views)} image view(s): {str(e)}")
+        raise
+    try:
+        rollup_image_views(views)
+    except Exception as e:
+        # The views themselves are saved; backfill-image-view-stats rebuilds the rollups
+        logger.error(f"Error updating view stats for {len(views)} image view(s): {str(e)}")
+
+    viewers = {}
+    for view in views:
+        count, last_active = viewers.get(view["user_id"], (0, view["timestamp"]))
+        viewers[view["user_id"]] = (count + 1, max(last_active, view["timestamp"]))
+    record_user_activity(viewers, "view_count", "last_active")
+
+# Views are recorded off the request path, written in batches by a background thread
+view_buffer = WriteBehindBuffer("image-views", flush_image_views, VIEW_TRACKING_CONFIG, observer=WriteBehindMetrics())
+
+@api.route('/images/<image_id>', methods=['GET'])
 def get_image(image_id):
     try:
         if not ObjectId.is_valid(image_id):
@@ -606,30 +1809,96 @@ def get_image(image_id):
                         image[key][nested_key] = str(nested_value)
             
         if 'filename' in image:
-            image['url'] = f"/uploads/{image['filename']}"
+            image['url'] = f"/images/{image_id}/file"
+        image['derivatives'] = serialize_derivatives(image_id, image.get('derivatives'))
             
         image["generated_title"] = image.get("generated_title", image.get("title", image.get("filename", "Untitled")))    
 
         if user_id:
-            try:
-                mongo.db.imageViews.insert_one({
-                    'user_id': user_id,
-                    'image_id': image_id,
-                    'timestamp': datetime.datetime.now(timezone.utc),
-                    'referrer': request.referrer or 'direct',
-                    'user_agent': request.user_agent.string
-                })
-            except Exception as e:
-                print(f"Error recording image view: {str(e)}")
+            # Dropped without blocking if the buffer is full; counted in /status and /metrics
+            view_buffer.add({
+                'user_id': user_id,
+                'image_id': image_id,
+                'timestamp': datetime.now(timezone.utc),
+                'referrer': request.referrer or 'direct',
+                'user_agent': request.user_agent.string
+            })
 
         return jsonify(image), 200
         
     except Exception as e:
-        print(f"Error getting image: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error getting image: {str(e)}")
         return jsonify({'error': 'Failed to get image'}), 500
 
-@app.route('/image/<image_id>', methods=['PUT'])
+@api.route('/images/<image_id>/file', methods=['GET'])
+def get_image_file(image_id):
+    """
+    Stream image bytes from GridFS with Range, ETag and conditional GET support.
+    ?size=<name> serves a stored derivative (e.g. thumb, medium), falling back to the original.
+    """
+    try:
+        if not ObjectId.is_valid(image_id):
+            return jsonify({'error': 'Invalid image ID format'}), 400
+
+        size_name = request.args.get('size')
+        if size_name and size_name != "original" and size_name not in UPLOAD_CONFIG.get("derivative_sizes", {}):
+            return jsonify({'error': f"Unknown size '{size_name}'"}), 400
+
+        image = mongo.db.images.find_one(
+            {"_id": ObjectId(image_id)},
+            {"file_id": 1, "content_hash": 1, "mime_type": 1, "derivatives": 1}
+        )
+
+        if image is None or not image.get("file_id"):
+            return jsonify({'error': 'Image not found'}), 404
+
+        # Images smaller than a derivative size (or uploaded before derivatives existed) serve the original
+        derivative = (image.get("derivatives") or {}).get(size_name) if size_name else None
+        if derivative:
+            image = {
+                "file_id": derivative["file_id"],
+                "content_hash": derivative.get("content_hash"),
+                "mime_type": derivative.get("content_type")
+            }
+
+        max_age = UPLOAD_CONFIG.get("image_cache_max_age", 365 * 24 * 60 * 60)
+        cache_control = f"public, max-age={max_age}, immutable"
+
+        # Revalidation for hashed uploads is answered from the images document alone
+        content_hash = image.get("content_hash")
+        if content_hash and request.if_none_match.contains_weak(content_hash):
+            not_modified = Response(status=304)
+            not_modified.set_etag(content_hash)
+            not_modified.headers["Cache-Control"] = cache_control
+            return not_modified
+
+        fs = gridfs.GridFS(mongo.db)
+        try:
+            grid_out = fs.get(ObjectId(image["file_id"]))
+        except gridfs.errors.NoFile:
+            return jsonify({'error': 'Image file not found in storage'}), 404
+
+        # Chunks are read from GridFS as the response is consumed, never buffered whole
+        response = Response(
+            wrap_file(request.environ, grid_out, buffer_size=grid_out.chunk_size),
+            mimetype=image.get("mime_type") or grid_out.content_type or "application/octet-stream",
+            direct_passthrough=True
+        )
+        response.content_length = grid_out.length
+        response.last_modified = grid_out.upload_date
+        response.set_etag(content_hash or grid_out.md5 or str(grid_out._id))
+        response.headers["Cache-Control"] = cache_control
+
+        # Handles If-None-Match / If-Modified-Since (304) and Range / If-Range (206)
+        return response.make_conditional(request, accept_ranges=True, complete_length=grid_out.length)
+
+    except HTTPException as http_error:
+        return http_error
+    except Exception as e:
+        logger.exception(f"Error streaming image file: {str(e)}")
+        return jsonify({'error': 'Failed to get image file'}), 500
+
+@api.route('/image/<image_id>', methods=['PUT'])
 def update_image(image_id):
     """Update image metadata"""
     try:
@@ -657,6 +1926,20 @@ def update_image(image_id):
         
         if result.matched_count == 0:
             return jsonify({"error": "Image not found"}), 404
+
+        invalidate_answer_cache(image_id)
+
+        if "title" in update_fields:
+            image = mongo.db.images.find_one({"_id": ObjectId(image_id)}, {"title": 1, "filename": 1, "generated_title": 1})
+            if image:
+                mongo.db.conversationSummaries.update_many(
+                    {"image_id": image_id},
+                    {"$set": {"title": get_display_title(image)}}
+                )
+                mongo.db.imageViewStats.update_many(
+                    {"image_id": image_id},
+                    {"$set": {"title": image.get("title", image.get("filename", "Unknown"))}}
+                )
             
         return jsonify({
             "message": "Image updated successfully",
@@ -664,11 +1947,68 @@ def update_image(image_id):
         }), 200
         
     except Exception as e:
-        print(f"Error updating image: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error updating image: {str(e)}")
         return jsonify({"error": "An error occurred updating the image", "details": str(e)}), 500
 
-@app.route('/image/<image_id>', methods=['DELETE'])
+def delete_unshared_blobs(image):
+    """
+    Delete an image's original and derivative GridFS blobs that no other images document
+    references. Identical uploads share the original, and share derivatives when the
+    analysis was reused, but a re-analyzed duplicate has derivatives of its own.
+    """
+    fs = gridfs.GridFS(mongo.db)
+    file_id = image.get("file_id")
+    if file_id:
+        other_references = mongo.db.images.count_documents(
+            {"file_id": file_id, "_id": {"$ne": image["_id"]}},
+            limit=1
+        )
+        if other_references == 0 and fs.exists(ObjectId(file_id)):
+            fs.delete(ObjectId(file_id))
+    for name, derivative in (image.get("derivatives") or {}).items():
+        other_references = mongo.db.images.count_documents(
+            {f"derivatives.{name}.file_id": derivative["file_id"], "_id": {"$ne": image["_id"]}},
+            limit=1
+        )
+        if other_references == 0 and fs.exists(derivative["file_id"]):
+            fs.delete(derivative["file_id"])
+
+def delete_image_data(image):
+    """
+    Delete an images document with its GridFS blobs (when no other image shares them),
+    views, chats, summaries and cached answers. Used by DELETE /image/<id> and /user/delete.
+    """
+    image_id = str(image["_id"])
+        
+    delete_unshared_blobs(image)
+    
+    # Delete all related data from different collections
+    # 1. Delete from images collection
+    mongo.db.images.delete_one({"_id": image["_id"]})
+    
+    # 2. Delete from uploadsImage collection
+    mongo.db.uploadsImage.delete_many({"image_id": image_id})
+    
+    # 3. Delete from imageViews collection and its rollups
+    mongo.db.imageViews.delete_many({"image_id": image_id})
+    mongo.db.imageViewStats.delete_many({"image_id": image_id})
+    
+    # 4. Find chat history related to this image
+    chat_records = list(mongo.db.chatHistory.find({"image_id": image_id}, {"_id": 1}))
+    chat_ids = [chat["_id"] for chat in chat_records]
+    
+    # 5. Delete from chatHistory collection
+    mongo.db.chatHistory.delete_many({"image_id": image_id})
+    
+    # 6. Delete from user_chat collection for the found chat_ids
+    if chat_ids:
+        mongo.db.user_chat.delete_many({"chat_history_id": {"$in": chat_ids}})
+
+    # 7. Delete conversation summaries and cached answers for this image
+    mongo.db.conversationSummaries.delete_many({"image_id": image_id})
+    invalidate_answer_cache(image_id)
+
+@api.route('/image/<image_id>', methods=['DELETE'])
 def delete_image(image_id):
     """Delete an image and all related data"""
     try:
@@ -676,164 +2016,530 @@ def delete_image(image_id):
         
         if not image:
             return jsonify({"error": "Image not found"}), 404
-            
-        file_id = image.get("file_id")
-        
-        if file_id:
-            fs = gridfs.GridFS(mongo.db)
-            if fs.exists(ObjectId(file_id)):
-                fs.delete(ObjectId(file_id))
-        
-        # Delete all related data from different collections
-        # 1. Delete from images collection
-        mongo.db.images.delete_one({"_id": ObjectId(image_id)})
-        
-        # 2. Delete from uploadsImage collection
-        mongo.db.uploadsImage.delete_many({"image_id": image_id})
-        
-        # 3. Delete from imageViews collection
-        mongo.db.imageViews.delete_many({"image_id": image_id})
-        
-        # 4. Find chat history related to this image
-        chat_records = list(mongo.db.chatHistory.find({"image_id": image_id}))
-        chat_ids = [chat["_id"] for chat in chat_records]
-        
-        # 5. Delete from chatHistory collection
-        mongo.db.chatHistory.delete_many({"image_id": image_id})
-        
-        # 6. Delete from user_chat collection for the found chat_ids
-        if chat_ids:
-            mongo.db.user_chat.delete_many({"chat_history_id": {"$in": chat_ids}})
+
+        delete_image_data(image)
         
         return jsonify({
             "message": "Image and all related data deleted successfully"
         }), 200
         
     except Exception as e:
-        print(f"Error deleting image: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error deleting image: {str(e)}")
         return jsonify({"error": "An error occurred deleting the image", "details": str(e)}), 500
         
-@app.route('/analytics/images', methods=['GET'])
+def parse_time_window(value):
+    """Parse a window such as "24h" or "7d" into a timedelta; None or "all" means no window. Raises ValueError."""
+    if not value or value == "all":
+        return None
+    amount, unit = value[:-1], value[-1:]
+    if not amount.isdigit() or int(amount) <= 0 or unit not in ("h", "d"):
+        raise ValueError(f"Invalid window '{value}', expected e.g. 24h, 7d or all")
+    return timedelta(hours=int(amount)) if unit == "h" else timedelta(days=int(amount))
+
+@api.route('/analytics/images', methods=['GET'])
 def get_image_analytics():
-    """Get analytics data about image views"""
+    """
+    Get analytics data about image views, from the imageViewStats rollups.
+    ?window=24h / 7d / all (default) limits the counts to recent views, rounded out to
+    whole hours (windows up to hourly_max_window_hours) or whole days.
+    ?user_id limits the results to that user's images.
+    """
     try:
         user_id = request.args.get('user_id')
-        
+        try:
+            window = parse_time_window(request.args.get('window'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        match = {"granularity": "total"}
+        since = None
+        if window is not None:
+            now = datetime.now(timezone.utc)
+            if window <= timedelta(hours=VIEW_TRACKING_CONFIG.get("hourly_max_window_hours", 48)):
+                granularity, since = view_stat_buckets(now - window)[0]
+            else:
+                granularity, since = view_stat_buckets(now - window)[1]
+            match = {"granularity": granularity, "bucket": {"$gte": since}}
+        if user_id:
+            match["owner_id"] = user_id
+
         pipeline = [
+            {"$match": match},
+            {"$sort": {"bucket": 1}},
             {"$group": {
                 "_id": "$image_id",
-                "view_count": {"$sum": 1},
-                "last_viewed": {"$max": "$timestamp"}
+                "view_count": {"$sum": "$views"},
+                "last_viewed": {"$max": "$last_viewed"},
+                "title": {"$last": "$title"},
+                "filename": {"$last": "$filename"}
             }},
+            {"$match": {"view_count": {"$gt": 0}}},
             {"$sort": {"view_count": -1}}
         ]
-        
-        if user_id:
-            user_images = list(mongo.db.uploadsImage.find({"user_id": user_id}))
-            image_ids = [img["image_id"] for img in user_images]
-            
-            if image_ids:
-                pipeline.insert(0, {"$match": {"image_id": {"$in": image_ids}}})
-        
-        view_stats = list(mongo.db.imageViews.aggregate(pipeline))
+        view_stats = list(mongo.db.imageViewStats.aggregate(pipeline))
         
         for stat in view_stats:
-            try:
-                image = mongo.db.images.find_one({"_id": ObjectId(stat["_id"])})
-                if image:
-                    stat["title"] = image.get("title", image.get("filename", "Unknown"))
-                    stat["filename"] = image.get("filename", "Unknown")
-                else:
-                    stat["title"] = "Image not found"
-                    stat["filename"] = "Unknown"
-            except:
-                stat["title"] = "Error retrieving image"
-                stat["filename"] = "Unknown"
-                
-            if "last_viewed" in stat:
+            if stat.get("last_viewed"):
                 stat["last_viewed"] = stat["last_viewed"].isoformat()
         
         return jsonify({
-            "image_view_stats": view_stats
+            "image_view_stats": view_stats,
+            "window": request.args.get('window', 'all'),
+            "since": since.isoformat() if since else None
         }), 200
         
     except Exception as e:
-        print(f"Error retrieving image analytics: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error retrieving image analytics: {str(e)}")
         return jsonify({"error": "An error occurred retrieving image analytics", "details": str(e)}), 500
 
-@app.route('/analytics/user-activity', methods=['GET'])
-def get_user_activity():
-    """Get analytics data about user activity"""
+def record_user_activity(activity, count_field, time_field):
+    """
+    Add to users' userActivity counters with one bulk write. activity maps user_id to
+    (count, latest time); count_field is incremented and time_field kept at the latest time.
+    Errors are logged, not raised, so a failed counter update never fails the request.
+    """
+    operations = [
+        pymongo.UpdateOne(
+            {"_id": activity_user_id},
+            {"$inc": {count_field: count}, "$max": {time_field: latest}},
+            upsert=True
+        )
+        for activity_user_id, (count, latest) in activity.items()
+    ]
+    if not operations:
+        return
     try:
-        view_pipeline = [
-            {"$group": {
-                "_id": "$user_id",
-                "view_count": {"$sum": 1},
-                "last_active": {"$max": "$timestamp"}
-            }},
-            {"$sort": {"view_count": -1}},
-            {"$limit": 10}
-        ]
-        
-        view_stats = list(mongo.db.imageViews.aggregate(view_pipeline))
-        
-        upload_pipeline = [
-            {"$group": {
-                "_id": "$user_id",
-                "upload_count": {"$sum": 1},
-                "last_upload": {"$max": "$timestamp"}
-            }},
-            {"$sort": {"upload_count": -1}},
-            {"$limit": 10}
+        mongo.db.userActivity.bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.error(f"Error updating {count_field} for {len(operations)} user(s): {str(e)}")
+
+def backfill_user_activity():
+    """
+    Rebuild userActivity from imageViews, uploadsImage and chatHistory, for activity
+    recorded before the counters were maintained. Returns the number of users written.
+    """
+    sources = [
+        (mongo.db.imageViews, {}, "view_count", "last_active"),
+        (mongo.db.uploadsImage, {}, "upload_count", "last_upload"),
+        (mongo.db.chatHistory, {"role": "user"}, "chat_count", "last_chat"),
+    ]
+    activity = {}
+    for collection, match, count_field, time_field in sources:
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": "$user_id", "count": {"$sum": 1}, "latest": {"$max": "$timestamp"}}}
         ]
-        
-        upload_stats = list(mongo.db.uploadsImage.aggregate(upload_pipeline))
-        
-        chat_pipeline = [
-            {"$group": {
-                "_id": "$user_id",
-                "chat_count": {"$sum": 1}
-            }},
-            {"$sort": {"chat_count": -1}},
-            {"$limit": 10}
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            if group["_id"] is None:
+                continue
+            fields = activity.setdefault(group["_id"], {})
+            fields[count_field] = group["count"]
+            fields[time_field] = group["latest"]
+
+    operations = [pymongo.ReplaceOne({"_id": activity_user_id}, fields, upsert=True)
+                  for activity_user_id, fields in activity.items()]
+    mongo.db.userActivity.delete_many({"_id": {"$nin": list(activity)}})
+    if operations:
+        mongo.db.userActivity.bulk_write(operations, ordered=False)
+    invalidate_activity_leaderboards()
+    return len(operations)
+
+# Leaderboards served by /analytics/user-activity, rebuilt from userActivity when older than the refresh interval
+activity_leaderboards = {"boards": None, "refreshed_at": 0.0}
+activity_leaderboards_lock = threading.Lock()
+activity_refresh_lock = threading.Lock()
+
+# Response key, counter field and last-activity field of each leaderboard
+ACTIVITY_LEADERBOARDS = [
+    ("most_active_viewers", "view_count", "last_active"),
+    ("most_active_uploaders", "upload_count", "last_upload"),
+    ("most_active_chatters", "chat_count", "last_chat"),
+]
+
+def build_activity_leaderboards():
+    """Read the top users for each counter from userActivity and resolve their names with one users query."""
+    limit = ACTIVITY_CONFIG.get("leaderboard_size", 10)
+    boards = {}
+    for board_name, count_field, time_field in ACTIVITY_LEADERBOARDS:
+        boards[board_name] = [
+            {"_id": activity["_id"], count_field: activity[count_field],
+             **({time_field: activity[time_field].isoformat()} if activity.get(time_field) else {})}
+            for activity in mongo.db.userActivity.find(
+                {count_field: {"$gt": 0}}, {count_field: 1, time_field: 1}
+            ).sort(count_field, -1).limit(limit)
         ]
-        
-        chat_stats = list(mongo.db.user_chat.aggregate(chat_pipeline))
-        
-        for stats_list in [view_stats, upload_stats, chat_stats]:
-            for stat in stats_list:
-                if stat["_id"] == "anonymous":
-                    stat["username"] = "Anonymous"
-                    continue
-                    
-                try:
-                    user = mongo.db.users.find_one({"_id": stat["_id"]})
-                    if user:
-                        stat["username"] = user.get("username", "Unknown")
-                        stat["email"] = user.get("email", "Unknown")
-                    else:
-                        stat["username"] = "User not found"
-                except:
-                    stat["username"] = "Error retrieving user"
-                
-                for date_field in ["last_active", "last_upload"]:
-                    if date_field in stat:
-                        stat[date_field] = stat[date_field].isoformat()
-        
-        return jsonify({
-            "most_active_viewers": view_stats,
-            "most_active_uploaders": upload_stats,
-            "most_active_chatters": chat_stats
-        }), 200
+
+    user_ids = list(set(stat["_id"] for board in boards.values() for stat in board if stat["_id"] != "anonymous"))
+    users = {user["_id"]: user for user in mongo.db.users.find({"_id": {"$in": user_ids}}, {"username": 1, "email": 1})}
+    for board in boards.values():
+        for stat in board:
+            if stat["_id"] == "anonymous":
+                stat["username"] = "Anonymous"
+            elif stat["_id"] in users:
+                stat["username"] = users[stat["_id"]].get("username", "Unknown")
+                stat["email"] = users[stat["_id"]].get("email", "Unknown")
+            else:
+                stat["username"] = "User not found"
+    return boards
+
+def get_activity_leaderboards():
+    """
+    Current leaderboards. When they are stale one request rebuilds them while concurrent
+    requests keep getting the previous ones; only the very first build is waited on.
+    """
+    refresh_seconds = ACTIVITY_CONFIG.get("leaderboard_refresh_seconds", 30)
+    with activity_leaderboards_lock:
+        boards = activity_leaderboards["boards"]
+        if boards is not None and time.monotonic() - activity_leaderboards["refreshed_at"] < refresh_seconds:
+            return boards
+
+    if not activity_refresh_lock.acquire(blocking=boards is None):
+        return boards
+    try:
+        with activity_leaderboards_lock:
+            if activity_leaderboards["boards"] is not None and time.monotonic() - activity_leaderboards["refreshed_at"] < refresh_seconds:
+                return activity_leaderboards["boards"]
+        boards = build_activity_leaderboards()
+        with activity_leaderboards_lock:
+            activity_leaderboards["boards"] = boards
+            activity_leaderboards["refreshed_at"] = time.monotonic()
+        return boards
+    finally:
+        activity_refresh_lock.release()
+
+def invalidate_activity_leaderboards():
+    """Make the next request rebuild the leaderboards, e.g. after a user is deleted."""
+    with activity_leaderboards_lock:
+        activity_leaderboards["refreshed_at"] = 0.0
+
+@api.route('/analytics/user-activity', methods=['GET'])
+def get_user_activity():
+    """
+    Get analytics data about user activity: the top viewers, uploaders and chatters, from
+    the userActivity counters. Counts are lifetime activity and may lag by up to
+    leaderboard_refresh_seconds (views also by one view flush interval).
+    """
+    try:
+        return jsonify(get_activity_leaderboards()), 200
         
     except Exception as e:
-        print(f"Error retrieving user activity analytics: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error retrieving user activity analytics: {str(e)}")
         return jsonify({"error": "An error occurred retrieving user activity analytics", "details": str(e)}), 500
 
-def conversation_with_llm(query, image_info, context=None):
+def chat_fallback_reply(image_info, image_description):
+    """
+    Reply to send without calling the LLM, or None when the LLM should answer: used when
+    the LLM is disabled or the image has no usable description.
+    """
+    if not LLM_CONFIG.get("enabled", False):
+        logger.info("LLM is disabled, returning basic response.")
+        return f"LLM is disabled. The image is titled '{image_info.get('title', 'Unknown')}'."
+
+    if not image_description or image_description.startswith("Error:"):
+        logger.warning(f"Image analysis failed or description is missing. Error/Description: {image_description}")
+        return f"Sorry, I couldn't analyze the image ('{image_info.get('title', 'Unknown')}'). The analysis step reported: {image_description if image_description else 'No description generated.'}"
+
+    return None
+
+def estimate_tokens(text):
+    """Rough token count for text, used for prompt budgeting."""
+    return len(text or "") // CHAT_CONTEXT_CONFIG.get("chars_per_token", 4) + 1
+
+def format_chat_messages(messages):
+    """Render chatHistory messages as a User/Assistant transcript."""
+    return "\n".join(
+        f"{'User' if message.get('role') == 'user' else 'Assistant'}: {message.get('content', '')}"
+        for message in messages
+    )
+
+def build_chat_prompt(query, image_info, image_description, context_summary=None, history=None):
+    """
+    Build the full Gemini prompt for a question about an image from its description,
+    optionally with a summary of the earlier conversation and the most recent messages.
+    query may be a list of questions, which asks for a JSON reply with one answer each.
+    """
+    system_prompt = (
+        f"You are an assistant that helps users understand images based on a provided description. "
+        f"The image title is: '{image_info.get('title', 'Unknown')}'.\n"
+        f"The description of the image is:\n---\n{image_description}\n---"
+        f"\nBased *only* on this description, please answer the user's questions about the image. "
+        f"Be conversational and helpful. If the description doesn't contain the answer, "
+        f"state that the information isn't available in the description.\n\n"
+        f"IMPORTANT INSTRUCTIONS:\n"
+        f"1. Keep your answers SHORT and PRECISE - ideally 1-3 sentences maximum.\n"
+        f"2. Base your answers strictly on the provided image description.\n"
+        f"3. Do not invent details not present in the description.\n"
+        f"4. Do not apologize for limitations or use phrases like 'Based on the description...' unless necessary to explain a limitation.\n"
+        f"5. Focus on answering the specific question asked."
+    )
+    if context_summary:
+        system_prompt += f"\n\nSummary of the earlier conversation:\n{context_summary}"
+    if history:
+        system_prompt += f"\n\nRecent conversation:\n{format_chat_messages(history)}"
+    if isinstance(query, list):
+        numbered = "\n".join(f"{index}. {question}" for index, question in enumerate(query, 1))
+        return (
+            f"{system_prompt}\n\nUser's questions:\n{numbered}\n\n"
+            f"Answer each question separately, following the instructions above. Reply with only a JSON object "
+            f'of the form {{"answers": ["answer to question 1", "answer to question 2", ...]}} '
+            f"containing exactly {len(query)} answers in the same order as the questions."
+        )
+    return f"{system_prompt}\n\nUser's question: {query}"
+
+def summarize_chat_messages(previous_summary, messages):
+    """
+    Fold messages into the running summary of a conversation.
+    Returns the new summary, or None if the LLM call failed.
+    """
+    max_words = CHAT_CONTEXT_CONFIG.get("summary_max_tokens", 300) * 3 // 4
+    prompt = (
+        "Summarize the following conversation between a user and an assistant about an image. "
+        "Keep the facts, names and questions a later reply may need to refer back to. "
+        f"Write at most {max_words} words of plain text.\n\n"
+    )
+    if previous_summary:
+        prompt += f"Summary of the conversation so far:\n{previous_summary}\n\n"
+    prompt += f"Conversation to add:\n{format_chat_messages(messages)}"
+
+    summary = generate_text_with_llm(prompt, call_site="summary")
+    if not summary or summary.startswith("Error:"):
+        logger.warning(f"Could not summarize chat history: {summary}")
+        return None
+    return summary
+
+def keyset_condition(comparison, timestamp, object_id):
+    """Filter for messages strictly before ("$lt") or after ("$gt") a (timestamp, _id) position."""
+    return {"$or": [
+        {"timestamp": {comparison: timestamp}},
+        {"timestamp": timestamp, "_id": {comparison: object_id}}
+    ]}
+
+# Conversations with a summarization task queued or running in this process
+summarizing_conversations = set()
+summarizing_conversations_lock = threading.Lock()
+
+def summarize_conversation_backlog(summary_id, overflow_query, context_summary, summarized_until_id):
+    """
+    Background task: fold unsummarized messages that no longer fit in the prompt into the
+    conversation's running summary, oldest first and one page at a time, once they pass the
+    summarize threshold. The summary's (timestamp, _id) cursor only moves past messages that
+    were summarized, so none are skipped, and each page is written only if the cursor is still
+    where this task found it, so another process summarizing the same conversation can't
+    overwrite it with an older summary.
+    """
+    fetch_limit = CHAT_CONTEXT_CONFIG.get("history_fetch_limit", 40)
+    try:
+        for _ in range(CHAT_CONTEXT_CONFIG.get("max_summary_pages_per_turn", 3)):
+            overflow = list(mongo.db.chatHistory.find(
+                overflow_query, {"role": 1, "content": 1, "timestamp": 1}
+            ).sort([("timestamp", 1), ("_id", 1)]).limit(fetch_limit))
+            overflow_tokens = sum(estimate_tokens(message.get("content")) for message in overflow)
+            # A full page means more is waiting, so it is summarized whatever its size
+            if not overflow or (len(overflow) < fetch_limit and overflow_tokens < CHAT_CONTEXT_CONFIG.get("summarize_threshold_tokens", 600)):
+                break
+            new_summary = summarize_chat_messages(context_summary, overflow)
+            if not new_summary:
+                break
+            result = mongo.db.conversationSummaries.update_one(
+                {"_id": summary_id, "summarized_until_id": summarized_until_id},
+                {"$set": {
+                    "context_summary": new_summary,
+                    "summarized_until": overflow[-1]["timestamp"],
+                    "summarized_until_id": overflow[-1]["_id"]
+                }}
+            )
+            if result.matched_count == 0:
+                logger.info(f"Summary for conversation {summary_id} changed while summarizing; leaving it")
+                break
+            context_summary = new_summary
+            summarized_until_id = overflow[-1]["_id"]
+            if len(overflow) < fetch_limit:
+                break
+            overflow_query = {"$and": [overflow_query, keyset_condition("$gt", overflow[-1]["timestamp"], overflow[-1]["_id"])]}
+    except Exception as e:
+        logger.exception(f"Error summarizing conversation {summary_id}: {str(e)}")
+    finally:
+        with summarizing_conversations_lock:
+            summarizing_conversations.discard(summary_id)
+
+def build_chat_context(user_id, query, image_info, image_description):
+    """
+    Build the prompt for the next chat turn within CHAT_CONTEXT_CONFIG's token budget.
+
+    The newest messages since the conversation's last summarization are included verbatim
+    while they fit, after the running summary stored on the conversationSummaries document.
+    Older messages that are not yet summarized are left out of this prompt and handed to
+    summarize_conversation_backlog on the background worker pool, so no summarization call
+    runs on the request path.
+    Returns a dict with the prompt and its estimated size, plus the summary and history it
+    was built from so prompts for other questions can reuse them.
+    """
+    image_id = str(image_info["_id"])
+    summary_id = f"{user_id}:{image_id}"
+    summary_doc = mongo.db.conversationSummaries.find_one(
+        {"_id": summary_id}, {"context_summary": 1, "summarized_until": 1, "summarized_until_id": 1}
+    ) or {}
+    context_summary = summary_doc.get("context_summary")
+
+    history_query = {"user_id": user_id, "image_id": image_id}
+    if summary_doc.get("summarized_until_id"):
+        history_query.update(keyset_condition("$gt", summary_doc["summarized_until"], summary_doc["summarized_until_id"]))
+    elif summary_doc.get("summarized_until"):
+        # Summaries written before the cursor included _id
+        history_query["timestamp"] = {"$gt": summary_doc["summarized_until"]}
+    fetch_limit = CHAT_CONTEXT_CONFIG.get("history_fetch_limit", 40)
+    recent_messages = list(mongo.db.chatHistory.find(
+        history_query, {"role": 1, "content": 1, "timestamp": 1}
+    ).sort([("timestamp", -1), ("_id", -1)]).limit(fetch_limit))
+
+    # Whatever the instructions, description, summary and question leave of the prompt budget
+    base_tokens = estimate_tokens(build_chat_prompt(query, image_info, image_description, context_summary))
+    history_budget = min(
+        CHAT_CONTEXT_CONFIG.get("history_token_budget", 1500),
+        CHAT_CONTEXT_CONFIG.get("max_prompt_tokens", 4000) - base_tokens
+    )
+
+    # recent_messages is newest first: keep a prefix that fits, everything older overflows
+    history_tokens = 0
+    kept = 0
+    for message in recent_messages:
+        message_tokens = estimate_tokens(message.get("content"))
+        if history_tokens + message_tokens > history_budget:
+            break
+        history_tokens += message_tokens
+        kept += 1
+    history = list(reversed(recent_messages[:kept]))
+
+    # Unsummarized messages older than the kept window, which may extend past the fetched page
+    has_overflow = kept < len(recent_messages) or len(recent_messages) == fetch_limit
+    if has_overflow and summary_doc and LLM_CONFIG.get("enabled", False):
+        overflow_query = dict(history_query)
+        if history:
+            overflow_query = {"$and": [history_query, keyset_condition("$lt", history[0]["timestamp"], history[0]["_id"])]}
+        with summarizing_conversations_lock:
+            already_summarizing = summary_id in summarizing_conversations
+            summarizing_conversations.add(summary_id)
+        if not already_summarizing:
+            # Run with the request's context so the summarization logs carry its request id
+            get_upload_executor().submit(contextvars.copy_context().run, summarize_conversation_backlog, summary_id,
+                                         overflow_query, context_summary, summary_doc.get("summarized_until_id"))
+
+    prompt = build_chat_prompt(query, image_info, image_description, context_summary, history)
+    return {
+        "prompt": prompt,
+        # No earlier turns went into the prompt, so the answer depends only on the image and question
+        "standalone": not context_summary and not history,
+        "prompt_chars": len(prompt),
+        "prompt_tokens": estimate_tokens(prompt),
+        "history_messages": len(history),
+        "context_summary": context_summary,
+        "history": history
+    }
+
+# Replies produced when generation fails; these are never cached
+CHAT_ERROR_PREFIXES = ("Error:", "Sorry, I encountered an error", "An unexpected error occurred", "Response blocked")
+
+# In-process answer cache: key -> (image_id, answer, stored_at), least recently used first
+answer_cache = OrderedDict()
+answer_cache_lock = threading.Lock()
+answer_cache_stats = {"hits": 0, "mongo_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+def normalize_question(question):
+    """Lowercase, collapse whitespace and drop trailing punctuation so trivially different phrasings share a key."""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+def answer_cache_key(image_info, image_description, question):
+    """
+    Cache key for a first question about an image. The title and description are hashed
+    in because both go into the prompt, so editing either makes old answers unreachable.
+    """
+    context_hash = hashlib.sha256(
+        f"{image_info.get('title', 'Unknown')}\n{image_description}".encode("utf-8")
+    ).hexdigest()
+    key_source = "\n".join([
+        str(image_info["_id"]), context_hash, LLM_CONFIG.get("model", "gemini-1.5-flash"), normalize_question(question)
+    ])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+def record_answer_cache_stat(name):
+    with answer_cache_lock:
+        answer_cache_stats[name] += 1
+
+def get_cached_answer(key):
+    """Return the cached answer for key from memory, then Mongo if enabled, or None."""
+    if not ANSWER_CACHE_CONFIG.get("enabled", False):
+        return None
+
+    now = time.monotonic()
+    ttl = ANSWER_CACHE_CONFIG.get("ttl_seconds", 6 * 60 * 60)
+    with answer_cache_lock:
+        entry = answer_cache.get(key)
+        if entry and now - entry[2] < ttl:
+            answer_cache.move_to_end(key)
+            answer_cache_stats["hits"] += 1
+            return entry[1]
+        if entry:
+            del answer_cache[key]
+            answer_cache_stats["expirations"] += 1
+
+    if ANSWER_CACHE_CONFIG.get("mongo_enabled", False):
+        try:
+            doc = mongo.db.answerCache.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+            if doc:
+                store_answer_in_memory(key, doc["image_id"], doc["answer"])
+                record_answer_cache_stat("mongo_hits")
+                return doc["answer"]
+        except Exception as e:
+            logger.error(f"Error reading answer cache from MongoDB: {str(e)}")
+
+    record_answer_cache_stat("misses")
+    return None
+
+def store_answer_in_memory(key, image_id, answer):
+    with answer_cache_lock:
+        answer_cache[key] = (image_id, answer, time.monotonic())
+        answer_cache.move_to_end(key)
+        while len(answer_cache) > ANSWER_CACHE_CONFIG.get("max_entries", 1000):
+            answer_cache.popitem(last=False)
+            answer_cache_stats["evictions"] += 1
+
+def store_cached_answer(key, image_id, answer):
+    """Cache a successful answer in memory and, if enabled, in the answerCache collection."""
+    if not ANSWER_CACHE_CONFIG.get("enabled", False) or not answer or answer.startswith(CHAT_ERROR_PREFIXES):
+        return
+
+    store_answer_in_memory(key, image_id, answer)
+    record_answer_cache_stat("stores")
+
+    if ANSWER_CACHE_CONFIG.get("mongo_enabled", False):
+        now = datetime.now(timezone.utc)
+        try:
+            mongo.db.answerCache.replace_one(
+                {"_id": key},
+                {
+                    "image_id": image_id,
+                    "answer": answer,
+                    "created_at": now,
+                    # Removed by the TTL index on expires_at
+                    "expires_at": now + timedelta(seconds=ANSWER_CACHE_CONFIG.get("ttl_seconds", 6 * 60 * 60))
+                },
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error writing answer cache to MongoDB: {str(e)}")
+
+def invalidate_answer_cache(image_id):
+    """Drop every cached answer for an image, in memory and in MongoDB."""
+    with answer_cache_lock:
+        stale_keys = [key for key, entry in answer_cache.items() if entry[0] == image_id]
+        for key in stale_keys:
+            del answer_cache[key]
+        answer_cache_stats["invalidations"] += len(stale_keys)
+
+    if ANSWER_CACHE_CONFIG.get("mongo_enabled", False):
+        mongo.db.answerCache.delete_many({"image_id": image_id})
+
+def conversation_with_llm(query, image_info, context=None, prompt=None):
     """
     Generate a conversational response about an image using Google's Gemini model.
     
@@ -841,72 +2547,52 @@ def conversation_with_llm(query, image_info, context=None):
         query: User's question
         image_info: Image metadata (used for title primarily now)
         context: The AI-generated description of the image from gemini-pro-vision
+        prompt: Full prompt from build_chat_context; built from the description alone if omitted
         
     Returns:
         Generated response text
     """
-    if not LLM_CONFIG.get("enabled", False):
-        print("LLM is disabled, returning basic response.")
-        return f"LLM is disabled. The image is titled '{image_info.get('title', 'Unknown')}'."
+    image_description = context if context else image_info.get('vision_description')
+    fallback_reply = chat_fallback_reply(image_info, image_description)
+    if fallback_reply:
+        return fallback_reply
     
     try:
-        print("LLM is enabled, attempting to use Gemini...")
-        image_description = context if context else image_info.get('vision_description')
-        
-        if not image_description or image_description.startswith("Error:"):
-            print(f"Image analysis failed or description is missing. Error/Description: {image_description}")
-            return f"Sorry, I couldn't analyze the image ('{image_info.get('title', 'Unknown')}'). The analysis step reported: {image_description if image_description else 'No description generated.'}"
-        
-        print(f"Using image description for LLM context: {image_description[:150]}...")
-        
-        system_prompt = (
-            f"You are an assistant that helps users understand images based on a provided description. "
-            f"The image title is: '{image_info.get("title", "Unknown")}'.\n"
-            f"The description of the image is:\n---\n{image_description}\n---"
-            f"\nBased *only* on this description, please answer the user's questions about the image. "
-            f"Be conversational and helpful. If the description doesn't contain the answer, "
-            f"state that the information isn't available in the description.\n\n"
-            f"IMPORTANT INSTRUCTIONS:\n"
-            f"1. Keep your answers SHORT and PRECISE - ideally 1-3 sentences maximum.\n"
-            f"2. Base your answers strictly on the provided image description.\n"
-            f"3. Do not invent details not present in the description.\n"
-            f"4. Do not apologize for limitations or use phrases like 'Based on the description...' unless necessary to explain a limitation.\n"
-            f"5. Focus on answering the specific question asked."
-        )
+        logger.debug("LLM is enabled, attempting to use Gemini...")
+        logger.debug("Using image description for LLM context: %.150s", image_description)
         
         # Google AI Studio (Gemini) integration
         try:
             model_name = LLM_CONFIG.get("model", "gemini-1.5-flash") 
-            print(f"Using Gemini conversational model: {model_name}")
-            model = genai.GenerativeModel(model_name)
+            logger.debug(f"Using Gemini conversational model: {model_name}")
             
-            full_prompt = f"{system_prompt}\n\nUser's question: {query}"
-            print(f"Sending prompt to Gemini (length: {len(full_prompt)}):")
+            full_prompt = prompt or build_chat_prompt(query, image_info, image_description)
+            logger.info("Sending prompt to Gemini", extra={"event": "chat.prompt", "prompt_chars": len(full_prompt)})
             
             try:
-                print("Generating content with Gemini API...")
-                response = model.generate_content(full_prompt)
+                logger.debug("Generating content with Gemini API...")
+                response = llm_gateway.generate_content("chat", full_prompt, model_name)
                 
                 # Process the response
                 response_text = None
                 if response and hasattr(response, 'text'):
                     response_text = response.text
-                    print(f"Got response from Gemini: {response_text[:100]}...")
+                    logger.info("Got response from Gemini", extra={"event": "chat.response", "chars": len(response_text)})
                 elif response and hasattr(response, 'parts') and response.parts:
                      response_text = response.parts[0].text
-                     print(f"Got response from Gemini (parts): {response_text[:100]}...")
+                     logger.info("Got response from Gemini (parts)", extra={"event": "chat.response", "chars": len(response_text)})
                 elif response and hasattr(response, 'candidates') and response.candidates:
                      try:
                          response_text = response.candidates[0].content.parts[0].text
-                         print(f"Got response from Gemini (candidates): {response_text[:100]}...")
+                         logger.info("Got response from Gemini (candidates)", extra={"event": "chat.response", "chars": len(response_text)})
                      except (AttributeError, IndexError):
-                         print(f"Could not extract text from Gemini candidates structure: {response.candidates}")
+                         logger.warning(f"Could not extract text from Gemini candidates structure: {response.candidates}")
                          response_text = "Error: Could not process LLM response structure."
                 else:
-                    print(f"Unexpected response format from Gemini: {type(response)}")
-                    print(f"Response content: {response}")
+                    logger.warning(f"Unexpected response format from Gemini: {type(response)}")
+                    logger.debug("Response content: %s", response)
                     if hasattr(response, 'prompt_feedback'):
-                        print(f"Prompt Feedback: {response.prompt_feedback}")
+                        logger.debug("Prompt Feedback: %s", response.prompt_feedback)
                         if response.prompt_feedback.block_reason:
                             response_text = f"Response blocked due to: {response.prompt_feedback.block_reason}"
                     if not response_text:
@@ -915,83 +2601,264 @@ def conversation_with_llm(query, image_info, context=None):
                 return response_text.strip()
                 
             except Exception as gen_error:
-                print(f"Error generating content with Gemini: {str(gen_error)}")
-                traceback.print_exc()
+                logger.exception(f"Error generating content with Gemini: {str(gen_error)}")
                 return "Sorry, I encountered an error trying to generate a response."
             
         except ImportError as e:
-            print(f"Error importing Gemini library: {str(e)}")
-            traceback.print_exc()
+            logger.exception(f"Error importing Gemini library: {str(e)}")
             return "Error: LLM library not available."
         except Exception as gemini_error:
-            print(f"Gemini API configuration or call error: {str(gemini_error)}")
-            traceback.print_exc()
+            logger.exception(f"Gemini API configuration or call error: {str(gemini_error)}")
             return "Error: Could not connect to the conversational AI service."
             
     except Exception as e:
-        print(f"Error in conversation_with_llm function: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error in conversation_with_llm function: {str(e)}")
         return "An unexpected error occurred while processing the chat request."
 
-@app.route('/chat', methods=['POST'])
-def chat():
+def parse_batch_answers(raw_text, question_count):
+    """
+    Parse the JSON reply to a multi-question prompt from build_chat_prompt.
+    Returns the list of answers, or None unless it holds exactly question_count non-empty strings.
+    """
+    data = extract_json_reply(raw_text)
+    answers = data.get("answers") if isinstance(data, dict) else data
+    if not isinstance(answers, list) or len(answers) != question_count:
+        return None
+    if not all(isinstance(answer, str) and answer.strip() for answer in answers):
+        return None
+    return [answer.strip() for answer in answers]
+
+def answer_questions_with_llm(questions, prompt):
+    """
+    Answer several questions about one image with a single JSON-mode Gemini call.
+    prompt is built by build_chat_prompt from the list of questions.
+    Returns the answers in question order, or None if the call failed or its reply could not be parsed.
+    """
+    model_name = LLM_CONFIG.get("model", "gemini-1.5-flash")
+    logger.info("Sending multi-question prompt to Gemini", extra={"event": "chat.prompt", "prompt_chars": len(prompt), "questions": len(questions)})
     try:
-        data = request.json
-        
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-            
-        user_message = data.get('message')
-        image_id = data.get('image_id')
-        user_id = data.get('user_id', 'anonymous')
-        
-        if not user_message or not image_id:
-            return jsonify({"error": "Message and image_id are required"}), 400
-            
-        if not ObjectId.is_valid(image_id):
-            return jsonify({"error": "Invalid image_id format"}), 400
+        response = llm_gateway.generate_content("chat", prompt, model_name, json_mode=True)
+    except Exception as e:
+        logger.exception(f"Error generating batch answers with Gemini: {str(e)}")
+        return None
 
-        image_info = mongo.db.images.find_one({"_id": ObjectId(image_id)})
-        if not image_info:
-            return jsonify({"error": "Image not found"}), 404
-        
-        context_description = image_info.get('vision_description')
-        if not context_description:
-             labels = image_info.get('labels', [])
-             if labels:
-                 context_description = "Detected labels: " + ", ".join([l.get('label', str(l)) for l in labels])
-             else:
-                 context_description = "No description or labels available for this image."
+    answers = parse_batch_answers(getattr(response, "text", None), len(questions))
+    if answers is None:
+        logger.warning(f"Could not parse {len(questions)} answers from the batch chat reply")
+    return answers
 
-        response_text = conversation_with_llm(user_message, image_info, context=context_description) # Pass description as context
+def get_display_title(image_info):
+    """Title shown for an image's conversation: generated title, then user title, then filename."""
+    return image_info.get("generated_title", image_info.get("title", image_info.get("filename", "Chat about Image")))
 
-        # --- Save Chat History ---
+def save_chat_turn(user_id, image_info, user_message, response_text, prompt_stats=None):
+    """
+    Save one question/answer turn to chatHistory and fold it into the user's
+    conversation summary for the image. prompt_stats (prompt_tokens, prompt_chars,
+    history_messages) are recorded on the bot message. Returns the turn's conversation id.
+    """
+    return save_chat_turns(user_id, image_info, [(user_message, response_text)], prompt_stats)[0]
+
+def save_chat_turns(user_id, image_info, turns, prompt_stats=None):
+    """
+    Save (user_message, response_text) turns, in order, with one chatHistory insert_many
+    and one conversationSummaries update. Returns the turns' conversation ids.
+    """
+    image_id = str(image_info["_id"])
+    now = datetime.now(timezone.utc)
+    messages = []
+    conversation_ids = []
+    for index, (user_message, response_text) in enumerate(turns):
         chat_history_id = ObjectId() # Unique ID for this conversation turn
+        conversation_ids.append(chat_history_id)
+        # Distinct, increasing timestamps keep the turns in order when history is sorted
+        user_timestamp = now + timedelta(milliseconds=2 * index)
+        bot_timestamp = user_timestamp + timedelta(milliseconds=1)
 
-        # Save user message
-        user_chat_entry = {
-            "_id": ObjectId(), # Unique ID for this specific message
-            "conversation_id": chat_history_id,
-            "user_id": user_id,
-            "image_id": image_id,
-            "role": "user",
-            "content": user_message,
-            "timestamp": datetime.now(timezone.utc)
-        }
-        mongo.db.chatHistory.insert_one(user_chat_entry)
+        # Save user message and bot response
+        messages.extend([
+            {
+                "_id": ObjectId(), # Unique ID for this specific message
+                "conversation_id": chat_history_id,
+                "user_id": user_id,
+                "image_id": image_id,
+                "role": "user",
+                "content": user_message,
+                "timestamp": user_timestamp
+            },
+            {
+                "_id": ObjectId(), 
+                "conversation_id": chat_history_id,
+                "user_id": user_id,
+                "image_id": image_id,
+                "role": "bot",
+                "content": response_text,
+                "timestamp": bot_timestamp,
+                **(prompt_stats or {})
+            }
+        ])
+    mongo.db.chatHistory.insert_many(messages)
+
+    # One row per (user, image) conversation, so the sidebar never reads messages
+    mongo.db.conversationSummaries.update_one(
+        {"_id": f"{user_id}:{image_id}"},
+        {
+            "$inc": {"message_count": len(messages)},
+            "$set": {
+                "title": get_display_title(image_info),
+                "last_user_message": messages[-2]["content"],
+                "last_bot_message": messages[-1]["content"],
+                "last_activity": messages[-1]["timestamp"]
+            },
+            "$setOnInsert": {
+                "user_id": user_id,
+                "image_id": image_id,
+                "created_at": messages[0]["timestamp"]
+            }
+        },
+        upsert=True
+    )
+    record_user_activity({user_id: (len(turns), messages[-1]["timestamp"])}, "chat_count", "last_chat")
 
-        # Save bot response
-        bot_chat_entry = {
-            "_id": ObjectId(), 
-            "conversation_id": chat_history_id,
-            "user_id": user_id,
-            "image_id": image_id,
-            "role": "bot",
-            "content": response_text,
-            "timestamp": datetime.now(timezone.utc)
-        }
-        mongo.db.chatHistory.insert_one(bot_chat_entry)
+    return conversation_ids
+
+def backfill_conversation_summaries():
+    """
+    Rebuild conversationSummaries from chatHistory, for conversations recorded before
+    summaries were maintained. Returns the number of summaries written.
+    """
+    pipeline = [
+        {"$sort": {"timestamp": 1}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "image_id": "$image_id"},
+            "message_count": {"$sum": 1},
+            "created_at": {"$first": "$timestamp"},
+            "last_activity": {"$last": "$timestamp"},
+            "messages": {"$push": {"role": "$role", "content": "$content"}}
+        }}
+    ]
+    groups = [group for group in mongo.db.chatHistory.aggregate(pipeline, allowDiskUse=True) if group["_id"].get("image_id")]
+
+    image_ids = list(set(group["_id"]["image_id"] for group in groups if ObjectId.is_valid(group["_id"]["image_id"])))
+    titles = {
+        str(image["_id"]): get_display_title(image)
+        for image in mongo.db.images.find(
+            {"_id": {"$in": [ObjectId(img_id) for img_id in image_ids]}},
+            {"title": 1, "filename": 1, "generated_title": 1}
+        )
+    }
+
+    operations = []
+    for group in groups:
+        user_id, image_id = group["_id"].get("user_id"), group["_id"]["image_id"]
+        messages = group["messages"]
+        last_user = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+        last_bot = next((m.get("content") for m in reversed(messages) if m.get("role") == "bot"), "")
+        operations.append(pymongo.UpdateOne(
+            {"_id": f"{user_id}:{image_id}"},
+            {"$set": {
+                "user_id": user_id,
+                "image_id": image_id,
+                "title": titles.get(image_id, "Image Deleted"),
+                "message_count": group["message_count"],
+                "last_user_message": last_user,
+                "last_bot_message": last_bot,
+                "last_activity": group["last_activity"],
+                "created_at": group["created_at"]
+            }},
+            upsert=True
+        ))
 
+    if operations:
+        mongo.db.conversationSummaries.bulk_write(operations, ordered=False)
+    return len(operations)
+
+def load_chat_request(data, batch=False):
+    """
+    Validate a /chat, /chat/stream or (with batch=True) /chat/batch request body and load
+    the image it refers to. Returns (error_response, chat) where chat holds user_message
+    (the list of questions for a batch), user_id, image_info and context_description;
+    exactly one of the two is None.
+    """
+    if not data:
+        return (jsonify({"error": "No data provided"}), 400), None
+        
+    user_message = data.get('questions') if batch else data.get('message')
+    image_id = data.get('image_id')
+    user_id = data.get('user_id', 'anonymous')
+    
+    if not user_message or not image_id:
+        if batch:
+            return (jsonify({"error": "Questions and image_id are required"}), 400), None
+        return (jsonify({"error": "Message and image_id are required"}), 400), None
+
+    if batch:
+        if not isinstance(user_message, list) or not all(isinstance(q, str) and q.strip() for q in user_message):
+            return (jsonify({"error": "Questions must be a list of non-empty strings"}), 400), None
+        max_questions = CHAT_BATCH_CONFIG.get("max_questions", 10)
+        if len(user_message) > max_questions:
+            return (jsonify({"error": f"At most {max_questions} questions can be asked at once"}), 400), None
+        user_message = [question.strip() for question in user_message]
+        
+    if not ObjectId.is_valid(image_id):
+        return (jsonify({"error": "Invalid image_id format"}), 400), None
+
+    image_info = mongo.db.images.find_one({"_id": ObjectId(image_id)})
+    if not image_info:
+        return (jsonify({"error": "Image not found"}), 404), None
+
+    if image_info.get("analysis_status") in ("pending", "processing"):
+        return (jsonify({"error": "Image analysis is still in progress, please try again shortly"}), 409), None
+    
+    context_description = image_info.get('vision_description')
+    if not context_description:
+         labels = image_info.get('labels', [])
+         if labels:
+             context_description = "Detected labels: " + ", ".join([l.get('label', str(l)) for l in labels])
+         else:
+             context_description = "No description or labels available for this image."
+
+    return None, {
+        "user_message": user_message,
+        "user_id": user_id,
+        "image_info": image_info,
+        "context_description": context_description
+    }
+
+@api.route('/chat', methods=['POST'])
+def chat():
+    try:
+        error_response, chat_request = load_chat_request(request.json)
+        if error_response:
+            return error_response
+
+        user_message = chat_request["user_message"]
+        user_id = chat_request["user_id"]
+        image_info = chat_request["image_info"]
+        image_id = str(image_info["_id"])
+        context_description = chat_request["context_description"]
+
+        prompt_stats = None
+        chat_context = None
+        cache_key = None
+        response_text = None
+        if not chat_fallback_reply(image_info, context_description):
+            chat_context = build_chat_context(user_id, user_message, image_info, context_description)
+            prompt_stats = {key: chat_context[key] for key in ("prompt_tokens", "prompt_chars", "history_messages")}
+            if chat_context["standalone"]:
+                cache_key = answer_cache_key(image_info, context_description, user_message)
+                response_text = get_cached_answer(cache_key)
+                if response_text:
+                    prompt_stats = {"cache_hit": True}
+
+        if not response_text:
+            response_text = conversation_with_llm(user_message, image_info, context=context_description,
+                                                  prompt=chat_context["prompt"] if chat_context else None)
+            if cache_key:
+                store_cached_answer(cache_key, image_id, response_text)
+
+        # --- Save Chat History ---
+        chat_history_id = save_chat_turn(user_id, image_info, user_message, response_text, prompt_stats)
 
         return jsonify({
             "response": response_text,
@@ -1000,22 +2867,242 @@ def chat():
         }), 200
         
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error in chat endpoint: {str(e)}")
+        return jsonify({"error": "Failed to process chat request", "details": str(e)}), 500
+
+@api.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """
+    Answer a list of questions about one image with a single model call and save every
+    turn with one bulk write. Questions already in the answer cache are not sent to the
+    model. If the reply cannot be parsed the questions are answered one call at a time.
+    """
+    try:
+        error_response, chat_request = load_chat_request(request.json, batch=True)
+        if error_response:
+            return error_response
+
+        questions = chat_request["user_message"]
+        user_id = chat_request["user_id"]
+        image_info = chat_request["image_info"]
+        image_id = str(image_info["_id"])
+        context_description = chat_request["context_description"]
+
+        answers = [None] * len(questions)
+        prompt_stats = None
+        model_calls = 0
+        fallback_reply = chat_fallback_reply(image_info, context_description)
+        if fallback_reply:
+            answers = [fallback_reply] * len(questions)
+        else:
+            cache_keys = [None] * len(questions)
+            chat_context = build_chat_context(user_id, questions, image_info, context_description)
+            if chat_context["standalone"]:
+                cache_keys = [answer_cache_key(image_info, context_description, question) for question in questions]
+                answers = [get_cached_answer(key) for key in cache_keys]
+
+            pending = [index for index, answer in enumerate(answers) if not answer]
+            if pending:
+                pending_questions = [questions[index] for index in pending]
+                prompt = chat_context["prompt"]
+                if len(pending) < len(questions):
+                    prompt = build_chat_prompt(pending_questions, image_info, context_description,
+                                               chat_context["context_summary"], chat_context["history"])
+                prompt_stats = {
+                    "prompt_tokens": estimate_tokens(prompt),
+                    "prompt_chars": len(prompt),
+                    "history_messages": chat_context["history_messages"],
+                    "batch_size": len(pending)
+                }
+                model_calls = 1
+                pending_answers = answer_questions_with_llm(pending_questions, prompt)
+                if pending_answers is None:
+                    logger.info("Falling back to one chat call per question")
+                    pending_answers = [
+                        conversation_with_llm(question, image_info, context=context_description,
+                                              prompt=build_chat_prompt(question, image_info, context_description,
+                                                                       chat_context["context_summary"], chat_context["history"]))
+                        for question in pending_questions
+                    ]
+                    model_calls += len(pending_questions)
+                for index, answer in zip(pending, pending_answers):
+                    answers[index] = answer
+                    if cache_keys[index]:
+                        store_cached_answer(cache_keys[index], image_id, answer)
+            else:
+                prompt_stats = {"cache_hit": True}
+
+        conversation_ids = save_chat_turns(user_id, image_info, list(zip(questions, answers)), prompt_stats)
+
+        return jsonify({
+            "image_id": image_id,
+            "answers": [
+                {"question": question, "response": answer, "conversation_id": str(conversation_id)}
+                for question, answer, conversation_id in zip(questions, answers, conversation_ids)
+            ],
+            "model_calls": model_calls
+        }), 200
+
+    except Exception as e:
+        logger.exception(f"Error in batch chat endpoint: {str(e)}")
+        return jsonify({"error": "Failed to process batch chat request", "details": str(e)}), 500
+
+def format_sse(event, payload):
+    """Format one Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def run_chat_stream(events, user_id, image_info, user_message, image_description):
+    """
+    Generate an answer with Gemini's streaming API, putting ("chunk", text) events on the
+    events queue as they arrive, then save the turn and put a final ("done", ...) event.
+    Runs on its own thread so the answer is saved even if the client disconnects.
+    """
+    response_parts = []
+    prompt_stats = None
+    try:
+        fallback_reply = chat_fallback_reply(image_info, image_description)
+        if fallback_reply:
+            response_parts.append(fallback_reply)
+            events.put(("chunk", {"text": fallback_reply}))
+        else:
+            model_name = LLM_CONFIG.get("model", "gemini-1.5-flash")
+            chat_context = build_chat_context(user_id, user_message, image_info, image_description)
+            prompt_stats = {key: chat_context[key] for key in ("prompt_tokens", "prompt_chars", "history_messages")}
+
+            cache_key = None
+            cached_answer = None
+            if chat_context["standalone"]:
+                cache_key = answer_cache_key(image_info, image_description, user_message)
+                cached_answer = get_cached_answer(cache_key)
+
+            if cached_answer:
+                prompt_stats = {"cache_hit": True}
+                response_parts.append(cached_answer)
+                events.put(("chunk", {"text": cached_answer}))
+            else:
+                for chunk in llm_gateway.stream_content("chat", chat_context["prompt"], model_name):
+                    try:
+                        chunk_text = chunk.text
+                    except ValueError:
+                        # Blocked or empty candidates carry no text
+                        chunk_text = ""
+                    if chunk_text:
+                        response_parts.append(chunk_text)
+                        events.put(("chunk", {"text": chunk_text}))
+
+                if not response_parts:
+                    response_parts.append("Error: Received unexpected response format from LLM.")
+                    events.put(("chunk", {"text": response_parts[0]}))
+                elif cache_key:
+                    store_cached_answer(cache_key, str(image_info["_id"]), "".join(response_parts).strip())
+    except Exception as e:
+        logger.exception(f"Error streaming content with Gemini: {str(e)}")
+        error_text = "Sorry, I encountered an error trying to generate a response."
+        response_parts.append(("\n\n" if response_parts else "") + error_text)
+        events.put(("error", {"error": error_text}))
+
+    response_text = "".join(response_parts).strip()
+    try:
+        chat_history_id = save_chat_turn(user_id, image_info, user_message, response_text, prompt_stats)
+        events.put(("done", {
+            "response": response_text,
+            "image_id": str(image_info["_id"]),
+            "conversation_id": str(chat_history_id)
+        }))
+    except Exception as e:
+        logger.exception(f"Error saving streamed chat response: {str(e)}")
+        events.put(("error", {"error": "Failed to save chat response"}))
+        events.put(("done", {"response": response_text, "image_id": str(image_info["_id"]), "conversation_id": None}))
+
+@api.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Streaming variant of /chat. Takes the same JSON body and answers with a
+    text/event-stream of `chunk` events ({"text": ...}) as Gemini produces them, followed
+    by one `done` event with the full response and conversation_id. An `error` event is
+    sent before `done` if generation fails part way.
+    """
+    try:
+        error_response, chat_request = load_chat_request(request.json)
+        if error_response:
+            return error_response
+
+        events = queue.Queue()
+        # Run in a copy of this request's context so the worker's logs carry its request id
+        worker = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(run_chat_stream, events, chat_request["user_id"], chat_request["image_info"],
+                  chat_request["user_message"], chat_request["context_description"]),
+            daemon=True
+        )
+        worker.start()
+
+        keepalive_interval = CHAT_STREAM_CONFIG.get("keepalive_interval", 15)
+
+        def generate():
+            while True:
+                try:
+                    event, payload = events.get(timeout=keepalive_interval)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event, payload)
+                if event == "done":
+                    return
+
+        return Response(generate(), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        })
+
+    except Exception as e:
+        logger.exception(f"Error in chat stream endpoint: {str(e)}")
         return jsonify({"error": "Failed to process chat request", "details": str(e)}), 500
 
-@app.route('/chat-history', methods=['GET'])
+@api.route('/chat-history', methods=['GET'])
 def get_chat_history():
+    """
+    Get a page of a user's chat messages in chronological order.
+    Without a cursor the most recent `limit` messages are returned. Pass before_cursor
+    back as `before` to load older messages, or after_cursor as `after` to load newer ones.
+    """
     try:
         user_id = request.args.get('user_id')
         image_id = request.args.get('image_id')
+        before = request.args.get('before')
+        after = request.args.get('after')
 
         if not user_id:
             return jsonify({"error": "User ID is required"}), 400
+
+        if before and after:
+            return jsonify({"error": "Use either before or after, not both"}), 400
+
+        try:
+            # At least 1: Mongo treats limit(0) as no limit
+            limit = max(1, min(int(request.args.get('limit', PAGINATION_CONFIG.get("chat_default_limit", 100))), PAGINATION_CONFIG.get("chat_max_limit", 500)))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
             
-        query = {"user_id": user_id}
+        # Keyset paging needs a timestamp on every message; legacy documents without one are left out
+        query = {"user_id": user_id, "timestamp": {"$type": "date"}}
         if image_id:
             query["image_id"] = image_id
+
+        # Keyset paging on (timestamp, _id): walk backwards from `before` (or the newest
+        # message), or forwards from `after`
+        direction = 1 if after else -1
+        if before or after:
+            try:
+                cursor_timestamp, cursor_id = decode_cursor(before or after)
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+            comparison = "$gt" if after else "$lt"
+            query["$or"] = [
+                {"timestamp": {comparison: cursor_timestamp}},
+                {"timestamp": cursor_timestamp, "_id": {comparison: cursor_id}}
+            ]
             
         chat_history = list(mongo.db.chatHistory.find(
             query,
@@ -1026,29 +3113,36 @@ def get_chat_history():
                 "timestamp": 1,
                 "image_id": 1
             }
-        ).sort("timestamp", 1))
+        ).sort([("timestamp", direction), ("_id", direction)]).limit(limit + 1))
+
+        has_more = len(chat_history) > limit
+        chat_history = chat_history[:limit]
+        if direction == -1:
+            chat_history.reverse()
         
-        image_ids = list(set(chat["image_id"] for chat in chat_history if "image_id" in chat))
+        # Resolve every referenced image's title in a single query
+        image_ids = list(set(chat["image_id"] for chat in chat_history if chat.get("image_id")))
         
         images = {}
+        try:
+            image_docs = mongo.db.images.find(
+                {"_id": {"$in": [ObjectId(img_id_str) for img_id_str in image_ids if ObjectId.is_valid(img_id_str)]}},
+                {"title": 1, "filename": 1, "generated_title": 1}
+            )
+            for image in image_docs:
+                img_id_str = str(image["_id"])
+                chat_title = image.get("generated_title", image.get("title", image.get("filename", "Chat about Image")))
+                images[img_id_str] = {
+                    "chat_summary_title": chat_title,
+                    "url": f"/images/{img_id_str}/file"
+                }
+        except Exception as img_fetch_error:
+            logger.error(f"Error fetching image details for chat history: {img_fetch_error}")
+            for img_id_str in image_ids:
+                images[img_id_str] = {"chat_summary_title": "Error Fetching Title", "url": None}
+
         for img_id_str in image_ids:
-            try:
-                img_object_id = ObjectId(img_id_str)
-                image = mongo.db.images.find_one(
-                    {"_id": img_object_id},
-                    {"title": 1, "filename": 1, "generated_title": 1} 
-                )
-                if image:
-                    chat_title = image.get("generated_title", image.get("title", image.get("filename", "Chat about Image")))
-                    images[img_id_str] = {
-                        "chat_summary_title": chat_title,
-                        "url": f"/uploads/{image.get('filename', '')}" if image.get('filename') else None
-                    }
-                else:
-                     images[img_id_str] = {"chat_summary_title": "Image Deleted", "url": None}
-            except Exception as img_fetch_error:
-                 print(f"Error fetching image details for {img_id_str}: {img_fetch_error}")
-                 images[img_id_str] = {"chat_summary_title": "Error Fetching Title", "url": None}
+            images.setdefault(img_id_str, {"chat_summary_title": "Image Deleted", "url": None})
         
         formatted_history = []
         for chat in chat_history:
@@ -1075,15 +3169,76 @@ def get_chat_history():
                 "image_url": images.get(img_id, {}).get("url") if img_id else None
             }
             formatted_history.append(formatted_chat)
+
+        # Older messages remain when paging backwards and more were found, or whenever paging forwards
+        has_older = has_more if direction == -1 else True
+        has_newer = has_more if direction == 1 else bool(before)
+        first, last = (chat_history[0], chat_history[-1]) if chat_history else (None, None)
             
-        return jsonify({"chat_history": formatted_history}), 200
+        return jsonify({
+            "chat_history": formatted_history,
+            "has_more_before": has_older and first is not None,
+            "has_more_after": has_newer and last is not None,
+            "before_cursor": encode_cursor(first["timestamp"], first["_id"]) if first else None,
+            "after_cursor": encode_cursor(last["timestamp"], last["_id"]) if last else after,
+            "limit": limit
+        }), 200
         
     except Exception as e:
-        print(f"Error getting chat history: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error getting chat history: {str(e)}")
         return jsonify({"error": "Failed to get chat history"}), 500
 
-@app.route('/chat-history/<image_id>', methods=['DELETE'])
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Answer cache counters and size for this process"""
+    with answer_cache_lock:
+        stats = dict(answer_cache_stats)
+        stats["entries"] = len(answer_cache)
+    lookups = stats["hits"] + stats["mongo_hits"] + stats["misses"]
+    stats["hit_rate"] = round((stats["hits"] + stats["mongo_hits"]) / lookups, 4) if lookups else 0.0
+    stats["enabled"] = ANSWER_CACHE_CONFIG.get("enabled", False)
+    stats["mongo_enabled"] = ANSWER_CACHE_CONFIG.get("mongo_enabled", False)
+    return jsonify({"answer_cache": stats, "pid": os.getpid()}), 200
+
+@api.route('/chat-summaries', methods=['GET'])
+def get_chat_summaries():
+    """Get one row per image conversation for the sidebar, most recently active first"""
+    try:
+        user_id = request.args.get('user_id')
+
+        if not user_id:
+            return jsonify({"error": "User ID is required"}), 400
+
+        try:
+            # At least 1: Mongo treats limit(0) as no limit
+            limit = max(1, min(int(request.args.get('limit', PAGINATION_CONFIG.get("summary_default_limit", 50))), PAGINATION_CONFIG.get("max_limit", 100)))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+
+        summaries = mongo.db.conversationSummaries.find(
+            {"user_id": user_id}
+        ).sort("last_activity", -1).limit(limit)
+
+        formatted_summaries = []
+        for summary in summaries:
+            formatted_summaries.append({
+                "image_id": summary["image_id"],
+                "title": summary.get("title", "Chat about Image"),
+                "message_count": summary.get("message_count", 0),
+                "last_user_message": summary.get("last_user_message", ""),
+                "last_bot_message": summary.get("last_bot_message", ""),
+                "last_activity": summary["last_activity"].isoformat() if summary.get("last_activity") else None,
+                "image_url": f"/images/{summary['image_id']}/file",
+                "thumbnail_url": f"/images/{summary['image_id']}/file?size=thumb"
+            })
+
+        return jsonify({"conversations": formatted_summaries}), 200
+
+    except Exception as e:
+        logger.exception(f"Error getting chat summaries: {str(e)}")
+        return jsonify({"error": "Failed to get chat summaries"}), 500
+
+@api.route('/chat-history/<image_id>', methods=['DELETE'])
 def delete_chat_history(image_id):
     try:
         user_id = request.args.get('user_id')
@@ -1102,6 +3257,8 @@ def delete_chat_history(image_id):
             "user_id": user_id,
             "chat_history_id": {"$in": [str(chat["_id"]) for chat in mongo.db.chatHistory.find({"image_id": image_id})]}
         })
+
+        mongo.db.conversationSummaries.delete_one({"_id": f"{user_id}:{image_id}"})
         
         return jsonify({
             "message": "Chat history deleted successfully",
@@ -1109,11 +3266,10 @@ def delete_chat_history(image_id):
         }), 200
         
     except Exception as e:
-        print(f"Error deleting chat history: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error deleting chat history: {str(e)}")
         return jsonify({"error": "Failed to delete chat history"}), 500
 
-@app.route('/recommendations', methods=['GET'])
+@api.route('/recommendations', methods=['GET'])
 def get_recommendations():
     """Get personalized image recommendations for a user based on their activity"""
     try:
@@ -1188,6 +3344,7 @@ def get_recommendations():
                 img["file_id"] = str(img["file_id"]) if "file_id" in img else None
                 if "uploadTimestamp" in img:
                     img["uploadTimestamp"] = img["uploadTimestamp"].isoformat()
+                img["derivatives"] = serialize_derivatives(img["_id"], img.get("derivatives"))
                 img["recommendation_reason"] = "Based on images you've viewed"
                 recommendations.append(img)
         
@@ -1215,10 +3372,11 @@ def get_recommendations():
                     image["file_id"] = str(image["file_id"]) if "file_id" in image else None
                     if "uploadTimestamp" in image:
                         image["uploadTimestamp"] = image["uploadTimestamp"].isoformat()
+                    image["derivatives"] = serialize_derivatives(image["_id"], image.get("derivatives"))
                     image["recommendation_reason"] = f"Popular image with {item['view_count']} views"
                     recommendations.append(image)
             except Exception as e:
-                print(f"Error getting popular image {image_id}: {str(e)}")
+                logger.error(f"Error getting popular image {image_id}: {str(e)}")
         
         # 3. Recent uploads
         recent_uploads = list(mongo.db.images.find(
@@ -1250,6 +3408,7 @@ def get_recommendations():
                 img["file_id"] = str(img["file_id"]) if "file_id" in img else None
                 if "uploadTimestamp" in img:
                     img["uploadTimestamp"] = img["uploadTimestamp"].isoformat()
+                img["derivatives"] = serialize_derivatives(img["_id"], img.get("derivatives"))
                     
                 matching_topics = []
                 for topic in top_topic_words:
@@ -1275,11 +3434,10 @@ def get_recommendations():
         }), 200
         
     except Exception as e:
-        print(f"Error generating recommendations: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Error generating recommendations: {str(e)}")
         return jsonify({"error": "An error occurred generating recommendations", "details": str(e)}), 500
 
-@app.route('/user/update', methods=['PUT'])
+@api.route('/user/update', methods=['PUT'])
 def update_user():
     """Update user information"""
     try:
@@ -1322,10 +3480,10 @@ def update_user():
         }), 200
 
     except Exception as e:
-        print(f"Error updating user: {str(e)}")
+        logger.error(f"Error updating user: {str(e)}")
         return jsonify({"error": "An error occurred while updating user information"}), 500
 
-@app.route('/user/delete', methods=['DELETE'])
+@api.route('/user/delete', methods=['DELETE'])
 def delete_user():
     """Delete user account and associated data"""
     try:
@@ -1339,17 +3497,25 @@ def delete_user():
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        # Delete user's images
-        mongo.db.images.delete_many({"user_id": user_id})
+        # Delete user's images with their blobs and everything attached to them
+        for image in list(mongo.db.images.find({"user_id": user_id})):
+            delete_image_data(image)
         
         # Delete user's chat history
         mongo.db.chatHistory.delete_many({"user_id": user_id})
+        mongo.db.conversationSummaries.delete_many({"user_id": user_id})
         
         # Delete user's uploads
         mongo.db.uploadsImage.delete_many({"user_id": user_id})
         
-        # Delete user's image views
+        # Delete user's image views, and their counts from other users' images
+        mongo.db.imageViewStats.delete_many({"owner_id": user_id})
+        rollup_image_views(list(mongo.db.imageViews.find({"user_id": user_id}, {"image_id": 1, "timestamp": 1})), sign=-1)
         mongo.db.imageViews.delete_many({"user_id": user_id})
+
+        # Delete user's activity counters
+        mongo.db.userActivity.delete_one({"_id": user_id})
+        invalidate_activity_leaderboards()
         
         # Finally, delete the user
         result = mongo.db.users.delete_one({"_id": user_id})
@@ -1360,10 +3526,10 @@ def delete_user():
         return jsonify({"message": "User account and all associated data deleted successfully"}), 200
 
     except Exception as e:
-        print(f"Error deleting user: {str(e)}")
+        logger.error(f"Error deleting user: {str(e)}")
         return jsonify({"error": "An error occurred while deleting user account"}), 500
 
-@app.route('/test-db', methods=['GET'])
+@api.route('/test-db', methods=['GET'])
 def test_db():
     """Test MongoDB connection and chat history collection"""
     try:
@@ -1381,42 +3547,108 @@ def test_db():
         }), 200
         
     except Exception as e:
-        print(f"Database test error: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Database test error: {str(e)}")
         return jsonify({
             "status": "error",
             "mongo_connected": False,
             "error": str(e)
         }), 500
 
-@app.route('/debug_image_labels/<image_id>', methods=['GET'])
+@api.route('/debug_image_labels/<image_id>', methods=['GET'])
 def debug_image_labels(image_id):
     """Debug endpoint to check image labels and processing"""
     try:
-        print(f"\n=== Debugging Image Labels ===")
-        print(f"Image ID: {image_id}")
+        logger.debug("Debugging image labels")
+        logger.debug(f"Image ID: {image_id}")
         
         if not ObjectId.is_valid(image_id):
-            print("Invalid ObjectId format")
+            logger.warning("Invalid ObjectId format")
             return jsonify({"error": "Invalid image_id format"}), 400
             
         image_info = mongo.db.images.find_one({"_id": ObjectId(image_id)})
         if not image_info:
-            print("Image not found in database")
+            logger.warning("Image not found in database")
             return jsonify({"error": "Image not found"}), 404
             
-        print(f"Image found: {image_info.get('filename')}")
-        print(f"Labels: {image_info.get('labels')}")
-        print(f"Raw image info: {image_info}")
+        logger.debug(f"Image found: {image_info.get('filename')}")
+        logger.debug("Labels: %s", image_info.get('labels'))
+        logger.debug("Raw image info: %s", image_info)
         
         return jsonify({
             "labels": image_info.get('labels'),
             "raw": image_info
         }), 200
     except Exception as e:
-        print(f"Debug error: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"Debug error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def create_app():
+    """
+    Application factory. Creating the app never touches the network: the MongoDB client
+    and Gemini configuration are set up lazily in each process, and the database connection
+    is established (and retried) in the background. Serve with e.g. `flask --app app run`
+    or `gunicorn "app:create_app()"`.
+    """
+    app = Flask(__name__)
+    app.request_class = SpooledUploadRequest
+    CORS(app)
+
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+    app.register_blueprint(api)
+
+    @app.cli.command("ensure-indexes")
+    def ensure_indexes_command():
+        """Create all required MongoDB indexes."""
+        errors = ensure_indexes(mongo.db)
+        for index_error in errors:
+            print(f"Could not create index {index_error}")
+        print("Indexes are up to date" if not errors else f"{len(errors)} index(es) could not be created")
+
+    @app.cli.command("backfill-image-owners")
+    def backfill_image_owners_command():
+        """Denormalize uploadsImage.user_id onto images uploaded before it was stored there."""
+        print(f"Updated {backfill_image_owners()} image(s)")
+
+    @app.cli.command("backfill-conversation-summaries")
+    def backfill_conversation_summaries_command():
+        """Rebuild the sidebar's conversation summaries from chatHistory."""
+        print(f"Wrote {backfill_conversation_summaries()} conversation summar(ies)")
+
+    @app.cli.command("backfill-image-view-stats")
+    def backfill_image_view_stats_command():
+        """Rebuild the hourly, daily and total view rollups from imageViews."""
+        print(f"Rolled up {backfill_image_view_stats()} view(s)")
+
+    @app.cli.command("backfill-user-activity")
+    def backfill_user_activity_command():
+        """Rebuild the per-user view, upload and chat counters."""
+        print(f"Wrote activity counters for {backfill_user_activity()} user(s)")
+
+    @app.cli.command("explain-queries")
+    def explain_queries_command():
+        """Explain each route's queries and flag collection scans."""
+        results = explain_queries(mongo.db)
+        for result in results:
+            marker = "COLLSCAN" if result["collection_scan"] else "ok"
+            print(f"[{marker:>8}] {result['route']:<28} {result['collection']:<14} {' <- '.join(result['stages'])}  {result['filter']}")
+        scans = sum(1 for result in results if result["collection_scan"])
+        print(f"{len(results)} queries explained, {scans} collection scan(s)")
+        if scans:
+            raise SystemExit(1)
+
+    # Workers forked after create_app() start their own background services on first request
+    app.before_request(ensure_background_services)
+    ensure_background_services()
+
+    app.before_request(assign_request_id)
+    app.after_request(return_request_id)
+    app.teardown_request(clear_request_id)
+
+    app.before_request(start_metrics_timer)
+    app.after_request(record_request_metrics)
+
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
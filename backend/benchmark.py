@@ -0,0 +1,358 @@
+"""
+End-to-end benchmark for the chatbot API.
+
+Seeds a MongoDB database with users, images (with GridFS blobs and derivatives) and chat
+messages, then drives /upload, /chat, /images, /images/<id>, /chat-history and
+/recommendations at each requested concurrency level. Gemini is replaced by the mock
+provider (see providers.py), so runs are offline and repeatable. Results are printed (or
+written with --output) as JSON: throughput, error count and p50/p95/p99 latency per route
+and concurrency level.
+
+    python benchmark.py --concurrency 1,4,16 --requests 200
+    python benchmark.py --mongomock            # in-process MongoDB stand-in, needs `pip install mongomock`
+    python benchmark.py --url http://host:5000 # benchmark a running server sharing MONGODB_URI
+
+By default the app is served in-process and data goes to the chatbot_benchmark database
+on localhost (override with MONGODB_URI). --reset drops that database before seeding.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+
+# Select the mock model provider and a local database before app reads its configuration
+os.environ.setdefault("ENABLE_MOCK", "1")
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/chatbot_benchmark")
+
+import requests
+from PIL import Image, ImageDraw
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# The app's log handler writes to whatever sys.stdout is when app is imported; importing
+# under this redirect sends the logs to stderr and keeps stdout for the JSON report
+with contextlib.redirect_stdout(sys.stderr):
+    import app as chatbot
+from providers import MockProvider
+
+try:
+    import mongomock
+    import mongomock.gridfs
+except ImportError:
+    mongomock = None
+
+ROUTES = ["upload", "chat", "images", "image", "chat_history", "recommendations"]
+
+QUESTIONS = [
+    "What is in this image?",
+    "What colors are there?",
+    "Is there a person in the picture?",
+    "Where was this taken?",
+    "What is the main subject?",
+    "Describe the background.",
+]
+
+
+def make_image_bytes(rng, width=640, height=480):
+    """A JPEG with random colors and shapes, so every generated image has distinct bytes."""
+    image = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([x, y, x + rng.randrange(20, 200), y + rng.randrange(20, 200)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def use_mongomock():
+    """Point the app's MongoDB handle at an in-process mongomock client."""
+    if mongomock is None:
+        sys.exit("--mongomock needs the mongomock package: pip install mongomock")
+    mongomock.gridfs.enable_gridfs_integration()
+    chatbot.mongo._client = mongomock.MongoClient(chatbot.MONGO_CONFIG["uri"])
+    chatbot.mongo._pid = os.getpid()
+
+
+def seed_database(users, images_per_user, messages_per_image, rng):
+    """
+    Insert benchmark users, images and chat turns directly, the way /register, /upload and
+    /chat would store them. Returns the seeded user ids and image ids.
+    """
+    db = chatbot.mongo.db
+    seeded = {"users": [], "images": []}
+    now = datetime.now(timezone.utc)
+
+    for user_index in range(users):
+        user_id = f"bench-user-{user_index}"
+        db.users.replace_one({"_id": user_id}, {
+            "_id": user_id,
+            "username": f"bench{user_index}",
+            "email": f"bench{user_index}@example.com",
+            "password": "benchmark",
+            "created_at": now,
+            "last_login": None,
+            "preferences": {"theme": "light", "notifications_enabled": True}
+        }, upsert=True)
+        seeded["users"].append(user_id)
+
+        for image_index in range(images_per_user):
+            data = make_image_bytes(rng)
+            stream = io.BytesIO(data)
+            content_hash = chatbot.compute_content_hash(stream)
+            filename = f"bench_{user_index}_{image_index}.jpg"
+            image_part, _, derivatives = chatbot.prepare_image_for_vision(
+                stream, derivative_sizes=chatbot.UPLOAD_CONFIG.get("derivative_sizes")
+            )
+            analysis = chatbot.parse_structured_analysis(
+                chatbot.llm_gateway.provider.reply_text("vision", ["seed", image_part], True)
+            )
+
+            stream.seek(0)
+            file_id = chatbot.gridfs.GridFS(db).put(stream, filename=filename, content_type="image/jpeg",
+                                                    metadata={"content_hash": content_hash})
+            image_doc = {
+                "_id": chatbot.ObjectId(),
+                "file_id": file_id,
+                "user_id": user_id,
+                "filename": filename,
+                "title": filename,
+                "description": "",
+                "vision_description": analysis["description"],
+                "generated_title": analysis["title"],
+                "uploadTimestamp": now - timedelta(minutes=len(seeded["images"])),
+                "size": len(data),
+                "mime_type": "image/jpeg",
+                "content_hash": content_hash,
+                "analysis_status": "completed",
+                "labels": analysis["labels"],
+                "derivatives": chatbot.store_image_derivatives(derivatives, filename, content_hash)
+            }
+            db.images.insert_one(image_doc)
+            db.uploadsImage.insert_one({
+                "_id": f"bench-upload-{image_doc['_id']}",
+                "user_id": user_id,
+                "image_id": str(image_doc["_id"]),
+                "timestamp": image_doc["uploadTimestamp"]
+            })
+            seeded["images"].append(str(image_doc["_id"]))
+
+            for _ in range(messages_per_image // 2):
+                question = rng.choice(QUESTIONS)
+                chatbot.save_chat_turn(user_id, image_doc, question, f"Seeded answer to: {question}")
+
+    return seeded
+
+
+class Workload:
+    """Builds the request for one call to a benchmarked route."""
+
+    def __init__(self, base_url, seeded, seed):
+        self.base_url = base_url.rstrip("/")
+        self.seeded = seeded
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.sessions = threading.local()
+
+    def session(self):
+        if not hasattr(self.sessions, "session"):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def pick(self):
+        with self.rng_lock:
+            return (self.rng.choice(self.seeded["users"]), self.rng.choice(self.seeded["images"]),
+                    self.rng.choice(QUESTIONS), self.rng.randrange(2 ** 32))
+
+    def call(self, route):
+        """Issue one request to route; returns the HTTP status code and latency in milliseconds."""
+        user_id, image_id, question, image_seed = self.pick()
+        session = self.session()
+        url = self.base_url
+        # Generated before the clock starts, so image encoding is not counted as upload latency
+        data = make_image_bytes(random.Random(image_seed)) if route == "upload" else None
+        start = time.perf_counter()
+        if route == "upload":
+            response = session.post(f"{url}/upload", data={"user_id": user_id},
+                                    files={"file": (f"bench_{image_seed}.jpg", data, "image/jpeg")})
+        elif route == "chat":
+            response = session.post(f"{url}/chat", json={"message": question, "image_id": image_id, "user_id": user_id})
+        elif route == "images":
+            response = session.get(f"{url}/images", params={"user_id": user_id, "limit": 10})
+        elif route == "image":
+            response = session.get(f"{url}/images/{image_id}", params={"user_id": user_id})
+        elif route == "chat_history":
+            response = session.get(f"{url}/chat-history", params={"user_id": user_id, "image_id": image_id})
+        elif route == "recommendations":
+            response = session.get(f"{url}/recommendations", params={"user_id": user_id})
+        else:
+            raise ValueError(f"Unknown route: {route}")
+        return response.status_code, (time.perf_counter() - start) * 1000
+
+
+def run_level(workload, route, concurrency, total_requests):
+    """Send total_requests calls to route from concurrency threads and summarize latencies."""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one_call(_):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            status_code, elapsed = workload.call(route)
+            ok = status_code < 400
+        except requests.RequestException:
+            ok = False
+            elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_call, range(total_requests)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "route": route,
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(total_requests / duration, 2) if duration else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "max": round(latencies[-1], 2)
+        }
+    }
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Skip werkzeug's per-request access log, which would dominate benchmark output."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def start_server():
+    """Serve create_app() on a free local port in a background thread; returns its base URL."""
+    server = make_server("127.0.0.1", 0, chatbot.create_app(), threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def wait_until_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/status/ready", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    sys.exit(f"Server at {base_url} did not become ready within {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot API against the mock model provider.")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--images-per-user", type=int, default=5)
+    parser.add_argument("--messages-per-image", type=int, default=6)
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests per route and concurrency level")
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"comma-separated subset of {','.join(ROUTES)}")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mock-latency-scale", type=float, default=1.0,
+                        help="multiply the mock provider's median latencies (0 for no simulated latency)")
+    parser.add_argument("--url", help="benchmark an already running server instead of an in-process one")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-process mongomock database")
+    parser.add_argument("--reset", action="store_true", help="drop the benchmark database before seeding")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown route(s): {', '.join(sorted(unknown))}")
+    if args.url and args.mongomock:
+        parser.error("--mongomock only works with the in-process server")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    for latency in list(chatbot.MOCK_CONFIG["latency"].values()) + [chatbot.MOCK_CONFIG["default_latency"]]:
+        latency["median"] *= args.mock_latency_scale
+    chatbot.MOCK_CONFIG["seed"] = args.seed
+    if isinstance(chatbot.llm_gateway.provider, MockProvider):
+        # The provider seeded its random generator when app was imported, before --seed was known
+        chatbot.llm_gateway.provider = MockProvider(chatbot.MOCK_CONFIG)
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.mongomock:
+            use_mongomock()
+        if args.reset:
+            chatbot.mongo.client.drop_database(chatbot.mongo.db.name)
+
+        seed_started = time.perf_counter()
+        seeded = seed_database(args.users, args.images_per_user, args.messages_per_image, random.Random(args.seed))
+        seed_duration = time.perf_counter() - seed_started
+
+        base_url = args.url or start_server()
+        wait_until_ready(base_url)
+
+        workload = Workload(base_url, seeded, args.seed)
+        results = []
+        for route in routes:
+            for concurrency in levels:
+                results.append(run_level(workload, route, concurrency, args.requests))
+                print(f"{route:<16} c={concurrency:<4} p50={results[-1]['latency_ms']['p50']}ms "
+                      f"p99={results[-1]['latency_ms']['p99']}ms rps={results[-1]['throughput_rps']}")
+
+    report = {
+        "started_at": started_at,
+        "config": {
+            "users": args.users,
+            "images_per_user": args.images_per_user,
+            "messages_per_image": args.messages_per_image,
+            "concurrency": levels,
+            "requests_per_level": args.requests,
+            "seed": args.seed,
+            "mock_latency_scale": args.mock_latency_scale,
+            "database": "mongomock" if args.mongomock else chatbot.mongo.db.name,
+            "server": args.url or "in-process"
+        },
+        "seed_duration_s": round(seed_duration, 3),
+        "results": results
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
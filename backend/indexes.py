@@ -0,0 +1,195 @@
+"""
+MongoDB index management for the image chatbot backend.
+
+ensure_indexes() creates every index the routes in app.py rely on. It is idempotent
+(create_indexes is a no-op for indexes that already exist) and runs whenever a process
+first connects to the database.
+
+explain_queries() runs explain() on the queries each route issues and flags any whose
+winning plan is a collection scan. Run it with `flask --app app explain-queries`.
+"""
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# Indexes required by the queries in app.py, per collection
+REQUIRED_INDEXES = {
+    "users": [
+        # Register checks for an existing email and login looks users up by email
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "images": [
+        IndexModel([("content_hash", ASCENDING), ("uploadTimestamp", DESCENDING)], name="content_hash_uploadTimestamp"),
+        IndexModel([("file_id", ASCENDING)], name="file_id"),
+        # Deleting an image checks whether another image shares each derivative blob; one index
+        # per name in UPLOAD_CONFIG["derivative_sizes"]
+        IndexModel([("derivatives.thumb.file_id", ASCENDING)], name="derivatives_thumb_file_id"),
+        IndexModel([("derivatives.medium.file_id", ASCENDING)], name="derivatives_medium_file_id"),
+        # Keyset pagination on /images, for all images and per owner
+        IndexModel([("uploadTimestamp", DESCENDING), ("_id", DESCENDING)], name="uploadTimestamp_id"),
+        IndexModel([("user_id", ASCENDING), ("uploadTimestamp", DESCENDING), ("_id", DESCENDING)], name="user_id_uploadTimestamp_id"),
+    ],
+    "chatHistory": [
+        # Keyset pagination on /chat-history, for all of a user's messages and per image
+        IndexModel([("user_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)], name="user_id_timestamp_id"),
+        IndexModel([("user_id", ASCENDING), ("image_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="user_id_image_id_timestamp_id"),
+        IndexModel([("image_id", ASCENDING)], name="image_id"),
+    ],
+    "uploadsImage": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)], name="user_id_timestamp"),
+        IndexModel([("image_id", ASCENDING)], name="image_id"),
+    ],
+    "imageViews": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)], name="user_id_timestamp"),
+        IndexModel([("image_id", ASCENDING)], name="image_id"),
+    ],
+    "imageViewStats": [
+        # _id is "<image_id>:<granularity>[:<bucket>]"; /analytics/images reads one granularity over a window
+        IndexModel([("granularity", ASCENDING), ("bucket", ASCENDING)], name="granularity_bucket"),
+        IndexModel([("owner_id", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING)], name="owner_id_granularity_bucket"),
+        IndexModel([("image_id", ASCENDING)], name="image_id"),
+        # Hourly buckets carry expires_at and are removed once it passes
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "userActivity": [
+        # _id is the user id; each /analytics/user-activity leaderboard reads the top of one counter
+        IndexModel([("view_count", DESCENDING)], name="view_count"),
+        IndexModel([("upload_count", DESCENDING)], name="upload_count"),
+        IndexModel([("chat_count", DESCENDING)], name="chat_count"),
+    ],
+    "conversationSummaries": [
+        # _id is "<user_id>:<image_id>"; the sidebar lists a user's conversations by recency
+        IndexModel([("user_id", ASCENDING), ("last_activity", DESCENDING)], name="user_id_last_activity"),
+        IndexModel([("image_id", ASCENDING)], name="image_id"),
+    ],
+    "answerCache": [
+        # Documents are removed once expires_at passes
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+        IndexModel([("image_id", ASCENDING)], name="image_id"),
+    ],
+    "uploadJobs": [
+        # Duplicate uploads attach to the active job for their bytes; stale jobs are requeued at startup
+        IndexModel([("content_hash", ASCENDING), ("status", ASCENDING)], name="content_hash_status"),
+        IndexModel([("status", ASCENDING), ("updated_at", ASCENDING)], name="status_updated_at"),
+    ],
+    "user_chat": [
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        IndexModel([("chat_history_id", ASCENDING)], name="chat_history_id"),
+    ],
+}
+
+# Representative find() queries issued by each route. Values only need the right type
+# for the planner to choose an index.
+SAMPLE_ID = "00000000-0000-0000-0000-000000000000"
+SAMPLE_OBJECT_ID = ObjectId("000000000000000000000000")
+SAMPLE_TIMESTAMP = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+ROUTE_QUERIES = [
+    {"route": "POST /register", "collection": "users", "filter": {"email": "user@example.com"}},
+    {"route": "POST /login", "collection": "users", "filter": {"email": "user@example.com", "password": "x"}},
+    {"route": "GET /user/profile", "collection": "user_chat", "filter": {"user_id": SAMPLE_ID}},
+    {"route": "POST /upload", "collection": "images",
+     "filter": {"content_hash": "0" * 64, "file_id": {"$exists": True}}, "sort": [("uploadTimestamp", DESCENDING)]},
+    {"route": "POST /upload", "collection": "uploadJobs",
+     "filter": {"content_hash": "0" * 64, "status": {"$in": ["queued", "processing"]}}},
+    {"route": "GET /images", "collection": "images",
+     "filter": {}, "sort": [("uploadTimestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"route": "GET /images", "collection": "images",
+     "filter": {"user_id": SAMPLE_ID, "$or": [{"uploadTimestamp": {"$lt": SAMPLE_TIMESTAMP}},
+                                              {"uploadTimestamp": SAMPLE_TIMESTAMP, "_id": {"$lt": SAMPLE_OBJECT_ID}}]},
+     "sort": [("uploadTimestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"route": "DELETE /image/<id>", "collection": "images",
+     "filter": {"file_id": SAMPLE_OBJECT_ID, "_id": {"$ne": SAMPLE_OBJECT_ID}}},
+    {"route": "DELETE /image/<id>", "collection": "images",
+     "filter": {"derivatives.thumb.file_id": SAMPLE_OBJECT_ID, "_id": {"$ne": SAMPLE_OBJECT_ID}}},
+    {"route": "DELETE /image/<id>", "collection": "images",
+     "filter": {"derivatives.medium.file_id": SAMPLE_OBJECT_ID, "_id": {"$ne": SAMPLE_OBJECT_ID}}},
+    {"route": "DELETE /image/<id>", "collection": "uploadsImage", "filter": {"image_id": str(SAMPLE_OBJECT_ID)}},
+    {"route": "DELETE /image/<id>", "collection": "imageViews", "filter": {"image_id": str(SAMPLE_OBJECT_ID)}},
+    {"route": "DELETE /image/<id>", "collection": "chatHistory", "filter": {"image_id": str(SAMPLE_OBJECT_ID)}},
+    {"route": "DELETE /image/<id>", "collection": "user_chat", "filter": {"chat_history_id": {"$in": [SAMPLE_OBJECT_ID]}}},
+    {"route": "GET /analytics/images", "collection": "imageViewStats",
+     "filter": {"granularity": "hour", "bucket": {"$gte": SAMPLE_TIMESTAMP}}},
+    {"route": "GET /analytics/images", "collection": "imageViewStats",
+     "filter": {"owner_id": SAMPLE_ID, "granularity": "day", "bucket": {"$gte": SAMPLE_TIMESTAMP}}},
+    {"route": "DELETE /user/delete", "collection": "imageViewStats", "filter": {"owner_id": SAMPLE_ID}},
+    {"route": "GET /analytics/user-activity", "collection": "userActivity",
+     "filter": {"view_count": {"$gt": 0}}, "sort": [("view_count", DESCENDING)]},
+    {"route": "GET /analytics/user-activity", "collection": "userActivity",
+     "filter": {"upload_count": {"$gt": 0}}, "sort": [("upload_count", DESCENDING)]},
+    {"route": "GET /analytics/user-activity", "collection": "userActivity",
+     "filter": {"chat_count": {"$gt": 0}}, "sort": [("chat_count", DESCENDING)]},
+    {"route": "GET /chat-history", "collection": "chatHistory",
+     "filter": {"user_id": SAMPLE_ID, "timestamp": {"$type": "date"}}, "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"route": "GET /chat-history", "collection": "chatHistory",
+     "filter": {"user_id": SAMPLE_ID, "timestamp": {"$type": "date"}, "image_id": str(SAMPLE_OBJECT_ID),
+                "$or": [{"timestamp": {"$lt": SAMPLE_TIMESTAMP}},
+                        {"timestamp": SAMPLE_TIMESTAMP, "_id": {"$lt": SAMPLE_OBJECT_ID}}]},
+     "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"route": "DELETE /chat-history/<id>", "collection": "chatHistory",
+     "filter": {"user_id": SAMPLE_ID, "image_id": str(SAMPLE_OBJECT_ID)}},
+    {"route": "GET /chat-summaries", "collection": "conversationSummaries",
+     "filter": {"user_id": SAMPLE_ID}, "sort": [("last_activity", DESCENDING)]},
+    {"route": "GET /recommendations", "collection": "imageViews",
+     "filter": {"user_id": SAMPLE_ID}, "sort": [("timestamp", DESCENDING)]},
+    {"route": "GET /recommendations", "collection": "chatHistory",
+     "filter": {"user_id": SAMPLE_ID}, "sort": [("timestamp", DESCENDING)]},
+    {"route": "GET /recommendations", "collection": "images",
+     "filter": {"_id": {"$nin": [SAMPLE_OBJECT_ID]}}, "sort": [("uploadTimestamp", DESCENDING)]},
+    {"route": "DELETE /user/delete", "collection": "images", "filter": {"user_id": SAMPLE_ID}},
+]
+
+
+def ensure_indexes(db):
+    """
+    Create all REQUIRED_INDEXES on db.
+    Returns a list of error messages for indexes that could not be built (for example a
+    unique index over existing duplicate values); the remaining indexes are still created.
+    """
+    errors = []
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        for index in indexes:
+            try:
+                db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                errors.append(f"{collection_name}.{index.document['name']}: {e}")
+    return errors
+
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree."""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan", "winningPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+
+def explain_queries(db):
+    """
+    Run explain() for every query in ROUTE_QUERIES.
+    Returns one result per query with the route, collection, the winning plan's stages and
+    whether the plan contains a collection scan.
+    """
+    results = []
+    for query in ROUTE_QUERIES:
+        cursor = db[query["collection"]].find(query["filter"])
+        if query.get("sort"):
+            cursor = cursor.sort(query["sort"])
+        explanation = cursor.explain()
+        stages = list(_plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {})))
+        results.append({
+            "route": query["route"],
+            "collection": query["collection"],
+            "filter": str(query["filter"]),
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages,
+        })
+    return results
@@ -0,0 +1,242 @@
+"""
+Single entry point for Gemini model calls.
+
+LLMGateway wraps a model provider (see providers.py) with:
+- a per-call deadline, passed to the provider as its timeout
+- retries with jittered exponential backoff, only for errors that are worth retrying
+- a cap on in-flight calls, so a slow provider cannot tie up every request thread
+- a circuit breaker that fails fast while the provider is down
+
+Every call is labelled with a call site ("vision", "title", "chat", "summary") for
+per-site deadlines and counters.
+"""
+import random
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+# Errors that mean "try again later" rather than "this request is wrong"
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class LLMUnavailableError(Exception):
+    """Raised without calling the provider: the circuit is open or too many calls are in flight."""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for cooldown seconds.
+    After the cooldown one trial call is let through; its result closes or reopens the circuit.
+    """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    def rejects_now(self):
+        """True while the circuit is open and its cooldown has not passed: calls can fail without waiting."""
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_in_progress:
+                return False
+            self.trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def release_trial(self):
+        """Give back a trial slot taken by allow() when the call ended without a verdict on the provider."""
+        with self.lock:
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.trial_in_progress or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_progress = False
+
+
+class LLMGateway:
+    """
+    Makes model calls on behalf of the app. config is a dictionary like
+    LLM_GATEWAY_CONFIG in app.py; provider is a GeminiProvider or MockProvider.
+    observer, if given, is told when calls start, finish, retry or are rejected
+    (see LLMCallMetrics in metrics.py).
+    """
+
+    def __init__(self, config, provider, observer=None):
+        self.config = config
+        self.provider = provider
+        self.observer = observer
+        self.in_flight = threading.BoundedSemaphore(config.get("max_in_flight", 8))
+        self.circuit = CircuitBreaker(config.get("failure_threshold", 5), config.get("circuit_cooldown", 30))
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def record(self, call_site, name, amount=1):
+        with self.stats_lock:
+            site_stats = self.stats.setdefault(call_site, {
+                "calls": 0, "successes": 0, "failures": 0, "retries": 0, "rejected": 0, "in_flight": 0
+            })
+            site_stats[name] += amount
+
+    def record_failure(self, call_site, error):
+        """Count a failed call. Only provider-side errors count towards opening the circuit."""
+        self.record(call_site, "failures")
+        if isinstance(error, RETRYABLE_ERRORS):
+            self.circuit.record_failure()
+        else:
+            # The provider answered (e.g. rejected the request), so it is up
+            self.circuit.record_success()
+
+    def get_stats(self):
+        """Per call site counters and the circuit state."""
+        with self.stats_lock:
+            stats = {call_site: dict(site_stats) for call_site, site_stats in self.stats.items()}
+        return {"circuit": self.circuit.state, "call_sites": stats}
+
+    def timeout_for(self, call_site):
+        return self.config.get("timeouts", {}).get(call_site, self.config.get("default_timeout", 30))
+
+    def acquire(self, call_site):
+        """Check the circuit and take an in-flight slot, or raise LLMUnavailableError."""
+        # Fail fast while the circuit is open, without queueing behind calls to a dead provider
+        if self.circuit.rejects_now():
+            self.reject(call_site)
+            raise LLMUnavailableError("LLM provider circuit is open; failing fast")
+        # A half-open circuit only hands out its trial once the slot is held, to a call that will run
+        if not self.in_flight.acquire(timeout=self.config.get("queue_timeout", 5)):
+            self.reject(call_site)
+            raise LLMUnavailableError("Too many LLM calls in flight")
+        if not self.circuit.allow():
+            self.in_flight.release()
+            self.reject(call_site)
+            raise LLMUnavailableError("LLM provider circuit is open; failing fast")
+        self.record(call_site, "in_flight")
+        self.record(call_site, "calls")
+        if self.observer:
+            self.observer.call_started(call_site)
+        return time.monotonic()
+
+    def reject(self, call_site):
+        self.record(call_site, "rejected")
+        if self.observer:
+            self.observer.call_rejected(call_site)
+
+    def release(self, call_site, started_at, error=None):
+        self.record(call_site, "in_flight", -1)
+        self.in_flight.release()
+        if self.observer:
+            self.observer.call_finished(call_site, time.monotonic() - started_at, error)
+
+    def call_with_retries(self, call_site, send):
+        """
+        Call send(timeout) until it succeeds, a non-retryable error is raised, the retry
+        budget is spent or the call site's deadline would be passed.
+        """
+        timeout = self.timeout_for(call_site)
+        deadline = time.monotonic() + timeout
+        max_retries = self.config.get("max_retries", 2)
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                return send(max(remaining, 1))
+            except RETRYABLE_ERRORS:
+                delay = random.uniform(0, min(self.config.get("retry_max_delay", 4),
+                                              self.config.get("retry_initial_delay", 0.5) * (2 ** attempt)))
+                if attempt >= max_retries or time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                self.record(call_site, "retries")
+                if self.observer:
+                    self.observer.call_retried(call_site)
+                time.sleep(delay)
+
+    def generate_content(self, call_site, contents, model_name, json_mode=False):
+        """
+        Return model_name's response to contents, subject to the gateway's policies.
+        json_mode asks the model to reply with JSON only.
+        """
+        started_at = self.acquire(call_site)
+        error = None
+        try:
+            response = self.call_with_retries(
+                call_site,
+                lambda timeout: self.provider.generate(call_site, model_name, contents, timeout, json_mode=json_mode)
+            )
+        except Exception as e:
+            error = e
+            self.record_failure(call_site, e)
+            raise
+        except BaseException:
+            self.circuit.release_trial()
+            raise
+        finally:
+            self.release(call_site, started_at, error)
+        self.record(call_site, "successes")
+        self.circuit.record_success()
+        return response
+
+    def stream_content(self, call_site, contents, model_name):
+        """
+        Yield the chunks of a streaming generate_content call. Opening the stream is retried;
+        an error after the first chunk is raised to the caller. The in-flight slot is held
+        until the stream is exhausted or closed.
+        """
+        started_at = self.acquire(call_site)
+        error = None
+        try:
+            response = self.call_with_retries(
+                call_site,
+                lambda timeout: self.provider.generate(call_site, model_name, contents, timeout, stream=True)
+            )
+            for chunk in response:
+                yield chunk
+        except Exception as e:
+            error = e
+            self.record_failure(call_site, e)
+            raise
+        except BaseException:
+            # Closed early by the consumer (GeneratorExit): say nothing about the provider's health,
+            # but free a half-open trial so the next call can try again
+            self.circuit.release_trial()
+            raise
+        finally:
+            self.release(call_site, started_at, error)
+        self.record(call_site, "successes")
+        self.circuit.record_success()
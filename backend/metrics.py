@@ -0,0 +1,138 @@
+"""
+Prometheus metrics for the chatbot backend, served by GET /metrics.
+
+- HTTP request latency per Flask route template, method and status code
+- MongoDB command latency per command name, through pymongo command monitoring
+- LLM call latency, errors, retries, rejections and in-flight calls per call site
+  (vision, title, chat, summary), reported by the LLM gateway
+- Events flushed, dropped and failed by write-behind buffers (image views)
+- Image bytes before and after vision preprocessing
+
+Metrics are per process. Under a multi-process server (gunicorn workers), set
+PROMETHEUS_MULTIPROC_DIR to a shared empty directory so /metrics aggregates all workers.
+"""
+import os
+import time
+
+from pymongo import monitoring
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Model calls take seconds; HTTP and MongoDB latencies are mostly milliseconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to build the response for a request",
+    ["route", "method", "status"], buckets=REQUEST_BUCKETS
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round-trip time",
+    ["command"], buckets=MONGO_BUCKETS
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongodb_command_failures_total", "MongoDB commands that returned an error", ["command"]
+)
+LLM_CALL_DURATION = Histogram(
+    "llm_call_duration_seconds", "LLM call time including retries, by call site and outcome",
+    ["call_site", "outcome"], buckets=LLM_BUCKETS
+)
+LLM_CALL_ERRORS = Counter(
+    "llm_call_errors_total", "Failed LLM calls by call site and error type", ["call_site", "error"]
+)
+LLM_CALL_RETRIES = Counter(
+    "llm_call_retries_total", "LLM call attempts retried after a retryable error", ["call_site"]
+)
+LLM_CALL_REJECTED = Counter(
+    "llm_call_rejected_total", "LLM calls refused by the circuit breaker or concurrency limit", ["call_site"]
+)
+LLM_CALLS_IN_FLIGHT = Gauge(
+    "llm_calls_in_flight", "LLM calls currently in progress", ["call_site"], multiprocess_mode="livesum"
+)
+WRITE_BEHIND_EVENTS = Counter(
+    "write_behind_events_total", "Events handled by a write-behind buffer, by outcome (flushed, dropped, failed)",
+    ["buffer", "outcome"]
+)
+VISION_PREPROCESS_CALLS = Counter(
+    "vision_preprocess_calls_total", "Images prepared for the vision model"
+)
+VISION_PREPROCESS_BYTES = Counter(
+    "vision_preprocess_bytes_total", "Image bytes before (original) and after (sent) vision preprocessing", ["stage"]
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records every MongoDB command's duration; register with MongoClient(event_listeners=[...])."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_DURATION.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_DURATION.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+
+
+class LLMCallMetrics:
+    """Observer passed to LLMGateway; the gateway reports each call's lifecycle here."""
+
+    def call_started(self, call_site):
+        LLM_CALLS_IN_FLIGHT.labels(call_site).inc()
+
+    def call_finished(self, call_site, duration, error=None):
+        LLM_CALLS_IN_FLIGHT.labels(call_site).dec()
+        LLM_CALL_DURATION.labels(call_site, "error" if error else "success").observe(duration)
+        if error:
+            LLM_CALL_ERRORS.labels(call_site, type(error).__name__).inc()
+
+    def call_retried(self, call_site):
+        LLM_CALL_RETRIES.labels(call_site).inc()
+
+    def call_rejected(self, call_site):
+        LLM_CALL_REJECTED.labels(call_site).inc()
+
+
+class WriteBehindMetrics:
+    """Observer passed to WriteBehindBuffer."""
+
+    def events_flushed(self, buffer, count):
+        WRITE_BEHIND_EVENTS.labels(buffer, "flushed").inc(count)
+
+    def events_dropped(self, buffer, count):
+        WRITE_BEHIND_EVENTS.labels(buffer, "dropped").inc(count)
+
+    def events_failed(self, buffer, count):
+        WRITE_BEHIND_EVENTS.labels(buffer, "failed").inc(count)
+
+
+def start_request_timer(request_state):
+    """Call at the start of a request with a per-request namespace such as flask.g."""
+    request_state.metrics_started_at = time.perf_counter()
+
+
+def observe_request(request_state, rule, method, status_code):
+    """Record a finished request. rule is the matched URL rule template, or None for unmatched URLs."""
+    started_at = getattr(request_state, "metrics_started_at", None)
+    if started_at is None:
+        return
+    HTTP_REQUEST_DURATION.labels(rule or "unmatched", method, str(status_code)).observe(time.perf_counter() - started_at)
+
+
+def observe_vision_preprocess(original_bytes, sent_bytes):
+    """Record one image prepared for the vision model."""
+    VISION_PREPROCESS_CALLS.inc()
+    VISION_PREPROCESS_BYTES.labels("original").inc(original_bytes)
+    VISION_PREPROCESS_BYTES.labels("sent").inc(sent_bytes)
+
+
+def render_metrics():
+    """Return (body, content_type) for the Prometheus text exposition of all metrics."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,172 @@
+"""
+Model providers behind the LLM gateway.
+
+A provider turns one model call into a response: generate(call_site, model_name, contents,
+timeout, stream=False, json_mode=False). Responses expose .text like Gemini's; with
+stream=True an iterable of such chunks is returned.
+
+GeminiProvider calls Google's API. MockProvider answers locally with deterministic
+descriptions, titles and chat replies derived from the request, and simulates latency and
+failures from MOCK_CONFIG in app.py, so load tests and benchmarks run offline and repeat.
+"""
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+import google.generativeai as genai
+
+
+class ProviderUnavailableError(ConnectionError):
+    """Simulated provider outage; retryable like any connection error."""
+
+
+class GeminiProvider:
+    """Calls Gemini through google.generativeai, reusing one model client per process and model."""
+
+    def __init__(self, configure=None):
+        self.configure = configure
+        self.models = {}
+        self.models_lock = threading.Lock()
+
+    def get_model(self, model_name):
+        key = (os.getpid(), model_name)
+        with self.models_lock:
+            model = self.models.get(key)
+            if model is None:
+                if self.configure:
+                    self.configure()
+                model = genai.GenerativeModel(model_name)
+                self.models[key] = model
+            return model
+
+    def generate(self, call_site, model_name, contents, timeout, stream=False, json_mode=False):
+        options = {"request_options": {"timeout": timeout}}
+        if stream:
+            options["stream"] = True
+        if json_mode:
+            options["generation_config"] = {"response_mime_type": "application/json"}
+        return self.get_model(model_name).generate_content(contents, **options)
+
+
+class MockResponse:
+    """Stands in for a Gemini response or stream chunk."""
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        self.candidates = []
+        self.prompt_feedback = None
+
+
+MOCK_SUBJECTS = ["a red bicycle", "a golden retriever", "a city skyline", "a bowl of fruit", "a mountain lake",
+                 "a vintage car", "a cup of coffee", "a sunflower field", "a lighthouse", "a street market"]
+MOCK_SETTINGS = ["at sunset", "on a rainy street", "in a bright kitchen", "under a clear blue sky",
+                 "in soft morning light", "beside a wooden fence", "in a busy park", "on a snowy day"]
+MOCK_DETAILS = ["People walk in the background.", "The colors are warm and saturated.",
+                "A small sign is partly visible on the left.", "The foreground is slightly out of focus.",
+                "Shadows fall across the lower half of the frame.", "Trees frame both sides of the scene."]
+
+
+def text_after(contents, marker):
+    """Prompt text following the last occurrence of marker, or "" if it is absent."""
+    text = "\n".join(part for part in (contents if isinstance(contents, list) else [contents]) if isinstance(part, str))
+    position = text.rfind(marker)
+    return text[position + len(marker):] if position != -1 else ""
+
+
+class MockProvider:
+    """
+    Deterministic offline provider. The reply depends only on the request (the same image or
+    question always gets the same answer). Latency and failures are drawn from one random
+    generator seeded by config["seed"], so a run with the same sequence of calls repeats exactly.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.get("seed", 0))
+        self.random_lock = threading.Lock()
+
+    def digest(self, contents):
+        """Stable hash of a request's prompt text and image bytes."""
+        sha256 = hashlib.sha256()
+        for part in contents if isinstance(contents, list) else [contents]:
+            if isinstance(part, dict):
+                sha256.update(part.get("data", b""))
+            else:
+                sha256.update(str(part).encode("utf-8"))
+        return int(sha256.hexdigest(), 16)
+
+    def simulate_call(self, call_site, timeout):
+        """Sleep for a simulated latency, then maybe raise a simulated failure."""
+        latency = self.config.get("latency", {}).get(call_site, self.config.get("default_latency", {}))
+        with self.random_lock:
+            # Log-normal around the median, like real model latencies
+            delay = latency.get("median", 0.5) * math.exp(latency.get("sigma", 0.0) * self.random.gauss(0, 1))
+            roll = self.random.random()
+        error_rate = self.config.get("error_rate", 0.0)
+        timeout_rate = self.config.get("timeout_rate", 0.0)
+
+        if roll < timeout_rate:
+            time.sleep(timeout)
+            raise TimeoutError(f"Mock {call_site} call timed out after {timeout:.1f}s")
+        time.sleep(min(delay, timeout))
+        if delay > timeout:
+            raise TimeoutError(f"Mock {call_site} call timed out after {timeout:.1f}s")
+        if roll < timeout_rate + error_rate:
+            raise ProviderUnavailableError(f"Mock {call_site} provider error")
+
+    def describe(self, contents):
+        """
+        Pick the subject and setting for a reply. Title, chat and summary prompts embed an
+        earlier mock description, so its subject and setting are reused to stay consistent.
+        """
+        seed = self.digest(contents)
+        text = " ".join(part for part in (contents if isinstance(contents, list) else [contents]) if isinstance(part, str))
+        subject = next((s for s in MOCK_SUBJECTS if s in text), MOCK_SUBJECTS[seed % len(MOCK_SUBJECTS)])
+        setting = next((s for s in MOCK_SETTINGS if s in text), MOCK_SETTINGS[(seed // 7) % len(MOCK_SETTINGS)])
+        detail = MOCK_DETAILS[(seed // 59) % len(MOCK_DETAILS)]
+        return seed, subject, setting, f"The image shows {subject} {setting}. {detail}"
+
+    def reply_text(self, call_site, contents, json_mode):
+        seed, subject, setting, description = self.describe(contents)
+        if call_site == "vision":
+            if json_mode:
+                return json.dumps({
+                    "description": description,
+                    "title": f"{subject[2:].title()} {setting.split()[-1].title()}",
+                    "labels": [word for word in subject.split() if len(word) > 2] + [setting.split()[-1]]
+                })
+            return description
+        if call_site == "title":
+            return f"{subject[2:].title()} {setting.split()[-1].title()}"
+        if call_site == "summary":
+            return f"The user asked about {subject} and the assistant answered from the image description."
+        if json_mode:
+            # Multi-question chat prompt: one answer per numbered question after "User's questions:"
+            questions = re.findall(r"^\d+\. (.*)$", text_after(contents, "User's questions:"), re.MULTILINE)
+            return json.dumps({"answers": [
+                f"From the description, this looks like {subject} {setting}. "
+                f"{MOCK_DETAILS[self.digest([question]) % len(MOCK_DETAILS)]}"
+                for question in questions
+            ]})
+        return f"From the description, this looks like {subject} {setting}. {MOCK_DETAILS[(seed // 3) % len(MOCK_DETAILS)]}"
+
+    def generate(self, call_site, model_name, contents, timeout, stream=False, json_mode=False):
+        self.simulate_call(call_site, timeout)
+        text = self.reply_text(call_site, contents, json_mode)
+        if not stream:
+            return MockResponse(text)
+        return self.stream_chunks(text)
+
+    def stream_chunks(self, text):
+        words = text.split(" ")
+        chunk_words = self.config.get("stream_chunk_words", 4)
+        for start in range(0, len(words), chunk_words):
+            if start:
+                time.sleep(self.config.get("stream_chunk_delay", 0.05))
+            yield MockResponse(" ".join(words[start:start + chunk_words]) + (" " if start + chunk_words < len(words) else ""))
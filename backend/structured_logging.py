@@ -0,0 +1,154 @@
+"""
+Structured, non-blocking logging for the chatbot backend.
+
+Records go through a QueueHandler to a background QueueListener, so request threads never
+wait on stdout: they only format the message and put it on a bounded queue. When the queue
+is full records are dropped and counted instead of blocking. The listener writes one JSON
+object per line.
+
+Each record carries the current request id (set per request, and carried into background
+upload jobs and streaming threads), so one upload's analysis, title and GridFS steps can be
+followed across threads. High-volume events can be sampled: log with extra={"event": name}
+and set a rate for that name in the sample_rates config.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed through extra= and is logged as a field
+STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp each record with the request id of the thread (or context) that logged it."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of records for events listed in sample_rates; warnings and errors are always kept."""
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.sample_rates.get(getattr(record, "event", None))
+        if rate is None:
+            return True
+        return random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full and leaves JSON formatting to the listener."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve the message and traceback now, while args and frames are still valid;
+        # the expensive JSON formatting and the write happen on the listener thread.
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, request_id, extra fields, exception."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.msg if record.args is None else record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LogPipeline:
+    """
+    Owns the queue handler and its listener thread. The listener is started per process
+    (a thread does not survive fork), so pre-fork servers call start() in each worker.
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.listener_pid = None
+        self.lock = threading.Lock()
+
+    def configure(self, logger_name, config):
+        """Route logger_name's records through a bounded queue; call once at startup."""
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(config.get("level", "INFO"))
+        logger.propagate = False
+        if self.handler is None:
+            self.handler = NonBlockingQueueHandler(queue.Queue(maxsize=config.get("queue_size", 10000)))
+            self.handler.addFilter(RequestIdFilter())
+            self.handler.addFilter(SamplingFilter(config.get("sample_rates", {})))
+            logger.addHandler(self.handler)
+        self.output = logging.StreamHandler(sys.stdout)
+        if config.get("format", "json") == "json":
+            self.output.setFormatter(JsonFormatter())
+        else:
+            self.output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+        return logger
+
+    def start(self):
+        """Start this process's listener thread if it is not running yet."""
+        if self.handler is None or self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid == os.getpid():
+                return
+            if self.listener_pid is not None:
+                # Forked from a process whose listener was running: its queue's locks may be held
+                self.handler.queue = queue.Queue(maxsize=self.handler.queue.maxsize)
+            self.listener = logging.handlers.QueueListener(self.handler.queue, self.output, respect_handler_level=True)
+            self.listener.start()
+            self.listener_pid = os.getpid()
+            # Flush what is still queued when the process exits
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None and self.listener_pid == os.getpid():
+            self.listener.stop()
+            self.listener_pid = None
+
+    @property
+    def dropped(self):
+        return self.handler.dropped if self.handler else 0
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from llm_gateway import LLMGateway, LLMUnavailableError
+
+
+class FakeProvider:
+    """Provider whose calls fail while failing is set, and can be held open until release is set."""
+
+    def __init__(self):
+        self.failing = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def generate(self, call_site, model_name, contents, timeout, stream=False, json_mode=False):
+        self.release.wait(5)
+        if self.failing:
+            raise ConnectionError("provider down")
+        if stream:
+            return iter(["a", "b", "c"])
+        return "ok"
+
+
+def make_gateway(provider):
+    config = {"max_in_flight": 1, "queue_timeout": 0.05, "failure_threshold": 1, "circuit_cooldown": 0.05,
+              "max_retries": 0, "default_timeout": 5}
+    return LLMGateway(config, provider)
+
+
+def open_circuit(gateway, provider):
+    provider.failing = True
+    with pytest.raises(ConnectionError):
+        gateway.generate_content("chat", "hi", "model")
+    provider.failing = False
+    assert gateway.circuit.state == "open"
+    time.sleep(0.06)
+    assert gateway.circuit.state == "half_open"
+
+
+def test_queue_timeout_in_half_open_state_does_not_wedge_circuit():
+    provider = FakeProvider()
+    gateway = make_gateway(provider)
+    open_circuit(gateway, provider)
+
+    # Saturate the in-flight limit, then make a call that times out waiting for a slot
+    assert gateway.in_flight.acquire(timeout=1)
+    with pytest.raises(LLMUnavailableError):
+        gateway.generate_content("chat", "hi", "model")
+    gateway.in_flight.release()
+
+    assert not gateway.circuit.trial_in_progress
+    assert gateway.generate_content("chat", "hi", "model") == "ok"
+    assert gateway.circuit.state == "closed"
+
+
+def test_stream_closed_early_releases_half_open_trial():
+    provider = FakeProvider()
+    gateway = make_gateway(provider)
+    open_circuit(gateway, provider)
+
+    stream = gateway.stream_content("chat", "hi", "model")
+    assert next(stream) == "a"
+    assert gateway.circuit.trial_in_progress
+    stream.close()
+
+    assert not gateway.circuit.trial_in_progress
+    assert gateway.in_flight.acquire(timeout=0)
+    gateway.in_flight.release()
+    assert gateway.generate_content("chat", "hi", "model") == "ok"
+    assert gateway.circuit.state == "closed"
+
+
+def test_open_circuit_rejects_without_waiting_for_a_slot():
+    provider = FakeProvider()
+    gateway = make_gateway(provider)
+    gateway.config["queue_timeout"] = 2
+    gateway.circuit.cooldown = 60
+    provider.failing = True
+    with pytest.raises(ConnectionError):
+        gateway.generate_content("chat", "hi", "model")
+    assert gateway.circuit.state == "open"
+
+    # Every slot is held by a hung call
+    assert gateway.in_flight.acquire(timeout=1)
+    started = time.monotonic()
+    with pytest.raises(LLMUnavailableError, match="circuit is open"):
+        gateway.generate_content("chat", "hi", "model")
+    assert time.monotonic() - started < 0.5
+    gateway.in_flight.release()
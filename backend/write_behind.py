@@ -0,0 +1,115 @@
+"""
+Write-behind buffering for high-volume, loss-tolerant events such as image views.
+
+Request threads append events to a bounded in-process buffer and return immediately; a
+background thread hands them to a flush function in batches, when batch_size events are
+waiting or every flush_interval seconds. When the buffer is full new events are dropped
+and counted instead of blocking the request. What is still buffered is flushed when the
+process exits.
+"""
+import atexit
+import os
+import threading
+from collections import deque
+
+
+class WriteBehindBuffer:
+    """
+    Bounded buffer drained by a per-process flush thread. flush(events) receives a list of at
+    most batch_size events and should write them in one round trip; if it raises, that batch
+    is counted as failed and discarded. The optional observer is told about flushed, dropped
+    and failed events.
+    """
+
+    def __init__(self, name, flush, config, observer=None):
+        self.name = name
+        self.flush = flush
+        self.max_size = config.get("buffer_size", 10000)
+        self.batch_size = config.get("batch_size", 500)
+        self.flush_interval = config.get("flush_interval", 2.0)
+        self.observer = observer
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+        self.stats = {"buffered": 0, "flushed": 0, "dropped": 0, "failed": 0, "flushes": 0}
+
+    def add(self, event):
+        """Queue one event without blocking. Returns False if the buffer was full and it was dropped."""
+        with self.lock:
+            if len(self.events) >= self.max_size:
+                self.stats["dropped"] += 1
+                dropped = True
+            else:
+                self.events.append(event)
+                self.stats["buffered"] += 1
+                dropped = False
+                if len(self.events) >= self.batch_size:
+                    self.wakeup.set()
+        if dropped and self.observer:
+            self.observer.events_dropped(self.name, 1)
+        return not dropped
+
+    def start(self):
+        """Start this process's flush thread if it is not running yet."""
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            if self.thread_pid is not None:
+                # Forked from a process with a running flush thread: its lock and events belong to the parent
+                self.lock = threading.Lock()
+                self.events = deque()
+                self.wakeup = threading.Event()
+                self.stopping = threading.Event()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name=f"{self.name}-flush", daemon=True)
+            self.thread.start()
+            self.thread_pid = os.getpid()
+            atexit.register(self.stop)
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush_pending()
+
+    def flush_pending(self):
+        """Flush everything buffered so far, one batch at a time."""
+        while True:
+            with self.lock:
+                batch = [self.events.popleft() for _ in range(min(self.batch_size, len(self.events)))]
+            if not batch:
+                return
+            try:
+                self.flush(batch)
+            except Exception:
+                with self.lock:
+                    self.stats["failed"] += len(batch)
+                if self.observer:
+                    self.observer.events_failed(self.name, len(batch))
+                continue
+            with self.lock:
+                self.stats["flushed"] += len(batch)
+                self.stats["flushes"] += 1
+            if self.observer:
+                self.observer.events_flushed(self.name, len(batch))
+
+    def stop(self, timeout=5.0):
+        """Stop the flush thread and write out whatever is still buffered."""
+        if self.thread is None or self.thread_pid != os.getpid():
+            return
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join(timeout)
+        self.flush_pending()
+        self.thread_pid = None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self.events)
+        return stats
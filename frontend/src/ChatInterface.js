@@ -112,14 +112,24 @@ const ChatInterface = ({ imageId, initialHistory = [], userId = 'anonymous' }) =
       setChatHistory(prev => [...prev, userMessageObj]);
       
       console.log('Sending message to server:', { message, imageId, userId });
-      const response = await axios.post('http://localhost:5000/chat', {
-        message: message,
-        image_id: imageId,
-        user_id: userId
+      const response = await fetch('http://localhost:5000/chat/stream', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          message: message,
+          image_id: imageId,
+          user_id: userId
+        })
       });
       
-      console.log('Server response:', response.data);
+      if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}));
+        const requestError = new Error('Chat request failed');
+        requestError.response = { data: errorData };
+        throw requestError;
+      }
       
+      const botMessageId = 'bot-' + Date.now();
       setChatHistory(prev => [
         ...prev.filter(msg => msg.id !== userMessageObj.id),
         {
@@ -130,12 +140,54 @@ const ChatInterface = ({ imageId, initialHistory = [], userId = 'anonymous' }) =
         },
         {
           role: 'bot',
-          content: response.data.response,
-          id: 'bot-' + Date.now(),
+          content: '',
+          id: botMessageId,
           timestamp: new Date().toISOString()
         }
       ]);
       
+      const updateBotMessage = (update) => {
+        setChatHistory(prev => prev.map(msg => 
+          msg.id === botMessageId ? { ...msg, content: update(msg.content) } : msg
+        ));
+      };
+      
+      // Read the Server-Sent Events stream: "event: <name>\ndata: <json>\n\n"
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let finished = false;
+      
+      while (!finished) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        
+        for (const rawEvent of events) {
+          let eventName = 'message';
+          let data = '';
+          rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event: ')) eventName = line.slice(7);
+            else if (line.startsWith('data: ')) data += line.slice(6);
+          });
+          if (!data) continue;
+          
+          const payload = JSON.parse(data);
+          if (eventName === 'chunk') {
+            updateBotMessage(content => content + payload.text);
+          } else if (eventName === 'done') {
+            console.log('Server response:', payload);
+            updateBotMessage(() => payload.response);
+            finished = true;
+          } else if (eventName === 'error') {
+            console.error('Error while streaming response:', payload.error);
+          }
+        }
+      }
+      
       setMessage('');
       
     } catch (err) {
@@ -26,11 +26,10 @@ const ChatSidebar = ({ onSelectImage }) => {
       setLoading(true);
       setError(null);
       
-      const response = await axios.get(`http://localhost:5000/chat-history?user_id=${currentUser.user_id}`);
+      const response = await axios.get(`http://localhost:5000/chat-summaries?user_id=${currentUser.user_id}`);
       
-      if (response.data && Array.isArray(response.data.chat_history)) {
-        const groupedHistory = processAndGroupChatHistory(response.data.chat_history);
-        setChatHistory(groupedHistory);
+      if (response.data && Array.isArray(response.data.conversations)) {
+        setChatHistory(response.data.conversations);
       }
     } catch (err) {
       console.error('Error loading user chat history:', err);
@@ -40,46 +39,6 @@ const ChatSidebar = ({ onSelectImage }) => {
     }
   };
 
-  const processAndGroupChatHistory = (history) => {
-    const imageGroups = {};
-    
-    history.forEach(chat => {
-      if (!chat.image_id) return;
-      
-      if (!imageGroups[chat.image_id]) {
-        imageGroups[chat.image_id] = {
-          image_id: chat.image_id,
-          last_chat_time: chat.timestamp,
-          chats: []
-        };
-      }
-      
-      if (chat.role === 'user') {
-        const botResponse = history.find(msg => 
-          msg.role === 'bot' && 
-          msg.timestamp > chat.timestamp && 
-          (!msg.image_id || msg.image_id === chat.image_id)
-        );
-        
-        const contextTitle = chat.content.split(' ').slice(0, 5).join(' ') + '...';
-        
-        imageGroups[chat.image_id].chats.push({
-          context_title: contextTitle,
-          user_message: chat.content,
-          bot_response: botResponse ? botResponse.content : 'No response',
-          timestamp: chat.timestamp
-        });
-        
-        if (new Date(chat.timestamp) > new Date(imageGroups[chat.image_id].last_chat_time)) {
-          imageGroups[chat.image_id].last_chat_time = chat.timestamp;
-        }
-      }
-    });
-    
-    return Object.values(imageGroups)
-      .sort((a, b) => new Date(b.last_chat_time) - new Date(a.last_chat_time));
-  };
-
   const handleExpandItem = (index) => {
     setExpandedItem(expandedItem === index ? null : index);
   };
@@ -195,7 +154,7 @@ const ChatSidebar = ({ onSelectImage }) => {
                 <div className="d-flex align-items-center justify-content-between w-100">
                   <div className="history-context">
                     <i className="bi bi-chat-dots me-2"></i>
-                    {item.chats[0]?.context_title || 'Chat Conversation'}
+                    {item.title || 'Chat Conversation'}
                   </div>
                   <div className="history-actions">
                     <button 
@@ -222,23 +181,21 @@ const ChatSidebar = ({ onSelectImage }) => {
                     View Full Chat
                   </button>
                   
-                  {item.chats.slice(0, 3).map((chat, chatIndex) => (
-                    <div key={chatIndex} className="history-chat-item">
-                      <div className="history-chat-query">
-                        <strong>You:</strong> {chat.user_message}
-                      </div>
-                      <div className="history-chat-response">
-                        <strong>AI:</strong> {chat.bot_response.length > 100 
-                          ? chat.bot_response.substring(0, 100) + '...' 
-                          : chat.bot_response}
-                      </div>
+                  <div className="history-chat-item">
+                    <div className="history-chat-query">
+                      <strong>You:</strong> {item.last_user_message}
+                    </div>
+                    <div className="history-chat-response">
+                      <strong>AI:</strong> {(item.last_bot_message || '').length > 100 
+                        ? item.last_bot_message.substring(0, 100) + '...' 
+                        : item.last_bot_message}
                     </div>
-                  ))}
+                  </div>
                   
-                  {item.chats.length > 3 && (
+                  {item.message_count > 2 && (
                     <div className="text-center mt-2">
                       <small className="text-muted">
-                        + {item.chats.length - 3} more conversations
+                        + {Math.ceil(item.message_count / 2) - 1} more conversations
                       </small>
                     </div>
                   )}